@@ -0,0 +1,129 @@
+#This file resolves abbreviated object names and computes the shortest unique ones.
+#Packs are searched with a binary search over the sorted SHAs of the
+#multi-pack-index and of the .idx it does not cover. Loose objects come from a
+#sorted listing of each fan-out directory, kept until the directory's mtime changes.
+import bisect
+import os
+
+from libgitv.GitPack import pack_indexes, sha_lower_bound
+
+
+# Shortest abbreviation printed when core.abbrev is not set
+DEFAULT_ABBREV = 7
+# Shortest abbreviation accepted when resolving one
+MIN_ABBREV = 4
+
+
+class GitLooseNames(object):
+    """
+    Sorted names of the loose objects of each fan-out directory (the last 38
+    characters of their SHA), listed on first use and again once the directory's mtime changes
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.dirs = {}
+        """Fan-out directory ('00' to 'ff') -> (mtime, sorted names)"""
+
+    def names(self, prefix):
+        path = self.repo.path("objects", prefix)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+        cached = self.dirs.get(prefix)
+        if cached is None or cached[0] != mtime:
+            cached = self.dirs[prefix] = (mtime, sorted(f for f in os.listdir(path) if len(f) == 38))
+        return cached[1]
+
+
+def loose_names(repo, prefix):
+    """
+    Return the sorted names of the loose objects in fan-out directory prefix
+    """
+    if repo.looseNames is None:
+        repo.looseNames = GitLooseNames(repo)
+    return repo.looseNames.names(prefix)
+
+
+def common_prefix_length(a, b):
+    # Number of leading hex digits a and b (both hex) share
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def abbrev_resolve(repo, prefix):
+    """
+    Return the sorted SHAs of every object whose SHA starts with prefix (hex, any case)
+    """
+    prefix = prefix.lower()
+    found = set()
+
+    names = loose_names(repo, prefix[:2])
+    rest = prefix[2:]
+    i = bisect.bisect_left(names, rest)
+    while i < len(names) and names[i].startswith(rest):
+        found.add(prefix[:2] + names[i])
+        i += 1
+
+    # The lowest SHA the prefix can start: padded with zeros to whole bytes
+    binsha = bytes.fromhex(prefix + '0' * (len(prefix) % 2))
+    for index in pack_indexes(repo):
+        i = sha_lower_bound(index, binsha)
+        while i < index.count:
+            sha = index.sha_at(i).hex()
+            if not sha.startswith(prefix):
+                break
+            found.add(sha)
+            i += 1
+    return sorted(found)
+
+
+def abbrev_length(repo, sha, minLength=None):
+    """
+    Return the length of the shortest unique abbreviation of sha, at least minLength
+    """
+    return abbrev_unique(repo, [sha], minLength)[0]
+
+
+def abbrev_unique(repo, shas, minLength=None):
+    """
+    Return the length of the shortest unique abbreviation of each of shas:
+    one more than the longest prefix it shares with its nearest neighbours in every
+    sorted list of objects, and at least minLength (default core.abbrev, or 7).
+    """
+    if minLength is None:
+        configured = repo.conf.get("core", "abbrev", fallback="")
+        minLength = int(configured) if configured.isdigit() else DEFAULT_ABBREV  # "auto" is not supported
+    minLength = max(MIN_ABBREV, minLength)
+    indexes = pack_indexes(repo)
+    lengths = []
+    for sha in shas:
+        sha = sha.lower()
+        shared = 0
+        names = loose_names(repo, sha[:2])
+        i = bisect.bisect_left(names, sha[2:])
+        for j in (i - 1, i, i + 1):
+            if 0 <= j < len(names) and names[j] != sha[2:]:
+                shared = max(shared, 2 + common_prefix_length(names[j], sha[2:]))
+
+        binsha = bytes.fromhex(sha)
+        for index in indexes:
+            i = sha_lower_bound(index, binsha)
+            for j in (i - 1, i, i + 1):
+                if 0 <= j < index.count:
+                    other = index.sha_at(j)
+                    if other != binsha:
+                        shared = max(shared, common_prefix_length(other.hex(), sha))
+        lengths.append(min(40, max(minLength, shared + 1)))
+    return lengths
+
+
+def abbrev(repo, shas, minLength=None):
+    """
+    Return the shortest unique abbreviation of each of shas
+    """
+    return [sha[:length] for sha, length in zip(shas, abbrev_unique(repo, shas, minLength))]
@@ -0,0 +1,343 @@
+#This file is the reachability bitmap index of a pack (pack-*.bitmap, in git's format).
+#For some selected commits it stores an EWAH compressed bitmap of every object
+#reachable from them, bit i standing for the i-th object of the pack in pack order.
+#The objects reachable from any set of commits are then the OR of the bitmaps of
+#the nearest selected commits, plus the objects of the few commits walked to reach them.
+import array
+import bisect
+import hashlib
+import os
+import struct
+import sys
+
+from libgitv.GitObject import GitObject
+from libgitv.GitCommit import kvlm_parse
+from libgitv.GitTree import GitTree
+from libgitv.GitPack import mmap_file, pack_list
+from libgitv.util.Ewah import ewah_serialize, ewah_deserialize
+
+
+BITMAP_SIGNATURE = b'BITM'
+BITMAP_VERSION = 1
+BITMAP_OPT_FULL_DAG = 0x1  # Every object reachable from the pack is in the pack
+BITMAP_OPT_HASH_CACHE = 0x4
+BITMAP_OPT_LOOKUP_TABLE = 0x10
+
+RIDX_SIGNATURE = b'RIDX'
+RIDX_VERSION = 1
+RIDX_HASH_SHA1 = 1
+
+# Type bitmaps, in file order
+BITMAP_TYPES = (b'commit', b'tree', b'blob', b'tag')
+# One commit in this many gets a bitmap, besides the ref tips
+BITMAP_SPACING = 100
+# An entry may be stored XORed with one of the previous entries, at most this far back
+XOR_MAX = 160
+
+
+class GitBitmapIndex(object):
+    """
+    Bitmap index: header (signature, version, flags, entry count, pack checksum),
+    the commit, tree, blob and tag type bitmaps, then for each selected commit its
+    position in the .idx, the distance to the entry it is XORed with, flags and
+    its bitmap. An optional name-hash cache and lookup table follow; they are not used.
+    """
+    def __init__(self, pack, path):
+        self.pack = pack
+        self.path = path
+        self.data = mmap_file(path)
+
+        signature, version, flags, entryCount = struct.unpack_from('!4sHHL', self.data, 0)
+        if signature != BITMAP_SIGNATURE or version != BITMAP_VERSION:
+            raise Exception("Unsupported bitmap index {0}".format(path))
+        if self.data[12:32] != pack.data[-20:]:
+            raise Exception("Bitmap index {0} does not match its pack".format(path))
+
+        pos = 32
+        self.types = {}
+        for fmt in BITMAP_TYPES:
+            pos, self.types[fmt], _ = ewah_deserialize(self.data, pos)
+
+        self.entries = []
+        """(position of the bitmap, XOR distance) of each entry"""
+        self.commits = {}
+        """Commit sha -> entry number"""
+        for i in range(entryCount):
+            idxPos, xorOffset, entryFlags = struct.unpack_from('!LBB', self.data, pos)
+            pos += 6
+            if xorOffset > min(i, XOR_MAX) or idxPos >= pack.index.count:
+                raise Exception("Corrupt bitmap index {0}".format(path))
+            self.commits[pack.index.sha_at(idxPos).hex()] = i
+            self.entries.append((pos, xorOffset))
+            bitSize, nwords = struct.unpack_from('!LL', self.data, pos)
+            pos += 8 + 8 * nwords + 4
+
+        self.bitmaps = {}
+        """Entry number -> bitmap, for the entries decoded so far"""
+        self.order = None
+
+    def bitmap(self, sha):
+        """
+        Return the bitmap of the objects reachable from commit sha, or None when it has none
+        """
+        i = self.commits.get(sha)
+        if i is None:
+            return None
+        # Decode the XOR chain down to an entry stored as is or already decoded
+        chain = []
+        j = i
+        while j not in self.bitmaps:
+            chain.append(j)
+            xorOffset = self.entries[j][1]
+            if not xorOffset:
+                break
+            j -= xorOffset
+        for j in reversed(chain):
+            pos, xorOffset = self.entries[j]
+            bits = ewah_deserialize(self.data, pos)[1]
+            if xorOffset:
+                bits ^= self.bitmaps[j - xorOffset]
+            self.bitmaps[j] = bits
+        return self.bitmaps[i]
+
+    def pack_order(self):
+        """
+        Index positions of the objects in pack order, from the .rev file when
+        there is one, else by sorting the offsets
+        """
+        if self.order is None:
+            index = self.pack.index
+            revPath = self.pack.path[:-len('.pack')] + '.rev'
+            if os.path.exists(revPath):
+                with open(revPath, 'rb') as f:
+                    data = f.read()
+                signature, version, hashId = struct.unpack_from('!4sLL', data, 0)
+                if signature != RIDX_SIGNATURE or version != RIDX_VERSION or hashId != RIDX_HASH_SHA1:
+                    raise Exception("Unsupported reverse index {0}".format(revPath))
+                order = array.array('I', data[12:12 + 4 * index.count])
+                if sys.byteorder == 'little':
+                    order.byteswap()
+                self.order = order
+            else:
+                self.order = sorted(range(index.count), key=index.offset_at)
+        return self.order
+
+    def position(self, sha):
+        """
+        Return the pack order position of sha (hex), or None when it is not in the pack
+        """
+        index = self.pack.index
+        i = index.find(bytes.fromhex(sha))
+        if i is None:
+            return None
+        # Offsets grow with the pack order
+        return bisect.bisect_left(self.pack_order(), index.offset_at(i), key=index.offset_at)
+
+    def sha_at(self, pos):
+        return self.pack.index.sha_at(self.pack_order()[pos]).hex()
+
+    def close(self):
+        self.data.close()
+
+
+def bitmap_find(repo):
+    """
+    Return the bitmap index of the first pack that has one, or None
+    """
+    for pack in pack_list(repo):
+        if pack.bitmap is None:
+            path = pack.path[:-len('.pack')] + '.bitmap'
+            pack.bitmap = GitBitmapIndex(pack, path) if os.path.exists(path) else False
+        if pack.bitmap:
+            return pack.bitmap
+    return None
+
+
+class GitBitmapWalk(object):
+    """
+    Reachability as a bitmap over the count objects of a pack.
+    position(sha) gives the pack order position of an object, None when it is
+    not in the pack, and bitmap(sha) the bitmap of a commit, None when it has none.
+    """
+    def __init__(self, repo, count, position, bitmap):
+        self.repo = repo
+        self.count = count
+        self.position = position
+        self.bitmap = bitmap
+        self.commits = {}
+        """sha -> (tree, parent SHAs) of the commits read"""
+
+    def commit(self, sha):
+        commit = self.commits.get(sha)
+        if commit is None:
+            kvlm = kvlm_parse(GitObject.object_read_raw(self.repo, sha)[1])
+            parents = kvlm.get(b'parent', [])
+            if type(parents) != list:
+                parents = [parents]
+            commit = self.commits[sha] = (kvlm[b'tree'].decode("ascii"), [p.decode("ascii") for p in parents])
+        return commit
+
+    def reachable(self, roots):
+        """
+        Return (bits, extra): the bitmap of the objects of the pack reachable
+        from roots, and a dict sha -> format of the reachable objects not in the pack
+        """
+        # Walk the commits down to those with a bitmap, which are ORed in
+        bits = 0
+        uncovered = []
+        seen = set()
+        toVisit = [(sha, None) for sha in reversed(roots)]
+        while toVisit:
+            sha, fmt = toVisit.pop()
+            if sha in seen:
+                continue
+            seen.add(sha)
+            bitmap = self.bitmap(sha)
+            if bitmap is not None:
+                bits |= bitmap
+                continue
+            if fmt is None:
+                fmt = GitObject.object_info(self.repo, sha)[0]
+            uncovered.append((sha, fmt))
+            if fmt == b'commit':
+                toVisit.extend((p, b'commit') for p in reversed(self.commit(sha)[1]))
+            elif fmt == b'tag':
+                toVisit.append((kvlm_parse(GitObject.object_read_raw(self.repo, sha)[1])[b'object'].decode("ascii"), None))
+
+        # Then add the trees of the commits left, skipping what the bitmaps already hold:
+        # a tree in the bitmap comes with everything under it
+        marks = bytearray(bits.to_bytes((self.count + 7) // 8, 'little'))
+        extra = {}
+        toVisit = uncovered[::-1]
+        while toVisit:
+            sha, fmt = toVisit.pop()
+            pos = self.position(sha)
+            if pos is None:
+                if sha in extra:
+                    continue
+                extra[sha] = fmt
+            else:
+                if marks[pos >> 3] >> (pos & 7) & 1:
+                    continue
+                marks[pos >> 3] |= 1 << (pos & 7)
+            if fmt == b'commit':
+                toVisit.append((self.commit(sha)[0], b'tree'))
+            elif fmt == b'tree':
+                for item in GitTree.parse(GitObject.object_read_raw(self.repo, sha)[1]):
+                    if item.mode == b'160000':
+                        continue  # Submodule commits live in another repository
+                    toVisit.append((item.sha, b'tree' if item.mode.startswith(b'4') else b'blob'))
+        return int.from_bytes(marks, 'little'), extra
+
+
+def bitmap_reachable(repo, roots):
+    """
+    Objects reachable from roots using the bitmap index.
+    Return (bitmap index, bits, extra) as GitBitmapWalk.reachable, or None without a bitmap index
+    """
+    index = bitmap_find(repo)
+    if index is None:
+        return None
+    walk = GitBitmapWalk(repo, index.pack.index.count, index.position, index.bitmap)
+    bits, extra = walk.reachable(roots)
+    return index, bits, extra
+
+
+def commits_select(objects, tips, commits):
+    """
+    Pick the commits to store a bitmap for: the tips, and one commit in
+    BITMAP_SPACING in the order objects were reached.
+    Return them parents first, as each bitmap is built on those of its ancestors.
+    """
+    selected = set(sha for sha in tips if sha in commits)
+    for i, sha in enumerate(sha for sha, (fmt, _) in objects.items() if fmt == b'commit'):
+        if i % BITMAP_SPACING == 0:
+            selected.add(sha)
+
+    # Depth first, a commit once all its parents are done
+    order = []
+    done = set()
+    for sha in commits:
+        toVisit = [(sha, False)]
+        while toVisit:
+            cur, expanded = toVisit.pop()
+            if expanded:
+                if cur in selected:
+                    order.append(cur)
+                continue
+            if cur in done:
+                continue
+            done.add(cur)
+            toVisit.append((cur, True))
+            toVisit.extend((p, False) for p in commits[cur][1] if p not in done)
+    return order
+
+
+def rev_serialize(order, checksum):
+    # Reverse index: index positions in pack order, pack checksum, file checksum
+    buff = bytearray(struct.pack('!4sLL', RIDX_SIGNATURE, RIDX_VERSION, RIDX_HASH_SHA1))
+    buff += struct.pack('!%dL' % len(order), *order)
+    buff += checksum
+    buff += hashlib.sha1(buff).digest()
+    return bytes(buff)
+
+
+def bitmap_write(repo, path, objects, tips):
+    """
+    Write the bitmap index (and reverse index) of the pack at path, which holds
+    objects, an ordered dict sha -> (format, name) closed under reachability.
+    Bitmaps are stored for the commits of tips and one commit in BITMAP_SPACING.
+    Return the number of bitmaps written.
+    """
+    pack = next(pack for pack in pack_list(repo) if pack.path == path)
+    index = pack.index
+    count = index.count
+    order = sorted(range(count), key=index.offset_at)
+    positions = {}
+    for pos, i in enumerate(order):
+        positions[index.sha_at(i).hex()] = pos
+
+    typeMarks = {fmt: bytearray((count + 7) // 8) for fmt in BITMAP_TYPES}
+    for sha, (fmt, _) in objects.items():
+        pos = positions[sha]
+        typeMarks[fmt][pos >> 3] |= 1 << (pos & 7)
+
+    bitmaps = {}
+    walk = GitBitmapWalk(repo, count, positions.get, bitmaps.get)
+    for sha, (fmt, _) in objects.items():
+        if fmt == b'commit':
+            walk.commit(sha)
+    for sha in commits_select(objects, tips, walk.commits):
+        bits, extra = walk.reachable([sha])
+        if extra:
+            raise Exception("Pack {0} is missing objects reachable from {1}".format(path, sha))
+        bitmaps[sha] = bits
+
+    checksum = pack.data[-20:]
+    out = bytearray(struct.pack('!4sHHL', BITMAP_SIGNATURE, BITMAP_VERSION, BITMAP_OPT_FULL_DAG, len(bitmaps)))
+    out += checksum
+    for fmt in BITMAP_TYPES:
+        out += ewah_serialize(int.from_bytes(typeMarks[fmt], 'little'))
+
+    # Parents come first, so an entry is usually close to the previous one:
+    # store it XORed with it when that is smaller
+    previous = None
+    for sha, bits in bitmaps.items():
+        stored = ewah_serialize(bits)
+        xorOffset = 0
+        if previous is not None:
+            xored = ewah_serialize(bits ^ previous)
+            if len(xored) < len(stored):
+                stored, xorOffset = xored, 1
+        out += struct.pack('!LBB', index.find(bytes.fromhex(sha)), xorOffset, 0)
+        out += stored
+        previous = bits
+    out += hashlib.sha1(out).digest()
+
+    basePath = path[:-len('.pack')]
+    for ext, data in (('.rev', rev_serialize(order, checksum)), ('.bitmap', bytes(out))):
+        tmpPath = basePath + ext + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(data)
+        os.replace(tmpPath, basePath + ext)
+    return len(bitmaps)
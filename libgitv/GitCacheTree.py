@@ -0,0 +1,115 @@
+#This file is the cache-tree, stored in the TREE extension of the index.
+#For every directory of the index it records how many entries it covers
+#and the SHA of the tree object built from them, so that writing the root
+#tree only rebuilds the directories invalidated since (entry count -1).
+from libgitv.GitTree import GitTree, GitTreeLeaf
+
+
+class GitCacheTree(object):
+    def __init__(self, name=b''):
+        self.name = name
+        self.entryCount = -1
+        """Number of index entries under this directory, -1 when invalid"""
+        self.sha = None
+        """Tree object id as a hex string, when valid"""
+        self.children = {}
+
+    def valid(self):
+        return self.entryCount >= 0
+
+    def parse(data):
+        """
+        Parse the TREE extension: for each directory, in pre-order,
+        "<name>\x00<entry count> <subtree count>\n" then the 20-byte tree id when valid
+        """
+        def parse_one(pos):
+            end = data.index(b'\x00', pos)
+            node = GitCacheTree(data[pos:end])
+            pos = end + 1
+            end = data.index(b'\n', pos)
+            count, subtrees = data[pos:end].split(b' ')
+            pos = end + 1
+            node.entryCount = int(count)
+            if node.valid():
+                node.sha = data[pos:pos+20].hex()
+                pos += 20
+            for i in range(int(subtrees)):
+                pos, child = parse_one(pos)
+                node.children[child.name] = child
+            return pos, node
+
+        return parse_one(0)[1]
+
+    def serialize(self):
+        out = bytearray()
+        toVisit = [self]
+        while toVisit:
+            node = toVisit.pop()
+            out += node.name + b'\x00'
+            out += b'%d %d\n' % (node.entryCount, len(node.children))
+            if node.valid():
+                out += bytes.fromhex(node.sha)
+            # Git orders subtrees by name length first, then name
+            children = sorted(node.children.values(), key=lambda child: (len(child.name), child.name))
+            toVisit.extend(reversed(children))
+        return bytes(out)
+
+    def invalidate(self, path):
+        """
+        Invalidate the directories containing path (bytes), from the root down
+        """
+        node = self
+        node.entryCount, node.sha = -1, None
+        for name in path.split(b'/')[:-1]:
+            node = node.children.get(name)
+            if node is None:
+                return
+            node.entryCount, node.sha = -1, None
+
+    def update(self, repo, items):
+        """
+        Bring the cache-tree up to date with items, the sorted (path bytes, entry)
+        of the index, writing tree objects for invalid directories only.
+        Return the root tree id.
+        """
+        if not self.valid():
+            self.update_one(repo, items, 0, len(items), 0)
+        return self.sha
+
+    def update_one(self, repo, items, lo, hi, prefixLen):
+        leaves = []
+        children = {}
+        i = lo
+        while i < hi:
+            path, entry = items[i]
+            if entry.flags & 0x3000:
+                raise Exception("Cannot write a tree with unmerged entry {0}".format(path.decode("utf-8", "surrogateescape")))
+            slash = path.find(b'/', prefixLen)
+            if slash < 0:
+                leaves.append(GitTreeLeaf(b'%o' % entry.mode, path[prefixLen:], entry.sha1.hex()))
+                i += 1
+                continue
+
+            name = path[prefixLen:slash]
+            child = self.children.get(name) or GitCacheTree(name)
+            if child.valid():
+                # Trust the cache: a valid subtree covers exactly entryCount entries
+                end = i + child.entryCount
+            else:
+                prefix = path[:slash+1]
+                end = i
+                while end < hi and items[end][0].startswith(prefix):
+                    end += 1
+                child.update_one(repo, items, i, end, slash + 1)
+            children[name] = child
+            leaves.append(GitTreeLeaf(b'40000', name, child.sha))
+            i = end
+
+        self.children = children
+        if not self.valid():
+            # Tree entries sort as if directory names ended with '/'
+            leaves.sort(key=lambda leaf: leaf.path + b'/' if leaf.mode == b'40000' else leaf.path)
+            tree = GitTree(repo)
+            tree.items = leaves
+            self.sha = tree.object_write(True)
+            self.entryCount = hi - lo
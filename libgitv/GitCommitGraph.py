@@ -0,0 +1,278 @@
+#This file is the commit-graph, .git/objects/info/commit-graph in git's format.
+#It lists every commit reachable from the refs, sorted by SHA, with its tree,
+#its parents as positions in the same file, its generation number and its date,
+#so history walks follow integers through an mmap instead of inflating commits.
+import hashlib
+import os
+import struct
+
+from libgitv.GitRepository import GitRepository
+from libgitv.GitObject import GitObject
+from libgitv.GitCommit import kvlm_parse
+from libgitv.GitPack import mmap_file
+from libgitv.GitRepack import ref_roots
+
+
+GRAPH_SIGNATURE = b'CGPH'
+GRAPH_VERSION = 1
+GRAPH_HASH_SHA1 = 1
+CHUNK_OID_FANOUT = b'OIDF'
+CHUNK_OID_LOOKUP = b'OIDL'
+CHUNK_COMMIT_DATA = b'CDAT'
+CHUNK_EXTRA_EDGES = b'EDGE'
+
+PARENT_NONE = 0x70000000
+PARENT_EXTRA_EDGES = 0x80000000  # Second parent field: index in EDGE of the 2nd, 3rd... parents
+EDGE_LAST = 0x80000000
+GENERATION_INFINITY = 0xFFFFFFFF  # Generation of commits missing from the graph
+GENERATION_MAX = 0x3FFFFFFF
+
+# Tree, parent 1, parent 2, generation << 2 | date bits 32-33, date bits 0-31
+COMMIT_DATA = struct.Struct('!20sLLLL')
+
+
+class GitCommitGraph(object):
+    def __init__(self, path):
+        self.path = path
+        self.data = mmap_file(path)
+
+        signature, version, hashVersion, chunkCount = struct.unpack_from('!4sBBB', self.data, 0)
+        if signature != GRAPH_SIGNATURE or version != GRAPH_VERSION or hashVersion != GRAPH_HASH_SHA1:
+            raise Exception("Unsupported commit-graph {0}".format(path))
+
+        # Table of contents: chunk id and offset, then a terminating entry
+        chunks = {}
+        for i in range(chunkCount):
+            chunkId, offset = struct.unpack_from('!4sQ', self.data, 8 + 12 * i)
+            chunks[chunkId] = offset
+        for chunkId in (CHUNK_OID_FANOUT, CHUNK_OID_LOOKUP, CHUNK_COMMIT_DATA):
+            if chunkId not in chunks:
+                raise Exception("Commit-graph {0} has no {1} chunk".format(path, chunkId.decode("ascii")))
+
+        self.fanout = struct.unpack_from('!256L', self.data, chunks[CHUNK_OID_FANOUT])
+        self.count = self.fanout[255]
+        self.lookupOffset = chunks[CHUNK_OID_LOOKUP]
+        self.dataOffset = chunks[CHUNK_COMMIT_DATA]
+        self.edgeOffset = chunks.get(CHUNK_EXTRA_EDGES)
+
+    def sha_at(self, i):
+        start = self.lookupOffset + 20 * i
+        return self.data[start:start+20].hex()
+
+    def find(self, sha):
+        """
+        Return the position of sha (hex) in the graph, or None
+        """
+        binsha = bytes.fromhex(sha)
+        first = binsha[0]
+        lo = self.fanout[first-1] if first else 0
+        hi = self.fanout[first]
+        data = self.data
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.lookupOffset + 20 * mid
+            cur = data[start:start+20]
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def commit_at(self, i):
+        """
+        Return (parent positions, generation, commit date) of the commit at position i
+        """
+        tree, parent1, parent2, genDate, dateLow = COMMIT_DATA.unpack_from(self.data, self.dataOffset + 36 * i)
+        if parent1 == PARENT_NONE:
+            parents = []
+        elif parent2 == PARENT_NONE:
+            parents = [parent1]
+        elif parent2 & PARENT_EXTRA_EDGES:
+            parents = [parent1]
+            pos = self.edgeOffset + 4 * (parent2 & ~PARENT_EXTRA_EDGES)
+            while True:
+                edge, = struct.unpack_from('!L', self.data, pos)
+                parents.append(edge & ~EDGE_LAST)
+                if edge & EDGE_LAST:
+                    break
+                pos += 4
+        else:
+            parents = [parent1, parent2]
+        return parents, genDate >> 2, ((genDate & 3) << 32) | dateLow
+
+    def tree_at(self, i):
+        start = self.dataOffset + 36 * i
+        return self.data[start:start+20].hex()
+
+    def close(self):
+        self.data.close()
+
+
+def commit_graph(repo):
+    """
+    Return the commit-graph of the repository, opened the first time only,
+    or None when there is none or core.commitGraph is false
+    """
+    if repo.commitGraph is None:
+        repo.commitGraph = False
+        path = repo.file("objects", "info", "commit-graph")
+        if (repo.conf.getboolean("core", "commitGraph", fallback=True)
+                and path and os.path.exists(path)):
+            repo.commitGraph = GitCommitGraph(path)
+    return repo.commitGraph or None
+
+
+def commit_graph_reset(repo):
+    # Drop the open commit-graph so that the next lookup reads the file again
+    if repo.commitGraph:
+        repo.commitGraph.close()
+    repo.commitGraph = None
+
+
+def commit_parse(repo, sha):
+    """
+    Return (tree, parent SHAs, commit date) read from the commit object
+    """
+    fmt, raw = GitObject.object_read_raw(repo, sha)
+    if fmt != b'commit':
+        raise Exception("Object {0} is a {1}, not a commit".format(sha, fmt.decode("ascii")))
+    kvlm = kvlm_parse(raw)
+    parents = kvlm.get(b'parent', [])
+    if type(parents) != list:
+        parents = [parents]
+    committer = kvlm[b'committer']
+    if type(committer) == list:
+        committer = committer[0]
+    return kvlm[b'tree'].decode("ascii"), [p.decode("ascii") for p in parents], int(committer.split(b' ')[-2])
+
+
+def commit_info(repo, sha):
+    """
+    Return (parent SHAs, generation, commit date) of a commit, from the
+    commit-graph when it has it. Commits missing from it get GENERATION_INFINITY.
+    """
+    graph = commit_graph(repo)
+    if graph is not None:
+        i = graph.find(sha)
+        if i is not None:
+            parents, generation, date = graph.commit_at(i)
+            return [graph.sha_at(p) for p in parents], generation, date
+    tree, parents, date = commit_parse(repo, sha)
+    return parents, GENERATION_INFINITY, date
+
+
+def commit_graph_commits(repo, roots):
+    """
+    Walk every commit reachable from roots, peeling tags.
+    Return a dict sha -> (tree, parent SHAs, commit date), taken from the
+    current commit-graph when possible
+    """
+    graph = commit_graph(repo)
+    commits = {}
+    toVisit = list(ref_roots(repo) if roots is None else roots)
+    while toVisit:
+        sha = toVisit.pop()
+        if sha in commits:
+            continue
+        i = graph.find(sha) if graph is not None else None
+        if i is not None:
+            parents, _, date = graph.commit_at(i)
+            commits[sha] = (graph.tree_at(i), [graph.sha_at(p) for p in parents], date)
+        else:
+            fmt, _ = GitObject.object_info(repo, sha)
+            if fmt == b'tag':
+                toVisit.append(kvlm_parse(GitObject.object_read_raw(repo, sha)[1])[b'object'].decode("ascii"))
+                continue
+            if fmt != b'commit':
+                continue  # Refs may point to trees or blobs
+            commits[sha] = commit_parse(repo, sha)
+        toVisit.extend(commits[sha][1])
+    return commits
+
+
+def commit_graph_write(repo, roots=None):
+    """
+    Write the commit-graph of every commit reachable from roots (default: the refs).
+    Return the number of commits written.
+    """
+    commits = commit_graph_commits(repo, roots)
+    shas = sorted(commits)
+    position = {sha: i for i, sha in enumerate(shas)}
+
+    # Generation: 1 for root commits, else one more than the highest parent's.
+    # Computed with an explicit stack, as history can be much deeper than the recursion limit
+    generations = {}
+    for sha in shas:
+        toVisit = [sha]
+        while toVisit:
+            cur = toVisit[-1]
+            if cur in generations:
+                toVisit.pop()
+                continue
+            missing = [p for p in commits[cur][1] if p not in generations]
+            if missing:
+                toVisit.extend(missing)
+                continue
+            toVisit.pop()
+            generations[cur] = min(GENERATION_MAX, 1 + max((generations[p] for p in commits[cur][1]), default=0))
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+
+    lookup = b''.join(bytes.fromhex(sha) for sha in shas)
+    data = bytearray(36 * len(shas))
+    edges = []
+    for i, sha in enumerate(shas):
+        tree, parents, date = commits[sha]
+        parentPositions = [position[p] for p in parents]
+        parent1 = parentPositions[0] if parentPositions else PARENT_NONE
+        if len(parentPositions) <= 1:
+            parent2 = PARENT_NONE
+        elif len(parentPositions) == 2:
+            parent2 = parentPositions[1]
+        else:
+            # Octopus merge: the other parents go to the EDGE chunk, the last one flagged
+            parent2 = PARENT_EXTRA_EDGES | len(edges)
+            edges.extend(parentPositions[1:])
+            edges[-1] |= EDGE_LAST
+        COMMIT_DATA.pack_into(data, 36 * i, bytes.fromhex(tree), parent1, parent2,
+            (generations[sha] << 2) | ((date >> 32) & 3), date & 0xFFFFFFFF)
+
+    chunks = [(CHUNK_OID_FANOUT, struct.pack('!256L', *fanout)), (CHUNK_OID_LOOKUP, lookup), (CHUNK_COMMIT_DATA, bytes(data))]
+    if edges:
+        chunks.append((CHUNK_EXTRA_EDGES, struct.pack('!%dL' % len(edges), *edges)))
+
+    out = bytearray(struct.pack('!4sBBBB', GRAPH_SIGNATURE, GRAPH_VERSION, GRAPH_HASH_SHA1, len(chunks), 0))
+    offset = 8 + 12 * (len(chunks) + 1)
+    for chunkId, chunk in chunks:
+        out += struct.pack('!4sQ', chunkId, offset)
+        offset += len(chunk)
+    out += struct.pack('!4sQ', b'\x00' * 4, offset)
+    for _, chunk in chunks:
+        out += chunk
+    out += hashlib.sha1(out).digest()
+
+    commit_graph_reset(repo)
+    path = repo.file("objects", "info", "commit-graph", mkdir=True)
+    lockPath = path + '.lock'
+    fd = os.open(lockPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o444)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(out)
+        os.replace(lockPath, path)
+    except BaseException:
+        os.remove(lockPath)
+        raise
+    return len(shas)
+
+
+def cmd_commit_graph(args):
+    repo = GitRepository.repo_find()
+    if args.action == 'write':
+        count = commit_graph_write(repo)
+        print("Wrote commit-graph of {0} commits".format(count))
@@ -0,0 +1,129 @@
+#This file is the tree-to-tree diff and the diff-tree command.
+#The entries of two trees are merge-walked in git's tree order. An entry whose
+#SHA and mode are the same on both sides is skipped without being read, so a
+#whole unchanged subtree costs one comparison; only the trees along changed
+#paths are read. Changes are yielded one at a time, in path order.
+from libgitv.GitRepository import GitRepository
+from libgitv.GitObject import GitObject
+from libgitv.GitCommitGraph import commit_parse
+
+
+NULL_SHA = '0' * 40
+MODE_TREE = 0o40000
+MODE_GITLINK = 0o160000
+
+
+def entry_key(entry):
+    # Trees sort as if their name ended with '/', as in git
+    return entry.path + b'/' if entry.mode.startswith(b'4') else entry.path
+
+
+def entries_merge(oldItems, newItems):
+    """
+    Yield (name, old entry or None, new entry or None) over two sorted lists of tree entries
+    """
+    i = j = 0
+    while i < len(oldItems) or j < len(newItems):
+        old = oldItems[i] if i < len(oldItems) else None
+        new = newItems[j] if j < len(newItems) else None
+        if new is None or (old is not None and entry_key(old) < entry_key(new)):
+            yield old.path, old, None
+            i += 1
+        elif old is None or entry_key(new) < entry_key(old):
+            yield new.path, None, new
+            j += 1
+        else:
+            yield old.path, old, new
+            i += 1
+            j += 1
+
+
+def tree_items(repo, sha):
+    # Entries of tree sha, none for None
+    if sha is None:
+        return []
+    return GitObject.object_read(repo, sha).items
+
+
+def diff_status(oldMode, newMode):
+    if not oldMode:
+        return 'A'
+    if not newMode:
+        return 'D'
+    if oldMode & 0o170000 != newMode & 0o170000:
+        return 'T'  # Type change: file, symlink or submodule
+    return 'M'
+
+
+def diff_trees(repo, a, b, recursive=True):
+    """
+    Compare tree a with tree b (either may be None, for an empty tree).
+    Yield (path, old mode, new mode, old sha, new sha, status) for each change,
+    lazily and in path order. A missing side has mode 0 and the null SHA;
+    status is A(dded), D(eleted), M(odified) or T(ype changed).
+    Without recursive, changed subtrees are yielded as such instead of being entered.
+    """
+    if a == b:
+        return
+    stack = [(b'', entries_merge(tree_items(repo, a), tree_items(repo, b)))]
+    while stack:
+        prefix, entries = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            continue
+        name, old, new = entry
+        if old is not None and new is not None and old.sha == new.sha and old.mode == new.mode:
+            continue  # Same content: an unchanged subtree is not even read
+
+        path = prefix + name
+        oldMode = int(old.mode, 8) if old is not None else 0
+        newMode = int(new.mode, 8) if new is not None else 0
+        if recursive and MODE_TREE in (oldMode, newMode):
+            # Entries of the same name and different kinds never pair up: a tree is on one side only
+            stack.append((path + b'/', entries_merge(
+                tree_items(repo, old.sha if oldMode == MODE_TREE else None),
+                tree_items(repo, new.sha if newMode == MODE_TREE else None))))
+            continue
+        yield (path.decode("utf-8", "surrogateescape"), oldMode, newMode,
+            old.sha if old is not None else NULL_SHA, new.sha if new is not None else NULL_SHA,
+            diff_status(oldMode, newMode))
+
+
+def diff_print(changes, nameOnly=False, nameStatus=False, header=None):
+    """
+    Print changes as diff-tree does, header first when given and there is any change
+    """
+    for path, oldMode, newMode, oldSha, newSha, status in changes:
+        if header is not None:
+            print(header)
+            header = None
+        if nameOnly:
+            print(path)
+        elif nameStatus:
+            print("{0}\t{1}".format(status, path))
+        else:
+            print(":{0:06o} {1:06o} {2} {3} {4}\t{5}".format(oldMode, newMode, oldSha, newSha, status, path))
+
+
+def cmd_diff_tree(args):
+    repo = GitRepository.repo_find()
+    if len(args.trees) > 2:
+        raise Exception("diff-tree takes two trees or one commit")
+    if len(args.trees) == 2:
+        a, b = (GitObject.object_find(repo, name, b'tree') for name in args.trees)
+        diff_print(diff_trees(repo, a, b, args.recursive), args.name_only, args.name_status)
+        return
+
+    # A single commit is compared with its parent; a merge with each of its parents with -m only
+    commit = GitObject.object_find(repo, args.trees[0], b'commit')
+    if commit is None:
+        raise Exception("diff-tree needs two trees or a commit")
+    tree, parents, _ = commit_parse(repo, commit)
+    if not parents:
+        parents = [None] if args.root else []
+    elif len(parents) > 1 and not args.m:
+        parents = []
+    for parent in parents:
+        a = commit_parse(repo, parent)[0] if parent is not None else None
+        diff_print(diff_trees(repo, a, tree, args.recursive), args.name_only, args.name_status, commit)
@@ -0,0 +1,366 @@
+#This file is the filesystem monitor.
+#A daemon watches the worktree with inotify and remembers the paths changed
+#since it started. status asks it what changed since the token stored in the
+#FSMN extension of the index and only examines those paths.
+#core.fsmonitor=true uses the daemon, any other value is run as a hook speaking
+#git's fsmonitor protocol version 2. When nobody answers, status examines everything.
+import ctypes
+import ctypes.util
+import os
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from libgitv.GitRepository import GitRepository
+from libgitv.util.Ewah import ewah_serialize, ewah_deserialize, bit_positions
+
+
+FSMONITOR_SOCKET = 'gitv-fsmonitor.ipc'
+FSMONITOR_COOKIE = 'gitv-fsmonitor-cookie-'
+FSMONITOR_TIMEOUT = 5
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_FORMAT = 'iIII'  # wd, mask, cookie, name length
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+
+def fsmonitor_mode(repo):
+    # core.fsmonitor: None when off, True for the daemon, else the hook command
+    value = repo.conf.get("core", "fsmonitor", fallback="").strip()
+    if value.lower() in ("", "false", "no", "off", "0"):
+        return None
+    if value.lower() in ("true", "yes", "on", "1"):
+        return True
+    return value
+
+
+def fsmonitor_query(repo, token):
+    """
+    Ask the monitor what changed since token (bytes, or None when there is none).
+    Return (new token, changed paths), the paths being None when everything must
+    be examined, or None when no monitor answered.
+    Paths are relative to the worktree, directories end with '/'.
+    """
+    mode = fsmonitor_mode(repo)
+    if mode is None:
+        return None
+    try:
+        if mode is True:
+            reply = daemon_request(repo, b'query ' + (token or b''))
+        else:
+            # Like git, run the hook through the shell: version, then token
+            command = ['sh', '-c', mode + ' 2 "$1"', mode, os.fsdecode(token or b'')]
+            reply = subprocess.run(command, cwd=repo.worktree, check=True, capture_output=True,
+                timeout=FSMONITOR_TIMEOUT).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    fields = reply.split(b'\x00')
+    newToken = fields[0]
+    if not newToken:
+        return None
+    paths = [os.fsdecode(path) for path in fields[1:] if path]
+    if token is None or '/' in paths:
+        return newToken, None
+    return newToken, paths
+
+
+def fsmonitor_parse(data):
+    """
+    Parse the FSMN extension: version 2, the token and a bitmap of the
+    entries whose stat data cannot be trusted. Return (token, entry positions)
+    """
+    version, = struct.unpack_from('!L', data, 0)
+    if version == 1:
+        token = b'%d' % struct.unpack_from('!Q', data, 4)
+        pos = 12
+    else:
+        end = data.index(b'\x00', 4)
+        token = bytes(data[4:end])
+        pos = end + 1
+    pos += 4  # Size of the bitmap
+    bits = ewah_deserialize(data, pos)[1]
+    return token, list(bit_positions(bits))
+
+
+def fsmonitor_serialize(token, positions):
+    bitmap = bytearray((max(positions) // 8 + 1) if positions else 0)
+    for i in positions:
+        bitmap[i >> 3] |= 1 << (i & 7)
+    ewah = ewah_serialize(int.from_bytes(bitmap, 'little'))
+    return struct.pack('!L', 2) + token + b'\x00' + struct.pack('!L', len(ewah)) + ewah
+
+
+def daemon_socket_path(repo):
+    return repo.path(FSMONITOR_SOCKET)
+
+
+def daemon_request(repo, request):
+    """
+    Send one request to the daemon and return its whole reply
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(FSMONITOR_TIMEOUT)
+        sock.connect(daemon_socket_path(repo))
+        sock.sendall(request + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        reply = bytearray()
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return bytes(reply)
+            reply += chunk
+
+
+class GitInotify(object):
+    """
+    Minimal inotify binding through the C library
+    """
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        """Watch descriptor -> watched directory"""
+
+    def add_watch(self, path, dir):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno == 28:  # ENOSPC: fs.inotify.max_user_watches is too low
+                raise Exception("Too many directories to watch, raise fs.inotify.max_user_watches")
+            return False  # Removed meanwhile: its parent reports it
+        self.watches[wd] = dir
+        return True
+
+    def read_events(self):
+        """
+        Yield (watched directory, name, mask) of the pending events
+        """
+        while True:
+            try:
+                buff = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            pos = 0
+            while pos < len(buff):
+                wd, mask, cookie, nameLen = struct.unpack_from(EVENT_FORMAT, buff, pos)
+                name = buff[pos+EVENT_SIZE:pos+EVENT_SIZE+nameLen].rstrip(b'\x00')
+                pos += EVENT_SIZE + nameLen
+                dir = self.watches.get(wd)
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                yield dir, os.fsdecode(name), mask
+
+    def close(self):
+        os.close(self.fd)
+
+
+class GitFsmonitorDaemon(object):
+    def __init__(self, repo):
+        self.repo = repo
+        self.worktree = os.path.abspath(repo.worktree)
+        self.gitdir = os.path.abspath(repo.gitdir)
+        self.inotify = GitInotify()
+        self.cookies = set()
+        self.cookieCount = 0
+        self.reset()
+        # The git directory is only watched for the cookie files of sync()
+        self.inotify.add_watch(self.gitdir, None)
+        self.watch_tree('')
+
+    def reset(self):
+        # A new instance id invalidates every token handed out so far
+        self.instance = b'%x' % time.time_ns()
+        self.seq = 0
+        self.changed = {}
+        """Path -> sequence number of its last change"""
+
+    def watch_tree(self, dir):
+        toVisit = [dir]
+        while toVisit:
+            dir = toVisit.pop()
+            absDir = os.path.join(self.worktree, dir)
+            if not self.inotify.add_watch(absDir, dir):
+                continue
+            try:
+                with os.scandir(absDir) as it:
+                    for dirEntry in it:
+                        if dirEntry.is_dir(follow_symlinks=False) and not (dir == '' and dirEntry.name == '.git'):
+                            toVisit.append(dir + dirEntry.name + '/')
+            except OSError:
+                pass
+
+    def process_events(self):
+        for dir, name, mask in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: nobody can trust their token anymore
+                self.reset()
+                continue
+            if dir is None:
+                if name.startswith(FSMONITOR_COOKIE) and mask & IN_CREATE:
+                    self.cookies.add(name)
+                continue
+            if not name or (dir == '' and name == '.git'):
+                continue  # Events about the watched directory itself are reported by its parent
+            path = dir + name
+            if mask & IN_ISDIR:
+                path += '/'
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(path)
+            self.seq += 1
+            self.changed[path] = self.seq
+
+    def sync(self):
+        """
+        Wait for the events of every change made before now: the kernel reports
+        events in order, so once the cookie file created here is seen, they are in.
+        """
+        self.cookieCount += 1
+        name = '%s%d-%d' % (FSMONITOR_COOKIE, os.getpid(), self.cookieCount)
+        path = os.path.join(self.gitdir, name)
+        open(path, 'wb').close()
+        try:
+            deadline = time.monotonic() + FSMONITOR_TIMEOUT
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.inotify.fd, selectors.EVENT_READ)
+                while name not in self.cookies and time.monotonic() < deadline:
+                    selector.select(deadline - time.monotonic())
+                    self.process_events()
+            if name not in self.cookies:
+                self.reset()  # Events are late: be safe
+        finally:
+            self.cookies.discard(name)
+            os.remove(path)
+
+    def query(self, token):
+        self.sync()
+        instance, _, seq = token.partition(b':')
+        reply = [self.instance + b':%d' % self.seq]
+        if instance != self.instance or not seq.isdigit():
+            reply.append(b'/')  # Unknown token: everything may have changed
+        else:
+            since = int(seq)
+            reply.extend(os.fsencode(path) for path, changeSeq in self.changed.items() if changeSeq > since)
+        return b'\x00'.join(reply) + b'\x00'
+
+    def serve(self, sock):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.inotify.fd, selectors.EVENT_READ)
+            selector.register(sock, selectors.EVENT_READ)
+            while True:
+                for key, _ in selector.select():
+                    if key.fileobj is not sock:
+                        self.process_events()
+                        continue
+                    conn = sock.accept()[0]
+                    with conn:
+                        conn.settimeout(FSMONITOR_TIMEOUT)
+                        request = bytearray()
+                        while not request.endswith(b'\n'):
+                            chunk = conn.recv(4096)
+                            if not chunk:
+                                break
+                            request += chunk
+                        command, _, arg = bytes(request).rstrip(b'\n').partition(b' ')
+                        if command == b'query':
+                            conn.sendall(self.query(arg))
+                        elif command == b'status':
+                            conn.sendall(b'watching %s, %d directories\n' % (os.fsencode(self.worktree), len(self.inotify.watches) - 1))
+                        elif command == b'stop':
+                            conn.sendall(b'stopped\n')
+                            return
+
+
+def daemon_running(repo):
+    try:
+        daemon_request(repo, b'status')
+        return True
+    except OSError:
+        return False
+
+
+def daemon_run(repo):
+    path = daemon_socket_path(repo)
+    if daemon_running(repo):
+        raise Exception("The filesystem monitor is already running")
+    if os.path.exists(path):
+        os.remove(path)  # Left over by a daemon that died
+    daemon = GitFsmonitorDaemon(repo)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(path)
+        sock.listen(16)
+        try:
+            daemon.serve(sock)
+        finally:
+            os.remove(path)
+            daemon.inotify.close()
+
+
+def daemon_start(repo):
+    """
+    Run the daemon in the background, detached from the terminal,
+    and wait until it answers
+    """
+    if daemon_running(repo):
+        raise Exception("The filesystem monitor is already running")
+    pid = os.fork()
+    if pid == 0:
+        # Double fork so that the daemon is not a child of the caller
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        try:
+            daemon_run(repo)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    deadline = time.monotonic() + FSMONITOR_TIMEOUT
+    while not daemon_running(repo):
+        if time.monotonic() > deadline:
+            raise Exception("The filesystem monitor did not start")
+        time.sleep(0.05)
+
+
+def cmd_fsmonitor_daemon(args):
+    if not sys.platform.startswith('linux'):
+        raise Exception("The filesystem monitor needs inotify, only available on Linux")
+    repo = GitRepository.repo_find()
+    if args.action == 'start':
+        daemon_start(repo)
+        print("Watching {0}".format(repo.worktree))
+    elif args.action == 'run':
+        daemon_run(repo)
+    elif args.action == 'stop':
+        try:
+            daemon_request(repo, b'stop')
+        except OSError:
+            raise Exception("The filesystem monitor is not running")
+    elif args.action == 'status':
+        try:
+            print(daemon_request(repo, b'status').decode("utf-8", "surrogateescape"), end='')
+        except OSError:
+            print("The filesystem monitor is not running")
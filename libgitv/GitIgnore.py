@@ -0,0 +1,284 @@
+#This file is the ignore engine.
+#Patterns come from the .gitignore of every directory, .git/info/exclude and
+#core.excludesFile. Each file is compiled once into dicts of literal names,
+#prefixes and suffixes plus a few combined regexes for the other globs, and the
+#files that apply to a directory are cached, so matching a path is mostly dict lookups.
+import hashlib
+import os
+import re
+
+from libgitv.GitUntrackedCache import EMPTY_BLOB_SHA
+
+
+GLOB_CHARS = '*?[\\'
+
+
+def glob_translate(glob):
+    """
+    Translate a gitignore glob to a regex: * and ? do not match '/',
+    a leading '**/' matches any leading directories, a trailing '/**'
+    everything inside and '/**/' zero or more directories
+    """
+    out = []
+    i = 0
+    n = len(glob)
+    while i < n:
+        c = glob[i]
+        if c == '*':
+            if glob.startswith('**', i) and (i == 0 or glob[i-1] == '/') and (i + 2 == n or glob[i+2] == '/'):
+                if i + 2 == n:
+                    out.append('.*')
+                    i += 2
+                else:
+                    out.append('(?:.*/)?')
+                    i += 3
+                continue
+            while i < n and glob[i] == '*':
+                i += 1
+            out.append('[^/]*')
+            continue
+        if c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            end = i + 1
+            if end < n and glob[end] in '!^':
+                end += 1
+            if end < n and glob[end] == ']':
+                end += 1
+            while end < n and glob[end] != ']':
+                end += 2 if glob[end] == '\\' else 1
+            if end >= n:
+                out.append(re.escape(c))  # No closing bracket: a plain '['
+            else:
+                body = glob[i+1:end]
+                negate = body[:1] in ('!', '^')
+                if negate:
+                    body = body[1:]
+                body = body.replace('\\', '\\\\').replace('[', '\\[')
+                out.append('[^/' + body + ']' if negate else '(?!/)[' + body + ']')
+                i = end
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            out.append(re.escape(glob[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+
+def pattern_parse(line):
+    """
+    Parse one line of an ignore file.
+    Return (glob, negated, dirOnly, anchored), or None for blank lines and comments
+    """
+    line = line.rstrip('\r')
+    # Trailing spaces are dropped unless escaped
+    while line.endswith(' ') and not line.endswith('\\ '):
+        line = line[:-1]
+    if not line or line.startswith('#'):
+        return None
+
+    negated = line.startswith('!')
+    if negated:
+        line = line[1:]
+    elif line.startswith('\\!') or line.startswith('\\#'):
+        line = line[1:]
+
+    dirOnly = line.endswith('/')
+    if dirOnly:
+        line = line.rstrip('/')
+    # A slash anywhere but at the end ties the pattern to the ignore file's directory
+    anchored = '/' in line
+    if line.startswith('/'):
+        line = line[1:]
+    if not line:
+        return None
+    return line, negated, dirOnly, anchored
+
+
+def has_glob(glob):
+    return any(c in glob for c in GLOB_CHARS)
+
+
+def rule_best(best, found):
+    # Rules are (line number, negated): of two matching rules the later line wins
+    if found is not None and (best is None or found[0] > best[0]):
+        return found
+    return best
+
+
+def rules_compile(regexes, flags):
+    """
+    Join (regex, rule) pairs into one regex of alternatives, last line first:
+    the first alternative to match is then the last matching line, which decides.
+    Return the regex and the rule of each group
+    """
+    regexes = regexes[::-1]
+    combined = '|'.join('(' + regex + ')' for regex, _ in regexes)
+    return re.compile(combined, flags | re.DOTALL), [rule for _, rule in regexes]
+
+
+def regex_match(compiled, string):
+    regex, rules = compiled
+    m = regex.fullmatch(string)
+    return None if m is None else rules[m.lastindex - 1]
+
+
+class GitIgnoreRules(object):
+    """
+    The patterns of an ignore file that apply to files, or to directories.
+    Patterns are sorted by shape so that most are found with a dict lookup:
+    only wildcard patterns that are not a plain prefix or suffix go through a regex.
+    """
+    def __init__(self):
+        self.names = {}
+        """Unanchored patterns without wildcards: name -> rule"""
+        self.suffixes = {}
+        """Unanchored '*<suffix>' patterns: suffix length -> {suffix: rule}"""
+        self.prefixes = {}
+        """Unanchored '<prefix>*' patterns: prefix length -> {prefix: rule}"""
+        self.nameGlobs = []
+        self.nameRegex = None
+        self.pathGlobs = {}
+        """Anchored patterns by their first path component, '' when it has wildcards"""
+        self.pathRegexes = {}
+
+    def add(self, glob, anchored, rule):
+        if anchored:
+            first = glob.split('/', 1)[0]
+            self.pathGlobs.setdefault('' if has_glob(first) else first, []).append((glob_translate(glob), rule))
+        elif not has_glob(glob):
+            self.names[glob] = rule
+        elif len(glob) > 1 and glob[0] == '*' and not has_glob(glob[1:]):
+            self.suffixes.setdefault(len(glob) - 1, {})[glob[1:]] = rule
+        elif len(glob) > 1 and glob[-1] == '*' and not has_glob(glob[:-1]):
+            self.prefixes.setdefault(len(glob) - 1, {})[glob[:-1]] = rule
+        else:
+            self.nameGlobs.append((glob_translate(glob), rule))
+
+    def compile(self, flags):
+        if self.nameGlobs:
+            self.nameRegex = rules_compile(self.nameGlobs, flags)
+        self.pathRegexes = {first: rules_compile(globs, flags) for first, globs in self.pathGlobs.items()}
+
+    def match(self, path, name):
+        """
+        Return the rule of the last line matching path, whose last component is name
+        """
+        best = self.names.get(name)
+        for length, suffixes in self.suffixes.items():
+            best = rule_best(best, suffixes.get(name[-length:]))
+        for length, prefixes in self.prefixes.items():
+            best = rule_best(best, prefixes.get(name[:length]))
+        if self.nameRegex is not None:
+            best = rule_best(best, regex_match(self.nameRegex, name))
+        if self.pathRegexes:
+            slash = path.find('/')
+            compiled = self.pathRegexes.get(path if slash < 0 else path[:slash])
+            if compiled is not None:
+                best = rule_best(best, regex_match(compiled, path))
+            compiled = self.pathRegexes.get('')
+            if compiled is not None:
+                best = rule_best(best, regex_match(compiled, path))
+        return best
+
+
+class GitIgnoreList(object):
+    def __init__(self, text, base='', ignoreCase=False):
+        self.base = base
+        """Directory of the ignore file relative to the worktree, '' or ending with '/'"""
+        self.ignoreCase = ignoreCase
+        self.fileRules = GitIgnoreRules()
+        self.dirRules = GitIgnoreRules()
+        for index, line in enumerate(text.split('\n')):
+            pattern = pattern_parse(line)
+            if pattern is None:
+                continue
+            glob, negated, dirOnly, anchored = pattern
+            if ignoreCase:
+                glob = glob.lower()
+            self.dirRules.add(glob, anchored, (index, negated))
+            if not dirOnly:
+                self.fileRules.add(glob, anchored, (index, negated))
+        flags = re.IGNORECASE if ignoreCase else 0
+        self.fileRules.compile(flags)
+        self.dirRules.compile(flags)
+
+    def match(self, path, isDir=False):
+        """
+        Match path, relative to the directory of the ignore file.
+        Return True if ignored, False if re-included by a negated pattern, None if no pattern matches
+        """
+        if self.ignoreCase:
+            path = path.lower()
+        rules = self.dirRules if isDir else self.fileRules
+        best = rules.match(path, path[path.rfind('/')+1:])
+        return None if best is None else not best[1]
+
+
+def ignore_file_read(path):
+    # (blob id, text) of an ignore file, the empty blob's and '' when there is none
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return EMPTY_BLOB_SHA, ''
+    sha = hashlib.sha1(b'blob %d\x00' % len(data) + data).digest()
+    return sha, data.decode("utf-8", "surrogateescape")
+
+
+class GitIgnore(object):
+    def __init__(self, repo):
+        self.repo = repo
+        self.ignoreCase = repo.conf.getboolean("core", "ignoreCase", fallback=False)
+        # Lowest precedence, after every .gitignore: info/exclude, then core.excludesFile
+        self.globalLists = []
+        excludesFile = repo.conf.get("core", "excludesFile", fallback=None)
+        for path in (repo.file("info", "exclude"), os.path.expanduser(excludesFile) if excludesFile else None):
+            if path is not None:
+                text = ignore_file_read(path)[1]
+                if text:
+                    self.globalLists.append(GitIgnoreList(text, '', self.ignoreCase))
+        self.dirFiles = {}
+        """Directory -> (blob id, text) of its .gitignore"""
+        self.chains = {}
+        """Directory -> the .gitignore lists that apply to it, deepest first"""
+
+    def dir_file(self, dir):
+        if dir not in self.dirFiles:
+            self.dirFiles[dir] = ignore_file_read(os.path.join(self.repo.worktree, dir, '.gitignore'))
+        return self.dirFiles[dir]
+
+    def dir_sha(self, dir):
+        """
+        Blob id of the .gitignore of dir ('' or ending with '/'), the empty blob's when there is none
+        """
+        return self.dir_file(dir)[0]
+
+    def chain(self, dir):
+        chain = self.chains.get(dir)
+        if chain is None:
+            chain = self.chain(dir[:dir.rfind('/', 0, -1)+1]) if dir else []
+            text = self.dir_file(dir)[1]
+            if text:
+                chain = [GitIgnoreList(text, dir, self.ignoreCase)] + chain
+            self.chains[dir] = chain
+        return chain
+
+    def is_ignored(self, path, isDir=False):
+        """
+        Whether path, relative to the worktree, is ignored. The nearest .gitignore
+        with a matching pattern decides, then info/exclude and core.excludesFile.
+        Directories are not checked: a walk must not descend into ignored ones,
+        as git does not re-include files under an excluded directory.
+        """
+        dir = path[:path.rfind('/')+1]
+        for ignoreList in self.chain(dir):
+            result = ignoreList.match(path[len(ignoreList.base):], isDir)
+            if result is not None:
+                return result
+        for ignoreList in self.globalLists:
+            result = ignoreList.match(path, isDir)
+            if result is not None:
+                return result
+        return False
@@ -2,16 +2,77 @@ import hashlib
 import struct
 import os
 import posixpath
-import re
-from pathlib import Path
 
 import collections
+import heapq
+import mmap
+from array import array
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 
 from libgitv.util.TextDecorator import TextDecorator
 from libgitv.GitObject import GitObject, object_hash
 from libgitv.GitRepository import GitRepository
-from libgitv.GitBlob import GitBlob
-import libgitv.util.StringHelpers as StringHelper
+from libgitv.GitCacheTree import GitCacheTree
+from libgitv.GitUntrackedCache import GitUntrackedCache, GitUntrackedDir, stat_data, NULL_SHA, NULL_STAT
+from libgitv.GitIgnore import GitIgnore
+from libgitv.GitFsmonitor import fsmonitor_mode, fsmonitor_query, fsmonitor_parse, fsmonitor_serialize
+from libgitv.util.Varint import varint_encode, varint_decode
+
+
+# ctime_s, ctime_n, mtime_s, mtime_n, dev, ino, mode, uid, gid, size, sha1, flags
+INDEX_ENTRY_FORMAT = '!LLLLLLLLLL20sH'
+INDEX_ENTRY_SIZE = 62
+INDEX_FLAG_EXTENDED = 0x4000
+
+
+def index_version(repo):
+    # index.version in .git/config, else version 2
+    return repo.conf.getint("index", "version", fallback=2)
+
+
+def common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def untracked_cache_enabled(repo):
+    # core.untrackedCache, on unless set to false
+    return repo.conf.get("core", "untrackedCache", fallback="true").lower() not in ("false", "no", "off", "0")
+
+
+def excludes_file_path(repo):
+    path = repo.conf.get("core", "excludesFile", fallback=None)
+    return os.path.expanduser(path) if path else None
+
+
+def exclude_file_info(path):
+    # (stat data, blob id) of an exclude file, as recorded by the untracked cache
+    if path is None or not os.path.isfile(path):
+        return NULL_STAT, NULL_SHA
+    with open(path, 'rb') as f:
+        return stat_data(os.fstat(f.fileno())), object_hash(f, bin=True)
+
+
+def hash_jobs(repo):
+    # core.hashWorkers in .git/config, else one worker per core
+    jobs = repo.conf.getint("core", "hashWorkers", fallback=0)
+    return jobs if jobs > 0 else (os.cpu_count() or 1)
+
+
+def parallel_map(func, items, jobs):
+    """
+    Apply func to every item on a pool of jobs threads.
+    Results come back in the order of items, whatever order the workers finish in.
+    hashlib and zlib release the GIL on large buffers, so hashing scales with cores.
+    """
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(jobs, len(items))) as pool:
+        return list(pool.map(func, items))
 
 
 class GitIndexEntry(object):
@@ -40,200 +101,646 @@ class GitIndexEntry(object):
     """The object's hash as a hex string"""
     flags = None
     """Length of the name if < 0xFFF (yes, three Fs), -1 otherwise"""
+    extended = 0
+    """Extended flags (index version 3 and up), present when flags has 0x4000 set"""
 
 
     def __init__(self, fields):
         self.ctime_s, self.ctime_n, self.mtime_s, self.mtime_n, self.dev, self.ino, self.mode, self.uid, self.gid, self.size, self.sha1, self.flags = fields
     
-    def create_from_file(repo, path):
+    def create_from_file(repo, path, write=False):
         # ctime_s, ctime_n, mtime_s, mtime_n, dev, ino, mode, uid, gid, size, sha1, flags, path
-        pathStat = os.stat(path)
+        fullPath = os.path.join(repo.worktree, path)
+        pathStat = os.stat(fullPath)
         dev = pathStat.st_dev * 0
         ino = pathStat.st_ino * 0
-        sha1 = object_hash(open(path, 'rb'), repo=repo, bin=True)
+        with open(fullPath, 'rb') as f:
+            sha1 = object_hash(f, repo=repo, bin=True, write=write)
         flags = len(path)
         if flags >= 0xFFF: flags = 0xFFF
-        fields = (int(pathStat.st_ctime), (pathStat.st_ctime_ns % 1000000000),
-            int(pathStat.st_mtime), (pathStat.st_mtime_ns % 1000000000), dev, ino,
-            pathStat.st_mode, pathStat.st_uid, pathStat.st_gid, pathStat.st_size, sha1, flags)
-        print(fields)
+        # Git only records regular files as 100644 or 100755
+        mode = 0o100755 if pathStat.st_mode & 0o100 else 0o100644
+        fields = (pathStat.st_ctime_ns // 1000000000, (pathStat.st_ctime_ns % 1000000000),
+            pathStat.st_mtime_ns // 1000000000, (pathStat.st_mtime_ns % 1000000000), dev, ino,
+            mode, pathStat.st_uid, pathStat.st_gid, pathStat.st_size & 0xFFFFFFFF, sha1, flags)
         objIndex = GitIndexEntry(fields)
         return objIndex
 
+    def stat_matches(entry, pathStat):
+        """
+        True when the file still has the stat data recorded in the entry,
+        in which case its content is trusted to be unchanged
+        """
+        return (entry.mtime_s == pathStat.st_mtime_ns // 1000000000
+            and entry.mtime_n == pathStat.st_mtime_ns % 1000000000
+            and entry.ctime_s == pathStat.st_ctime_ns // 1000000000
+            and entry.ctime_n == pathStat.st_ctime_ns % 1000000000
+            and entry.size == pathStat.st_size & 0xFFFFFFFF  # Index stores sizes truncated to 32 bits
+            and (entry.ino == 0 or entry.ino == pathStat.st_ino & 0xFFFFFFFF))
+
     def serialize(entry):
-        buff = struct.pack('!LLLLLLLLLL20sH', entry.ctime_s, entry.ctime_n, entry.mtime_s, entry.mtime_n, entry.dev, entry.ino, entry.mode, entry.uid, entry.gid, entry.size, entry.sha1, entry.flags)
+        buff = struct.pack(INDEX_ENTRY_FORMAT, entry.ctime_s, entry.ctime_n, entry.mtime_s, entry.mtime_n, entry.dev, entry.ino, entry.mode, entry.uid, entry.gid, entry.size, entry.sha1, entry.flags)
         return buff
 
+    def serialize_into(entry, buff, offset):
+        struct.pack_into(INDEX_ENTRY_FORMAT, buff, offset, entry.ctime_s, entry.ctime_n, entry.mtime_s, entry.mtime_n, entry.dev, entry.ino, entry.mode, entry.uid, entry.gid, entry.size, entry.sha1, entry.flags)
+
         
 
 
+class GitIndexEntries(MutableMapping):
+    """
+    Index entries by path, stored in columns instead of one object per entry:
+    the offset of every entry in the (mmap'd) index file and a path offset
+    table. GitIndexEntry objects are only materialized for the paths asked for.
+    Entries set or removed since the index was read are kept on the side.
+    """
+
+    def __init__(self, data=b'', version=2, count=0, start=12):
+        self.data = data
+        self.entryOffsets = array('Q')
+        self.pathStarts = array('Q')
+        self.pathLens = array('L')
+        self.pathData = data  # Where paths live: the index itself, or a blob for v4
+        self.loaded = {}  # path -> GitIndexEntry, materialized or set
+        self.added = set()  # Paths in loaded that are not in the index file
+        self.removed = set()  # Paths of the index file that were deleted
+        self.onChange = None  # Called with the path of every entry set or deleted
+        self.end = start
+        if count:
+            self.parse(version, count, start)
+
+    def parse(self, version, count, pos):
+        data = self.data
+        if version == 4:
+            blob = bytearray()
+            prevStart = prevLen = 0
+        for ctr in range(count):
+            self.entryOffsets.append(pos)
+            flags = (data[pos+60] << 8) | data[pos+61]
+            i = pos + INDEX_ENTRY_SIZE
+            if flags & INDEX_FLAG_EXTENDED:
+                assert version >= 3, 'Extended flags in index version {}'.format(version)
+                i += 2
+
+            if version == 4:
+                # Path is prefix-compressed: drop N bytes from the previous path, then append the suffix
+                i, strip = varint_decode(data, i)
+                path_end = data.find(b'\x00', i)
+                start = len(blob)
+                blob += blob[prevStart:prevStart+prevLen-strip]
+                blob += data[i:path_end]
+                prevStart, prevLen = start, len(blob) - start
+                self.pathStarts.append(prevStart)
+                self.pathLens.append(prevLen)
+                pos = path_end + 1
+            else:
+                path_end = data.find(b'\x00', i)
+                self.pathStarts.append(i)
+                self.pathLens.append(path_end - i)
+                # Entries are padded with 1-8 NUL bytes to a multiple of 8
+                pos += ((path_end - pos + 8) // 8) * 8
+            assert path_end >= 0, 'Truncated index entry'
+        if version == 4:
+            self.pathData = bytes(blob)
+        self.end = pos
+
+    def path_at(self, i):
+        start = self.pathStarts[i]
+        return self.pathData[start:start+self.pathLens[i]]
+
+    def entry_at(self, i):
+        offset = self.entryOffsets[i]
+        entry = GitIndexEntry(struct.unpack_from(INDEX_ENTRY_FORMAT, self.data, offset))
+        if entry.flags & INDEX_FLAG_EXTENDED:
+            entry.extended, = struct.unpack_from('!H', self.data, offset + INDEX_ENTRY_SIZE)
+        return entry
+
+    def lower_bound(self, pathBytes):
+        # Entries of the index file are sorted by path: binary search
+        lo, hi = 0, len(self.entryOffsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.path_at(mid) < pathBytes:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, pathBytes):
+        i = self.lower_bound(pathBytes)
+        if i < len(self.entryOffsets) and self.path_at(i) == pathBytes:
+            return i
+        return None
+
+    def paths_under(self, prefix):
+        """
+        Yield the paths starting with prefix (a directory ending with '/')
+        """
+        prefixBytes = prefix.encode("utf-8", "surrogateescape")
+        for i in range(self.lower_bound(prefixBytes), len(self.entryOffsets)):
+            pathBytes = self.path_at(i)
+            if not pathBytes.startswith(prefixBytes):
+                break
+            path = pathBytes.decode("utf-8", "surrogateescape")
+            if path not in self.removed:
+                yield path
+        yield from [path for path in self.added if path.startswith(prefix)]
+
+    def peek(self, path):
+        """
+        Like entries[path] but without keeping the materialized entry,
+        for read-only passes over many entries. Return None when missing.
+        """
+        if path in self.loaded:
+            return self.loaded[path]
+        if path in self.removed:
+            return None
+        i = self.find(path.encode("utf-8", "surrogateescape"))
+        return None if i is None else self.entry_at(i)
+
+    def __getitem__(self, path):
+        if path in self.loaded:
+            return self.loaded[path]
+        entry = self.peek(path)
+        if entry is None:
+            raise KeyError(path)
+        self.loaded[path] = entry  # Keep it, callers may modify it
+        return entry
+
+    def __setitem__(self, path, entry):
+        if path not in self.loaded and path not in self.removed and self.find(path.encode("utf-8", "surrogateescape")) is None:
+            self.added.add(path)
+        self.loaded[path] = entry
+        self.removed.discard(path)
+        if self.onChange is not None:
+            self.onChange(path)
+
+    def __delitem__(self, path):
+        if path not in self:
+            raise KeyError(path)
+        self.loaded.pop(path, None)
+        if path in self.added:
+            self.added.discard(path)
+        else:
+            self.removed.add(path)
+        if self.onChange is not None:
+            self.onChange(path)
+
+    def __contains__(self, path):
+        if path in self.loaded:
+            return True
+        if path in self.removed or not isinstance(path, str):
+            return False
+        return self.find(path.encode("utf-8", "surrogateescape")) is not None
+
+    def __iter__(self):
+        for i in range(len(self.entryOffsets)):
+            path = self.path_at(i).decode("utf-8", "surrogateescape")
+            if path not in self.removed:
+                yield path
+        yield from list(self.added)
+
+    def __len__(self):
+        return len(self.entryOffsets) - len(self.removed) + len(self.added)
+
+    def sorted_items(self):
+        """
+        Yield (path bytes, entry) in index order without keeping the entries
+        """
+        def base():
+            for i in range(len(self.entryOffsets)):
+                pathBytes = self.path_at(i)
+                path = pathBytes.decode("utf-8", "surrogateescape")
+                if path in self.removed:
+                    continue
+                yield pathBytes, self.loaded[path] if path in self.loaded else self.entry_at(i)
+        added = sorted((path.encode("utf-8", "surrogateescape"), self.loaded[path]) for path in self.added)
+        return heapq.merge(base(), added, key=lambda item: item[0])
+
+
 class GitIndex(GitObject):
     format = b'DIRC'
-    entries = collections.defaultdict(GitIndexEntry)
+    entries = None
+    version = 2
+    extensions = None
+    """Raw extension data read from the index, by signature"""
+    cacheTree = None
+    """GitCacheTree read from or to be written to the TREE extension"""
+    untrackedCache = None
+    """GitUntrackedCache read from or to be written to the UNTR extension"""
+    untrackedChanged = False
+    """Whether the untracked cache was updated and is worth writing back"""
+    fsmonitorToken = None
+    """Token of the filesystem monitor for the FSMN extension, None without one"""
+    fsmonitorDirty = None
+    """Paths of the entries the filesystem monitor cannot vouch for, None when unknown"""
+    fsmonitorChanged = False
+    """Whether a new fsmonitor token was obtained and is worth writing back"""
+    mtime_ns = None
+    """Modification time of the index file when it was read, for racy entry detection"""
+    hashed = None
+    """Path -> (hex sha compared, whether the file differs) for the entries getStatus hashed"""
+    jobs = 1
+    """Number of threads hashing files"""
     
     def read_index(repo):
         path = repo.file('index')
+        if not os.path.exists(path):
+            # No index yet (nothing was ever added): start from an empty one
+            objIndex = GitIndex(repo)
+            objIndex.entries = GitIndexEntries()
+            objIndex.entries.onChange = objIndex.path_changed
+            objIndex.version = index_version(repo)
+            objIndex.extensions = collections.OrderedDict()
+            objIndex.jobs = hash_jobs(repo)
+            return objIndex
+
         with open(path, 'rb') as f:
-            data = f.read()
+            if os.name == 'nt':
+                data = f.read()  # A mapped file could not be replaced by write_index
+            else:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
             # Verify hash
-            assert hashlib.sha1(data[:-20]).digest() == data[-20:], 'Invalid index checksum'
+            assert hashlib.sha1(memoryview(data)[:-20]).digest() == data[-20:], 'Invalid index checksum'
             # Read headers
             signature, version, num_entries = struct.unpack('!4sLL', data[:12])
             assert signature == b'DIRC', 'Invalid index signature {}'.format(signature)
-            assert version == 2, 'Unknown index version {}'. format(version)
-            data = data[12:-20]
-            entries = collections.defaultdict(GitIndexEntry)
-            i = 0
-            ctr = 0
-            while i + 62 < len(data) and ctr < num_entries:
-                fields_end = i + 62
-                path_end = data.find(b'\x00', fields_end)
-                fields = struct.unpack('!LLLLLLLLLL20sH', data[i:fields_end])
-                path = data[fields_end:path_end]
-                entry = GitIndexEntry(fields)
-                entries[str(path)[2:-1]] = entry
-                entry_len = ((62 + len(path) + 8) // 8) * 8
-                i += entry_len
-                ctr += 1
-            assert len(entries) == num_entries
-            # data[i:] are for Extensions
+            assert version in (2, 3, 4), 'Unknown index version {}'. format(version)
+            entries = GitIndexEntries(data, version, num_entries, 12)
+            i = entries.end
+
+            # data[i:-20] are for Extensions: 4-byte signature, 4-byte size, data
+            extensions = collections.OrderedDict()
+            while i < len(data) - 20:
+                extSignature, extSize = struct.unpack_from('!4sL', data, i)
+                # Extensions starting with a lowercase letter are required to understand the index
+                assert not (b'a' <= extSignature[:1] <= b'z'), 'Unsupported index extension {}'.format(extSignature)
+                extensions[extSignature] = data[i+8:i+8+extSize]
+                i += 8 + extSize
 
             objIndex = GitIndex(repo)
             objIndex.entries = entries
+            objIndex.version = version
+            objIndex.extensions = extensions
+            if b'TREE' in extensions:
+                objIndex.cacheTree = GitCacheTree.parse(extensions[b'TREE'])
+            if b'UNTR' in extensions and untracked_cache_enabled(repo):
+                objIndex.untrackedCache = GitUntrackedCache.parse(repo, extensions[b'UNTR'])
+            if b'FSMN' in extensions and fsmonitor_mode(repo) is not None:
+                token, positions = fsmonitor_parse(extensions[b'FSMN'])
+                objIndex.fsmonitorToken = token
+                objIndex.fsmonitorDirty = {entries.path_at(i).decode("utf-8", "surrogateescape") for i in positions if i < num_entries}
+            entries.onChange = objIndex.path_changed
+            objIndex.mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            objIndex.jobs = hash_jobs(repo)
             return objIndex
 
     def write_cache_tree(index):
-        dirs = {}
-        child_dirs = {}
-        for entry_path in index.entries:
-            curr_dir = '/'.join(entry_path.split('/')[:-1])
-            dirs[curr_dir] = 1 + (dirs[curr_dir] if curr_dir in dirs else 0)
-            if curr_dir not in child_dirs:  child_dirs[curr_dir] = set()
-            # Update parent directory counts
-            path_curr_dir = Path(curr_dir)
-            for dir in dirs:
-                if Path(dir) in path_curr_dir.parents:
-                    dirs[dir] += 1
-                if Path(dir) == path_curr_dir.parent:
-                    child_dirs[dir].add(curr_dir)
-        child_dirs[''].remove('')
-
-        buff = b'TREE'
-        for dir in dirs:
-            if dir == '':  dir_path = b'\x00\x00\x00'
-            else: 
-                dir_path = Path(os.path.relpath(dir, index.repo.worktree)).parts[-1]
-            buff += StringHelper.toBytes(dir_path) + b'\x00'
-            buff += StringHelper.toBytes('%d %d\n' % (dirs[dir], len(child_dirs[dir])))
-            # TODO: Print object-id of tree node
-            # print(buff)
-        return buff
+        # TREE extension data, or None when there is no cache-tree to write
+        if index.cacheTree is None:
+            return None
+        return index.cacheTree.serialize()
+
+    def write_tree(index):
+        """
+        Write the tree objects of the index and return the root tree id.
+        Only directories invalidated since the cache-tree was computed are rebuilt.
+        """
+        if index.cacheTree is None:
+            index.cacheTree = GitCacheTree()
+        if index.cacheTree.valid():
+            return index.cacheTree.sha
+        return index.cacheTree.update(index.repo, list(index.entries.sorted_items()))
+
+    def path_changed(index, path):
+        # Called by the entries on every add/replace/remove
+        pathBytes = path.encode("utf-8", "surrogateescape")
+        if index.cacheTree is not None:
+            index.cacheTree.invalidate(pathBytes)
+        if index.untrackedCache is not None:
+            index.untrackedCache.invalidate(pathBytes)
+            index.untrackedChanged = True
 
     def write_index(index):
+        """
+        Serialize the index into a single buffer sized up front, then
+        write it to index.lock and rename it over the index.
+        """
+        version = index.version
+        dirty = set()
+        if index.fsmonitorDirty is not None:
+            dirty = {path.encode("utf-8", "surrogateescape") for path in index.fsmonitorDirty}
+        dirtyPositions = []
+        racy = []
+
+        # First pass: size every entry
+        sizes = array('L')
+        prevPath = b''
+        total = 12
+        for pathBytes, entry in index.entries.sorted_items():
+            if pathBytes in dirty:
+                dirtyPositions.append(len(sizes))
+            if index.mtime_ns is not None and entry.size and index.is_racy(entry):
+                racy.append((pathBytes, entry))
+            fixed = INDEX_ENTRY_SIZE + (2 if entry.flags & INDEX_FLAG_EXTENDED else 0)
+            if fixed > INDEX_ENTRY_SIZE and version < 3:
+                version = 3  # Extended flags need version 3
+            if version == 4:
+                common = common_prefix_len(prevPath, pathBytes)
+                size = fixed + len(varint_encode(len(prevPath) - common)) + len(pathBytes) - common + 1
+                prevPath = pathBytes
+            else:
+                size = ((fixed + len(pathBytes) + 8) // 8) * 8
+            sizes.append(size)
+            total += size
+
+        smudged = index.racy_smudged(racy)
+
+        # Extensions must follow the entries they describe; stale ones are dropped
+        extensions = index.extensions_serialize(dirtyPositions)
+        total += sum(8 + len(ext) for ext in extensions.values()) + 20
+
+        # Second pass: pack everything into the one buffer (zero-filled, so padding is free)
+        buff = bytearray(total)
+        struct.pack_into('!4sLL', buff, 0, index.format, version, len(sizes))
+        i = 12
+        prevPath = b''
+        for (pathBytes, entry), size in zip(index.entries.sorted_items(), sizes):
+            entry.flags = (entry.flags & 0xF000) | min(len(pathBytes), 0xFFF)
+            if pathBytes in smudged:
+                entry.size = 0
+            entry.serialize_into(buff, i)
+            pos = i + INDEX_ENTRY_SIZE
+            if entry.flags & INDEX_FLAG_EXTENDED:
+                struct.pack_into('!H', buff, pos, entry.extended)
+                pos += 2
+            if version == 4:
+                common = common_prefix_len(prevPath, pathBytes)
+                strip = varint_encode(len(prevPath) - common)
+                buff[pos:pos+len(strip)] = strip
+                pos += len(strip)
+                buff[pos:pos+len(pathBytes)-common] = pathBytes[common:]
+                prevPath = pathBytes
+            else:
+                buff[pos:pos+len(pathBytes)] = pathBytes
+            i += size
+
+        for extSignature, ext in extensions.items():
+            struct.pack_into('!4sL', buff, i, extSignature, len(ext))
+            buff[i+8:i+8+len(ext)] = ext
+            i += 8 + len(ext)
+
+        # Write hash digest of index
+        buff[i:i+20] = hashlib.sha1(memoryview(buff)[:i]).digest()
+
         path = index.repo.file('index')
-        with open(path, 'rb') as f:
-            # Write header: signature, version, num_entries
-            buff = struct.pack('!4sLL', index.format, 2, len(index.entries))
-
-            # For each index entry: write index entry
-            for entry_path in index.entries:
-                buff += index.entries[entry_path].serialize() + StringHelper.toBytes(entry_path) + b'\x00'
-            
-            buff += index.write_cache_tree()
-
-            # Write hash digest of index
-            sha1 = hashlib.sha1(buff).digest()
-            buff += sha1
-            # print(buff)
-            # f.write(buff)
-
-
-    def getIgnoreList(index):
-        fIgnore = os.path.join(index.repo.gitdir, '../.gitignore')
-        if not os.path.exists(fIgnore):
-            return []
-        liIgnore = []
-        for ignPattern in open(fIgnore, 'r'):
-            if ignPattern == '\n':
+        lockPath = path + '.lock'
+        # O_EXCL: fail rather than race with another process writing the index
+        fd = os.open(lockPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(buff)
+            os.replace(lockPath, path)
+        except BaseException:
+            os.remove(lockPath)
+            raise
+        index.version = version
+        index.mtime_ns = os.stat(path).st_mtime_ns
+
+    def racy_smudged(index, racy):
+        """
+        Return the paths of the racily clean entries among racy, (path bytes, entry)
+        pairs: those whose stat data still matches but whose content changed.
+        Once the index is written with a newer mtime they would no longer look racy,
+        so their size is written as 0 to have them hashed again, as git does.
+        """
+        hashed = index.hashed or {}
+        toHash = []
+        smudged = set()
+        for pathBytes, entry in racy:
+            path = pathBytes.decode("utf-8", "surrogateescape")
+            fullPath = os.path.join(index.repo.worktree, path)
+            try:
+                if not entry.stat_matches(os.stat(fullPath)):
+                    continue  # Stat data that differs already sends it to be hashed
+            except (FileNotFoundError, NotADirectoryError):
                 continue
-            bIgnore = not ignPattern.startswith('!')
-            if not bIgnore:
-                ignPattern = ignPattern.replace('!', '', 1)
-            # TODO: Support more complex gitignore patterns
-            ignPattern = ignPattern.replace('.', '\.').replace('*', '.*').replace('\n', '')
-            ignRegex = re.compile(ignPattern)
-            liIgnore.append((ignRegex, bIgnore))
-        return liIgnore
-
-
-    def getChangedFiles(index, targetPath=None):
-        repoRoot = os.path.abspath(os.path.join(index.repo.gitdir, '..'))  # Obtain repo's root path
-        if targetPath is None:
-            targetPath = repoRoot
-        toVisit = []
-        if os.path.isfile(targetPath):
-            toVisit.append(targetPath)
-        elif os.path.isdir(targetPath):
-            for root, dirs, files in os.walk(targetPath, topdown=True):
-                if '.git' in root:
-                    continue
-                files.sort()
-                for tmpF in files:
-                    path = os.path.join(root, tmpF)
-                    path = os.path.relpath(path, repoRoot)
-                    path = path.replace(os.sep, posixpath.sep)
-                    toVisit.append(path)
-
-        # Filter down list using gitignore
-        liIgnore = index.getIgnoreList()
-        liIgnore.reverse()
-        i = len(toVisit)-1
-        while i >= 0:
-            for reIgnore in liIgnore:
-                if reIgnore[0].match(toVisit[i]):
-                    if reIgnore[1]:
-                        toVisit.pop(i)
-                    break
-
-            i -= 1
-        return toVisit
+            known = hashed.get(path)
+            if known is not None and known[0] == entry.sha1.hex():
+                if known[1]:
+                    smudged.add(pathBytes)  # Already hashed by getStatus
+                continue
+            toHash.append((pathBytes, fullPath, entry.sha1.hex()))
+        changed = parallel_map(lambda job: index.is_modified(job[1], job[2]), toHash, index.jobs)
+        smudged.update(pathBytes for (pathBytes, _, _), isModified in zip(toHash, changed) if isModified)
+        return smudged
+
+    def extensions_serialize(index, dirtyPositions=()):
+        # Other cached data about the old entries would be stale once they change
+        extensions = collections.OrderedDict()
+        cacheTree = index.write_cache_tree()
+        if cacheTree is not None:
+            extensions[b'TREE'] = cacheTree
+        if index.untrackedCache is not None:
+            extensions[b'UNTR'] = index.untrackedCache.serialize()
+        if index.fsmonitorToken is not None and index.fsmonitorDirty is not None:
+            extensions[b'FSMN'] = fsmonitor_serialize(index.fsmonitorToken, dirtyPositions)
+        return extensions
+
+    def fsmonitor_changes(index):
+        """
+        Ask the filesystem monitor what changed since the token of the index.
+        Return the changed paths (directories ending with '/') plus the entries
+        already known dirty, or None when everything must be examined
+        """
+        result = fsmonitor_query(index.repo, index.fsmonitorToken)
+        if result is None:
+            if index.fsmonitorToken is not None:
+                index.fsmonitorToken = index.fsmonitorDirty = None  # Drop the FSMN extension
+                index.fsmonitorChanged = True
+            return None
+        token, changed = result
+        known = index.fsmonitorDirty
+        index.fsmonitorToken = token
+        index.fsmonitorChanged = True
+        if changed is None or known is None:
+            return None
+        return known.union(changed)
+
+
+    def getUntrackedFiles(index, changes=None):
+        """
+        Walk the worktree for files that are neither in the index nor ignored.
+        Directories whose stat data and .gitignore did not change since the
+        untracked cache recorded them are not read again, and ignored
+        directories are not descended into. When the filesystem monitor
+        reported changes, directories without any are not even stat'ed.
+        """
+        ignore = GitIgnore(index.repo)
+        dirtyDirs = None
+        if changes is not None:
+            dirtyDirs = set()
+            for path in changes:
+                path = path.rstrip('/')
+                dirtyDirs.add(path[:path.rfind('/')+1])
+                dirtyDirs.add(path + '/')  # In case path is a directory
+
+        cache = index.untrackedCache
+        if cache is None:
+            cache = GitUntrackedCache(index.repo)
+        cache.check_excludes(*exclude_file_info(index.repo.file("info", "exclude")),
+            *exclude_file_info(excludes_file_path(index.repo)))
+
+        untracked = []
+        toVisit = [(cache.root, '', False)]
+        while toVisit:
+            node, rel, force = toVisit.pop()
+            # With the filesystem monitor, directories it saw no change in are trusted without a stat
+            if dirtyDirs is None or force or not node.valid or rel in dirtyDirs:
+                force = index.untracked_dir_refresh(node, rel, force, ignore)
+
+            untracked.extend(rel + os.fsdecode(name) for name in node.untracked)
+            for name in reversed(sorted(node.children)):
+                toVisit.append((node.children[name], rel + os.fsdecode(name) + '/', force))
+
+        if untracked_cache_enabled(index.repo):
+            index.untrackedCache = cache
+        return untracked
+
+    def untracked_dir_refresh(index, node, rel, force, ignore):
+        """
+        Read the directory rel again unless its stat data and .gitignore show
+        the untracked cache node still holds. Return whether its subdirectories must be read again too
+        """
+        absDir = os.path.join(index.repo.worktree, rel)
+        try:
+            dirStat = os.stat(absDir)
+        except OSError:
+            # Gone meanwhile
+            node.untracked, node.children, node.valid = [], {}, False
+            index.untrackedChanged = True
+            return force
+        sha = ignore.dir_sha(rel)
+        if sha != node.sha:
+            force = True  # Rules changed: nothing below can be trusted either
+
+        if (force or not node.valid or node.stat != stat_data(dirStat)
+                or index.mtime_ns is None or dirStat.st_mtime_ns >= index.mtime_ns):
+            names = []
+            children = {}
+            with os.scandir(absDir) as it:
+                for dirEntry in sorted(it, key=lambda e: e.name):
+                    if dirEntry.name == '.git':
+                        continue
+                    path = rel + dirEntry.name
+                    name = os.fsencode(dirEntry.name)
+                    if dirEntry.is_dir(follow_symlinks=False):
+                        if ignore.is_ignored(path, True):
+                            continue
+                        children[name] = node.children.get(name) or GitUntrackedDir(name)
+                    elif path not in index.entries and not ignore.is_ignored(path):
+                        names.append(name)
+            node.untracked, node.children = names, children
+            node.valid, node.stat, node.sha = True, stat_data(dirStat), sha
+            index.untrackedChanged = True
+        return force
     
     
-    def getStatus(index, targetPath=None):
-        toVisit = index.getChangedFiles(targetPath)  # type: list
+    def is_racy(index, entry):
+        # A file modified in the same timestamp granule the index was written in
+        # may have changed after it was hashed without its stat data showing it
+        if index.mtime_ns is None:
+            return True
+        return entry.mtime_s * 1000000000 + entry.mtime_n >= index.mtime_ns
+
+    def is_modified(index, fullPath, sha1Index):
+        with open(fullPath, 'rb') as f:
+            sha1Visit = object_hash(f, repo=index.repo)
+            if sha1Index != sha1Visit:
+                f.seek(0)
+                sha1Visit = object_hash(f, repo=index.repo, lf_ending=True)
+        return sha1Index != sha1Visit
 
-        liIndex = index.entries  # type: dict
+    def getStatus(index, targetPath=None):
+        target = None
+        if targetPath is not None:
+            target = os.path.relpath(os.path.abspath(targetPath), index.repo.worktree).replace(os.sep, posixpath.sep)
+            if target == '.':
+                target = None
+
+        def inTarget(path):
+            return target is None or path == target or path.startswith(target + '/')
+
+        liIndex = index.entries
+        changes = index.fsmonitor_changes()
+        if changes is None:
+            paths = liIndex
+        else:
+            # Only the entries the filesystem monitor reports changed need a look
+            paths = set()
+            for path in changes:
+                if path in liIndex:
+                    paths.add(path)
+                paths.update(liIndex.paths_under(path if path.endswith('/') else path + '/'))
+            paths = sorted(paths)
 
         modified = []
-        added = []
-
-        for path in toVisit:
-            if path in liIndex:
-                sha1Index = liIndex[path].sha1.hex()
-                sha1Visit = object_hash(open(path, 'rb'), repo=index.repo)
-                if (sha1Index != sha1Visit) and (sha1Index != (object_hash(open(path, 'rb'), repo=index.repo, lf_ending=True))):
-                    modified.append((path, 'm'))
-            else:
-                added.append(path)
-        
-        for path in liIndex.keys():
-            if path not in toVisit:
+        toHash = []
+        skipped = set()
+
+        for path in paths:
+            if not inTarget(path):
+                if changes is not None:
+                    skipped.add(path)
+                continue
+            entry = liIndex.peek(path)
+            fullPath = os.path.join(index.repo.worktree, path)
+            try:
+                pathStat = os.stat(fullPath)
+            except (FileNotFoundError, NotADirectoryError):
                 modified.append((path, 'd'))
-            
+                continue
+            # Stat-cache fast path: matching stat data means unchanged content
+            if entry.stat_matches(pathStat) and not index.is_racy(entry):
+                continue
+            toHash.append((path, fullPath, entry.sha1.hex()))
+
+        # Hash the remaining candidates in parallel, results in path order
+        changed = parallel_map(lambda job: index.is_modified(job[1], job[2]), toHash, index.jobs)
+        index.hashed = {}
+        for (path, _, sha), isModified in zip(toHash, changed):
+            index.hashed[path] = (sha, isModified)
+            if isModified:
+                modified.append((path, 'm'))
+
+        if index.fsmonitorToken is not None:
+            if changes is None and target is not None:
+                index.fsmonitorDirty = None  # Entries outside target were not examined
+            else:
+                index.fsmonitorDirty = skipped.union(path for path, _ in modified)
+
+        added = [path for path in index.getUntrackedFiles(changes) if inTarget(path)]
         return modified, added
 
 
 def cmd_ls_files(args):
     repo = GitRepository.repo_find()
     objIndex = GitIndex.read_index(repo)
-    for entry in objIndex.entries:
-        print(entry.path)
+    for entry_path in objIndex.entries:
+        print(entry_path)
 
 
 def cmd_status(args):
     repo = GitRepository.repo_find()
     objIndex = GitIndex.read_index(repo)
     modified, added = objIndex.getStatus(args.path)
+    if objIndex.untrackedChanged or objIndex.fsmonitorChanged:
+        # Save the untracked cache and fsmonitor token for the next status, unless someone else holds the index
+        try:
+            objIndex.write_index()
+        except FileExistsError:
+            pass
 
     if len(modified) > 0:
         print('Changes not staged for commit:')
@@ -257,22 +764,29 @@ def cmd_add(args):
     modified, added = objIndex.getStatus(args.path)
     entries = objIndex.entries
     
+    toWrite = []
     for i in modified:
         path = i[0]
         if i[1] == 'm':
-            objBlob = GitBlob.create(repo, open(path, 'rb').read())
-            sha1 = objBlob.object_write(True, bin=True)
-            entries[path].sha1 = sha1
+            toWrite.append(path)
         elif i[1] == 'd':
             #delete the index
             entries.pop(path)
-    for path in added:
-        objBlob = GitBlob.create(repo, open(path, 'rb').read())
-        sha1 = objBlob.object_write(True, bin=True)
-        entries[path] = GitIndexEntry.create_from_file(repo, path)
-        entries[path].sha1 = sha1
+    toWrite += added
+
+    # Stream the files into blobs in parallel, also refreshing their stat data for the stat cache
+    newEntries = parallel_map(lambda path: GitIndexEntry.create_from_file(repo, path, write=True), toWrite, objIndex.jobs)
+    for path, entry in zip(toWrite, newEntries):
+        entries[path] = entry
 
     print('Updating')
     # Write updated index into index file 
     objIndex.write_index()
-    
\ No newline at end of file
+
+
+def cmd_write_tree(args):
+    repo = GitRepository.repo_find()
+    objIndex = GitIndex.read_index(repo)
+    print(objIndex.write_tree())
+    # Keep the computed tree ids for the next write-tree/commit
+    objIndex.write_index()
@@ -0,0 +1,187 @@
+#This file is the merge-base command and the ancestry queries.
+#Both paint commits down from the tips, highest generation first. Generation
+#numbers come from the commit-graph, and are computed for commits newer than it:
+#a commit with a generation below the target's cannot reach it, so the walks
+#stop there instead of exploring every ancestor.
+import heapq
+import itertools
+import sys
+
+from libgitv.GitRepository import GitRepository
+from libgitv.GitObject import GitObject
+from libgitv.GitCommitGraph import GENERATION_INFINITY, GENERATION_MAX
+from libgitv.GitRevWalk import GitRevWalk
+
+
+# Paint flags
+PARENT1 = 1
+PARENT2 = 2
+STALE = 4
+RESULT = 8
+
+
+class GitAncestry(object):
+    """
+    Ancestry queries on one repository. Commits read are kept, so
+    repeated queries through the same instance only read each commit once.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.walker = GitRevWalk(repo)
+        self.infos = {}
+        """sha -> [parent SHAs, generation, commit date]"""
+
+    def info(self, sha):
+        info = self.infos.get(sha)
+        if info is None:
+            info = self.infos[sha] = list(self.walker.commit_info(sha))
+        return info
+
+    def generation(self, sha):
+        """
+        Generation of a commit: from the commit-graph, or one more than its
+        highest parent's for commits newer than the graph. Without a commit-graph
+        it is GENERATION_INFINITY, and walks are ordered by date only.
+        """
+        info = self.info(sha)
+        if info[1] != GENERATION_INFINITY or self.walker.graph is None:
+            return info[1]
+        toVisit = [sha]
+        while toVisit:
+            info = self.info(toVisit[-1])
+            if info[1] != GENERATION_INFINITY:
+                toVisit.pop()
+                continue
+            missing = [p for p in info[0] if self.info(p)[1] == GENERATION_INFINITY]
+            if missing:
+                toVisit.extend(missing)
+                continue
+            toVisit.pop()
+            info[1] = min(GENERATION_MAX, 1 + max((self.infos[p][1] for p in info[0]), default=0))
+        return self.infos[sha][1]
+
+    def paint_down(self, one, twos, minGeneration=0):
+        """
+        Paint the ancestors of one with PARENT1 and those of twos with PARENT2,
+        highest generation then newest first, until only commits painted
+        with both (and their ancestors, STALE) are left.
+        Return (the commits painted with both first, flags)
+        """
+        flags = {one: PARENT1}
+        for two in twos:
+            flags[two] = flags.get(two, 0) | PARENT2
+        queue = []
+        queued = set()
+        active = set()  # Queued commits that are not STALE: the walk ends without any
+        counter = itertools.count()
+
+        def push(sha):
+            info = self.info(sha)
+            heapq.heappush(queue, (-self.generation(sha), -info[2], next(counter), sha))
+            queued.add(sha)
+            if not flags[sha] & STALE:
+                active.add(sha)
+
+        for sha in flags:
+            push(sha)
+
+        result = []
+        while active:
+            negGeneration, _, _, sha = heapq.heappop(queue)
+            queued.discard(sha)
+            active.discard(sha)
+            if -negGeneration < minGeneration:
+                break
+            paint = flags[sha] & (PARENT1 | PARENT2 | STALE)
+            if paint == PARENT1 | PARENT2:
+                if not flags[sha] & RESULT:
+                    flags[sha] |= RESULT
+                    result.append(sha)
+                paint |= STALE
+            for parent in self.info(sha)[0]:
+                if flags.get(parent, 0) & paint == paint:
+                    continue
+                flags[parent] = flags.get(parent, 0) | paint
+                if parent not in queued:
+                    push(parent)
+                elif paint & STALE:
+                    active.discard(parent)
+
+        # Commits found to be ancestors of other results are not results
+        result = [sha for sha in result if not flags[sha] & STALE]
+        result.sort(key=lambda sha: -self.info(sha)[2])
+        return result, flags
+
+    def remove_redundant(self, commits):
+        # Drop the commits that are ancestors of another one
+        redundant = set()
+        minGeneration = min(self.generation(sha) for sha in commits)
+        for sha in commits:
+            if sha in redundant:
+                continue
+            others = [other for other in commits if other != sha and other not in redundant]
+            _, flags = self.paint_down(sha, others, minGeneration)
+            if flags[sha] & PARENT2:
+                redundant.add(sha)
+            redundant.update(other for other in others if flags[other] & PARENT1)
+        return [sha for sha in commits if sha not in redundant]
+
+    def merge_bases(self, one, twos):
+        """
+        Return the best common ancestors of one and of a merge of twos, newest first
+        """
+        if one in twos:
+            return [one]
+        result = self.paint_down(one, twos)[0]
+        if len(result) <= 1:
+            return result
+        return self.remove_redundant(result)
+
+    def is_ancestor(self, ancestor, sha):
+        """
+        Whether ancestor is reachable from sha (a commit is its own ancestor).
+        Commits whose generation is not above the ancestor's cannot reach it,
+        so they are not walked.
+        """
+        if ancestor == sha:
+            return True
+        target = self.generation(ancestor)
+        if target == GENERATION_INFINITY:
+            target = 0  # No generation numbers: nothing can be pruned
+        elif self.generation(sha) <= target:
+            return False
+        seen = {sha}
+        toVisit = [sha]
+        while toVisit:
+            for parent in self.info(toVisit.pop())[0]:
+                if parent == ancestor:
+                    return True
+                if parent in seen or self.generation(parent) <= target:
+                    continue
+                seen.add(parent)
+                toVisit.append(parent)
+        return False
+
+
+def merge_bases(repo, one, twos):
+    return GitAncestry(repo).merge_bases(one, twos)
+
+
+def is_ancestor(repo, ancestor, sha):
+    return GitAncestry(repo).is_ancestor(ancestor, sha)
+
+
+def cmd_merge_base(args):
+    repo = GitRepository.repo_find()
+    commits = [GitObject.object_find(repo, name, b'commit') for name in args.commits]
+    if args.is_ancestor:
+        if len(commits) != 2:
+            raise Exception("--is-ancestor takes exactly two commits")
+        sys.exit(0 if is_ancestor(repo, commits[0], commits[1]) else 1)
+    if len(commits) < 2:
+        raise Exception("merge-base needs at least two commits")
+    bases = merge_bases(repo, commits[0], commits[1:])
+    if not bases:
+        sys.exit(1)
+    for sha in bases if args.all else bases[:1]:
+        print(sha)
@@ -1,14 +1,16 @@
 #This file is the GitObject class.
 #To initialize a GitObject, it needs the repo info and also other data
 #Two important functions - serialize() and deserialize()
-from datetime import datetime
 import zlib
 import os
 import re
 import sys
 import hashlib  # SHA-1 function used extensively by Git
+import tempfile
 
 from libgitv.GitRepository import GitRepository
+from libgitv.GitPack import pack_read, pack_info, pack_stream
+from libgitv.GitAbbrev import abbrev, abbrev_resolve
 
 def ref_resolve():
     pass
@@ -17,6 +19,12 @@ def ref_resolve():
 # to filled after the superclass declaration
 GIT_OBJECT_CONSTRUCTORS = {}
 
+# Size of the chunks read when streaming a file into a blob
+STREAM_CHUNK = 1024 * 1024
+
+# Longest loose object header: "commit " + 20 digits + NULL terminator
+LOOSE_HEADER_MAX = 32
+
 class GitObject:
     repo = None
 
@@ -41,10 +49,115 @@ class GitObject:
     def object_read(repo,sha): #sha is the way the path is hashed
         """
         Read object from Git repo
-        Return a GitObject
+        Return a GitObject, shared with every other reader through the repo's object cache
         """
+        obj = repo.objectCache.get(sha)
+        if obj is not None:
+            return obj
+
+        fmt, data = GitObject.object_read_raw(repo, sha)
+
+        #pick constructor
+        if fmt in GIT_OBJECT_CONSTRUCTORS:
+            c=GIT_OBJECT_CONSTRUCTORS[fmt]
+        else:
+            raise Exception("Unknow type {0} for object {1}".format(fmt.decode("ascii"),sha))
 
+        obj = c(repo,data) #return the content
+        repo.objectCache.put(sha, obj, len(data))
+        return obj
+
+    def object_read_raw(repo, sha):
+        """
+        Read the type and content of an object, looking at loose objects
+        first and falling back to the packs.
+        Return (format, data)
+        """
         path = repo.file("objects", sha[:2],sha[2:])
+        if path and os.path.exists(path):
+            return GitObject.object_read_loose(path, sha)
+
+        ret = pack_read(repo, sha, lambda base: GitObject.object_read_raw(repo, base))
+        if ret is None:
+            raise Exception("Object {0} not found".format(sha))
+        return ret
+
+    def object_info(repo, sha):
+        """
+        Return (format, size) of an object without inflating its content:
+        only the header of a loose object or the entry header of a pack is read.
+        """
+        path = repo.file("objects", sha[:2],sha[2:])
+        if path and os.path.exists(path):
+            return GitObject.object_info_loose(path, sha)
+
+        ret = pack_info(repo, sha, lambda base: GitObject.object_info(repo, base))
+        if ret is None:
+            raise Exception("Object {0} not found".format(sha))
+        return ret
+
+    def object_info_loose(path, sha):
+        d = zlib.decompressobj()
+        header = b''
+        with open(path, 'rb') as f:
+            # The header ("<type> <size>\x00") is at most a few dozen bytes
+            while b'\x00' not in header and not d.eof:
+                chunk = f.read(64)
+                if not chunk:
+                    break
+                header += d.decompress(chunk, LOOSE_HEADER_MAX - len(header))
+                if len(header) >= LOOSE_HEADER_MAX:
+                    break
+
+        sizeIdx = header.find(b'\x00')
+        objectTypeIdx = header.find(b' ')
+        if sizeIdx < 0 or objectTypeIdx < 0:
+            raise Exception("Malformed object {0}: bad header".format(sha))
+        return header[0:objectTypeIdx], int(header[objectTypeIdx+1:sizeIdx].decode("ascii"))
+
+    def object_stream(repo, sha):
+        """
+        Open an object for streaming.
+        Return (format, size, chunks) where chunks yields the decompressed
+        content, checks it against the size header as it goes and verifies
+        the SHA once the last chunk has been read.
+        """
+        path = repo.file("objects", sha[:2],sha[2:])
+        if path and os.path.exists(path):
+            fmt, size, chunks = GitObject.object_stream_loose(path, sha)
+        else:
+            ret = pack_stream(repo, sha, STREAM_CHUNK, lambda base: GitObject.object_read_raw(repo, base))
+            if ret is None:
+                raise Exception("Object {0} not found".format(sha))
+            fmt, size, chunks = ret
+        return fmt, size, object_stream_verify(sha, fmt, size, chunks)
+
+    def object_stream_loose(path, sha):
+        f = open(path, 'rb')
+        chunks = inflate_file(f)
+
+        # Inflate up to the end of the header, keeping what follows it
+        header = b''
+        for chunk in chunks:
+            header += chunk
+            if b'\x00' in header or len(header) >= LOOSE_HEADER_MAX:
+                break
+        sizeIdx = header.find(b'\x00')
+        objectTypeIdx = header.find(b' ')
+        if sizeIdx < 0 or objectTypeIdx < 0 or objectTypeIdx > sizeIdx:
+            f.close()
+            raise Exception("Malformed object {0}: bad header".format(sha))
+        fmt = header[0:objectTypeIdx]
+        size = int(header[objectTypeIdx+1:sizeIdx].decode("ascii"))
+
+        def content():
+            with f:
+                if len(header) > sizeIdx+1:
+                    yield header[sizeIdx+1:]
+                yield from chunks
+        return fmt, size, content()
+
+    def object_read_loose(path, sha):
         with open(path, 'rb') as f:
             #first get the raw data from depressing the file
             raw = zlib.decompress(f.read()) #type(raw) is String
@@ -58,14 +171,8 @@ class GitObject:
             size = int(raw[objectTypeIdx:sizeIdx].decode("ascii"))
             if size != len(raw)-sizeIdx-1:
                 raise Exception("Malformed object {0}: bad length".format(sha))
-            
-            #pick constructor
-            if fmt in GIT_OBJECT_CONSTRUCTORS:
-                c=GIT_OBJECT_CONSTRUCTORS[fmt]
-            else:
-                raise Exception("Unknow type {0} for object {1}".format(fmt.decode("ascii"),sha))
-            
-            return c(repo,raw[sizeIdx+1:]) #return the content
+
+            return fmt, raw[sizeIdx+1:]
 
         
     def object_write(obj, written = True, bin=False):
@@ -94,13 +201,7 @@ class GitObject:
         if hashRE.match(name):
             if len(name) == 40:
                 return [name.lower()]  # A complete hash
-            prefix = name.lower()[0:2]
-            path = repo.dir('objects', prefix, mkdir=False)
-            if path:
-                rem = name[2:]
-                for f in os.listdir(path):
-                    if f.startswith(rem):
-                        candidates.append(prefix + f)
+            candidates = abbrev_resolve(repo, name)
         
         # Resolve reference names
         if len(candidates) == 0:
@@ -129,22 +230,55 @@ class GitObject:
             return sha
 
         while True:
-            obj = GitObject.object_read(repo, sha)
+            # Only the header is needed to know whether we are done
+            fmt, _ = GitObject.object_info(repo, sha)
 
-            if obj.format == format:
+            if fmt == format:
                 return sha
 
             if not follow:
                 return None
 
             # Follow tags
-            if obj.format == b'tag':
-                sha = obj.kvlm[b'object'].decode("ascii")
-            elif obj.format == b'commit' and format == b'tree':
-                sha = obj.kvlm[b'tree'].decode("ascii")
+            if fmt == b'tag':
+                sha = GitObject.object_read(repo, sha).kvlm[b'object'].decode("ascii")
+            elif fmt == b'commit' and format == b'tree':
+                sha = GitObject.object_read(repo, sha).kvlm[b'tree'].decode("ascii")
             else:
                 return None
 
+def inflate_file(f):
+    # Yield the decompressed content of f, STREAM_CHUNK bytes at most at a time
+    d = zlib.decompressobj()
+    while not d.eof:
+        data = d.unconsumed_tail or f.read(STREAM_CHUNK)
+        if not data:
+            rest = d.flush()
+            if rest:
+                yield rest
+            if not d.eof:
+                raise Exception("Truncated object {0}".format(f.name))
+            return
+        out = d.decompress(data, STREAM_CHUNK)
+        if out:
+            yield out
+
+
+def object_stream_verify(sha, fmt, size, chunks):
+    objHash = hashlib.sha1(fmt + b' ' + str(size).encode() + b'\x00')
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        if total > size:
+            raise Exception("Malformed object {0}: bad length".format(sha))
+        objHash.update(chunk)
+        yield chunk
+    if total != size:
+        raise Exception("Malformed object {0}: bad length".format(sha))
+    if objHash.hexdigest() != sha:
+        raise Exception("Corrupt object {0}: hash mismatch".format(sha))
+
+
 # Import subclasses
 from libgitv.GitBlob import GitBlob
 from libgitv.GitTree import GitTree
@@ -153,11 +287,11 @@ from libgitv.GitCommit import GitCommit
 # Load subclass constructors into dictionary
 GIT_OBJECT_CONSTRUCTORS[b'commit'] = GitCommit
 GIT_OBJECT_CONSTRUCTORS[b'tree'] = GitTree
-# GIT_OBJECT_CONSTRUCTORS[b'tag'] = GitTag  # Uncomment when class implemented
 GIT_OBJECT_CONSTRUCTORS[b'blob'] = GitBlob
 
 
-from libgitv.GitRefs import ref_resolve
+from libgitv.GitRefs import ref_resolve, GitTag
+GIT_OBJECT_CONSTRUCTORS[b'tag'] = GitTag
 
 #cat-file command
 #git cat-file TYPE OBJECT 
@@ -165,13 +299,64 @@ from libgitv.GitRefs import ref_resolve
 
 def cmd_cat_file(args):
     repo = GitRepository.repo_find()
+    if args.batch or args.batch_check:
+        cat_file_batch(repo, sys.stdin.buffer, sys.stdout.buffer, contents=args.batch)
+        return
+    if args.object is None:
+        # A single positional argument is the object (cat-file -t OBJECT)
+        args.type, args.object = None, args.type
+    if args.object is None:
+        raise Exception("cat-file needs an object")
+    if args.type is not None and args.type not in ("blob", "commit", "tag", "tree"):
+        raise Exception("Unknown type {0}".format(args.type))
+    if args.show_type or args.show_size:
+        # Metadata only: never inflate more than the object header
+        fmt, size = GitObject.object_info(repo, GitObject.object_find(repo, args.object))
+        print(fmt.decode("ascii") if args.show_type else size)
+        return
+    if not args.type:
+        raise Exception("cat-file needs a type, -t or -s")
     cat_file(repo, args.object, format = args.type.encode())
 
 def cat_file(repo, obj, format = None):
-    obj = GitObject.object_read(repo, GitObject.object_find(repo,obj,format=format))
-    sys.stdout.buffer.write(obj.serialize())
+    # Stream the raw content, so that blobs of any size pipe in constant memory
+    fmt, size, chunks = GitObject.object_stream(repo, GitObject.object_find(repo,obj,format=format))
+    for chunk in chunks:
+        sys.stdout.buffer.write(chunk)
         
 
+def cat_file_batch(repo, input, output, contents=True):
+    """
+    Read one object name per line from input and write for each
+    "<sha> <type> <size>" followed with contents by the object content and a newline.
+    The repository, its packs and its object cache are shared by the whole session.
+    """
+    for line in input:
+        name = line.strip().decode("utf-8")
+        if not name:
+            continue
+        try:
+            sha = GitObject.object_find(repo, name)
+        except Exception:
+            sha = None
+        if not sha:
+            output.write(name.encode("utf-8") + b' missing\n')
+            output.flush()
+            continue
+
+        if contents:
+            fmt, size, chunks = GitObject.object_stream(repo, sha)
+        else:
+            fmt, size = GitObject.object_info(repo, sha)
+        output.write(sha.encode("ascii") + b' ' + fmt + b' ' + str(size).encode("ascii") + b'\n')
+        if contents:
+            for chunk in chunks:
+                output.write(chunk)
+            output.write(b'\n')
+        # Callers wait on each answer before sending the next name
+        output.flush()
+
+
 #hash-object is basically the opposite of cat-file: 
 #it reads a file, computes its hash as an object
 #either storing it in the repository (if the -w flag is passed) or just printing its hash.
@@ -184,52 +369,111 @@ def cmd_hash_object(args):
     
     with open(args.path, "rb") as fd:
         #printing its hash
-        sha = object_hash(fd,args.type.encode(),repo)
+        sha = object_hash(fd,args.type.encode(),repo,write=args.write)
         print(sha)
 
-def object_hash(fd, format=b'blob', repo=None, lf_ending=False, bin=False):
+def object_hash(fd, format=b'blob', repo=None, lf_ending=False, bin=False, write=False):
     #type commit, tree, tag, blob
     #default: blob
+    if format not in GIT_OBJECT_CONSTRUCTORS:
+        raise Exception("Unknown type %s!" % format)
+
+    if format == b'blob' and fd.seekable():
+        # Blobs need no parsing: stream them so memory stays constant whatever the file size
+        return object_hash_stream(fd, repo, lf_ending=lf_ending, bin=bin, write=write)
+
     data = fd.read()
     if lf_ending:  # Scrub blobs to linux LF format for cross-platform consistency
         data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
 
-    if format in GIT_OBJECT_CONSTRUCTORS:
-        obj = GIT_OBJECT_CONSTRUCTORS[format](repo, data)
-    else:
-        raise Exception("Unknown type %s!" % format)
+    obj = GIT_OBJECT_CONSTRUCTORS[format](repo, data)
+    return obj.object_write(write, bin=bin)
 
-    return obj.object_write(False, bin=bin)
 
+def read_chunks(fd):
+    while True:
+        chunk = fd.read(STREAM_CHUNK)
+        if not chunk:
+            return
+        yield chunk
 
-def cmd_log(args):
-    repo = GitRepository.repo_find()
-    log_graph(repo, GitObject.object_find(repo, args.commit), set())
 
-def log_graph(repo,sha,seen):
-    if sha in seen:
-        return 
-    seen.add(sha)
+def lf_chunks(chunks):
+    # Same scrubbing as object_hash, keeping a trailing \r until we know
+    # whether the next chunk starts with \n
+    pending = b''
+    for chunk in chunks:
+        chunk = pending + chunk
+        if chunk.endswith(b'\r'):
+            pending = b'\r'
+            chunk = chunk[:-1]
+        else:
+            pending = b''
+        yield chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    if pending:
+        yield b'\n'
 
-    commit = GitObject.object_read(repo,sha)
-    assert(commit.format==b'commit')
-    if not b'parent' in commit.kvlm.keys():
-        #no parent, the initial commit
-        return
-    
-    parents = commit.kvlm[b'parent'] #key value list message
-    if type(parents) != list:
-        parents=[parents] #convert it to a list
-    
-    for p in parents:
-        p = p.decode("ascii")
-        # print("c_{0} -> c_{1};".format(sha,p))
-        print('commit: {0}'.format(sha))
-        arrAuthor = str(commit.kvlm[b'author'])[2:-1].split(' ')
-        commitDate = datetime.fromtimestamp(int(arrAuthor[-2]))
-        print('Author: {0} {1}\nDate: {2} {3}\n'.format(' '.join(arrAuthor[:-3]), arrAuthor[-3], commitDate.ctime(), arrAuthor[-1]))
-        print('\t{0}'.format(str(commit.kvlm[b''])[2:-1].replace('\\n', '\n\t')))
-        log_graph(repo,p,seen) #recursion
+
+def object_hash_stream(fd, repo=None, lf_ending=False, bin=False, write=False):
+    """
+    Hash (and with write, store) the rest of fd as a blob, a chunk at a time.
+    The size for the header comes from seeking to the end, or from a first pass when
+    line endings are scrubbed since that changes the size.
+    """
+    start = fd.tell()
+    if lf_ending:
+        size = sum(len(chunk) for chunk in lf_chunks(read_chunks(fd)))
+        fd.seek(start)
+        chunks = lf_chunks(read_chunks(fd))
+    else:
+        size = fd.seek(0, os.SEEK_END) - start
+        fd.seek(start)
+        chunks = read_chunks(fd)
+    return object_write_stream(repo, b'blob', chunks, size, written=write, bin=bin)
+
+
+def object_write_stream(repo, format, chunks, size, written=True, bin=False):
+    """
+    Feed chunks through SHA-1 and zlib at the same time. The compressed
+    object goes to a temporary file renamed into objects/ once its name is known.
+    """
+    header = format + b' ' + str(size).encode() + b'\x00'
+    sha = hashlib.sha1(header)
+    total = 0
+
+    if not written:
+        for chunk in chunks:
+            sha.update(chunk)
+            total += len(chunk)
+    else:
+        compressor = zlib.compressobj()
+        fdTmp, tmpPath = tempfile.mkstemp(prefix="tmp_obj_", dir=repo.dir("objects", mkdir=True))
+        try:
+            with os.fdopen(fdTmp, 'wb') as f:
+                f.write(compressor.compress(header))
+                for chunk in chunks:
+                    sha.update(chunk)
+                    total += len(chunk)
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+        except BaseException:
+            os.remove(tmpPath)
+            raise
+
+    if total != size:
+        if written:
+            os.remove(tmpPath)
+        raise Exception("File changed while hashing: expected {0} bytes, read {1}".format(size, total))
+
+    shaHex = sha.hexdigest()
+    if written:
+        path = repo.file("objects", shaHex[0:2], shaHex[2:], mkdir=True)
+        if os.path.exists(path):
+            os.remove(tmpPath)  # Same content already stored
+        else:
+            os.chmod(tmpPath, 0o444)  # mkstemp makes it 0600: objects are read-only, as in git
+            os.replace(tmpPath, path)
+    return sha.digest() if bin else shaHex
 
 
 def cmd_rev_parse(args):
@@ -237,4 +481,7 @@ def cmd_rev_parse(args):
     if args.type:
         format = args.type.encode()
     repo = GitRepository.repo_find()
-    print(GitObject.object_find(repo, args.name, format, follow=True))
\ No newline at end of file
+    sha = GitObject.object_find(repo, args.name, format, follow=True)
+    if args.short and sha is not None:
+        sha = abbrev(repo, [sha], args.abbrev)[0]
+    print(sha)
\ No newline at end of file
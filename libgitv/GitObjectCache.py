@@ -0,0 +1,51 @@
+#This file is the object cache shared by every reader of a GitRepository.
+#Parsed objects are kept by SHA and evicted least recently used first once
+#the total size of their content goes over core.objectCacheSize.
+import collections
+
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class GitObjectCache(object):
+    def __init__(self, maxSize=DEFAULT_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.size = 0
+        self.entries = collections.OrderedDict()  # sha -> (object, size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sha):
+        entry = self.entries.get(sha)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(sha)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, sha, obj, size):
+        if size > self.maxSize:
+            return  # Would evict everything else for a single object
+        if sha in self.entries:
+            self.size -= self.entries.pop(sha)[1]
+        self.entries[sha] = (obj, size)
+        self.size += size
+        while self.size > self.maxSize:
+            _, (_, evictedSize) = self.entries.popitem(last=False)
+            self.size -= evictedSize
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "size": self.size
+        }
@@ -0,0 +1,836 @@
+#This file is the packfile reader and writer.
+#A pack stores many objects in a single file (.pack), with a companion
+#index (.idx) mapping each SHA to the offset of its entry inside the pack.
+#Objects inside a pack are either stored whole or as a delta against
+#another object (OFS_DELTA: base given by offset, REF_DELTA: base given by SHA)
+#A multi-pack-index merges the indexes of several packs, so that finding an
+#object takes one binary search however many packs there are.
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+
+
+IDX_SIGNATURE = b'\xfftOc'
+PACK_SIGNATURE = b'PACK'
+MIDX_SIGNATURE = b'MIDX'
+MIDX_VERSION = 1
+MIDX_HASH_SHA1 = 1
+CHUNK_PACK_NAMES = b'PNAM'
+CHUNK_OID_FANOUT = b'OIDF'
+CHUNK_OID_LOOKUP = b'OIDL'
+CHUNK_OBJECT_OFFSETS = b'OOFF'
+CHUNK_LARGE_OFFSETS = b'LOFF'
+MIDX_LARGE_OFFSET = 0x80000000
+
+# Pack entry types
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+PACK_TYPE_NAMES = {
+    OBJ_COMMIT: b'commit',
+    OBJ_TREE: b'tree',
+    OBJ_BLOB: b'blob',
+    OBJ_TAG: b'tag'
+}
+
+# Size of the chunks fed to zlib when inflating an entry out of the mmap
+INFLATE_CHUNK = 4096
+
+
+def mmap_file(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def inflate(buf, pos, size):
+    """
+    Inflate the zlib stream starting at buf[pos], which is known to hold
+    size bytes once decompressed. Input is fed in small chunks so that we
+    never copy the rest of the pack.
+    """
+    view = memoryview(buf)
+    d = zlib.decompressobj()
+    out = []
+    while not d.eof:
+        chunk = view[pos:pos+INFLATE_CHUNK]
+        if not chunk:
+            raise Exception("Truncated pack entry")
+        out.append(d.decompress(chunk))
+        pos += len(chunk)
+    data = b''.join(out)
+    if len(data) != size:
+        raise Exception("Malformed pack entry: bad length")
+    return data
+
+
+def inflate_chunks(buf, pos, chunkSize):
+    """
+    Yield the inflated zlib stream at buf[pos] no more than chunkSize bytes at a time
+    """
+    view = memoryview(buf)
+    d = zlib.decompressobj()
+    while not d.eof:
+        data = d.unconsumed_tail
+        if not data:
+            data = view[pos:pos+chunkSize]
+            if not data:
+                raise Exception("Truncated pack entry")
+            pos += len(data)
+        out = d.decompress(data, chunkSize)
+        if out:
+            yield out
+
+
+def inflate_head(buf, pos, length):
+    """
+    Inflate no more than the first length bytes of the zlib stream at buf[pos]
+    """
+    view = memoryview(buf)
+    d = zlib.decompressobj()
+    out = b''
+    while len(out) < length and not d.eof:
+        chunk = view[pos:pos+64]
+        if not chunk:
+            break
+        out += d.decompress(chunk, length - len(out))
+        pos += len(chunk)
+        # Input left unconsumed once length is reached is simply dropped
+        if d.unconsumed_tail:
+            break
+    return out
+
+
+def delta_read_size(delta, pos):
+    # Little-endian base 128 varint used by the delta headers
+    size = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return pos, size
+
+
+def delta_apply(base, delta):
+    pos, srcSize = delta_read_size(delta, 0)
+    if srcSize != len(base):
+        raise Exception("Delta base size mismatch")
+    pos, dstSize = delta_read_size(delta, pos)
+
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            # Copy from base: bits 0-3 select offset bytes, bits 4-6 size bytes
+            offset = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[offset:offset+size]
+        elif cmd:
+            # Insert the next cmd bytes literally
+            out += delta[pos:pos+cmd]
+            pos += cmd
+        else:
+            raise Exception("Invalid delta opcode 0")
+
+    if len(out) != dstSize:
+        raise Exception("Delta result size mismatch")
+    return bytes(out)
+
+
+class GitPackIndex(object):
+    """
+    Version 2 pack index:
+    header (4-byte signature, 4-byte version), 256-entry fan-out table,
+    sorted SHAs, CRC32s, 4-byte offsets, 8-byte offsets for large packs,
+    pack checksum and index checksum
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = mmap_file(path)
+
+        signature, version = struct.unpack('!4sL', self.data[:8])
+        if signature != IDX_SIGNATURE or version != 2:
+            raise Exception("Unsupported pack index {0}".format(path))
+
+        self.fanout = struct.unpack('!256L', self.data[8:8+1024])
+        self.count = self.fanout[255]
+        self.shaOffset = 8 + 1024
+        self.crcOffset = self.shaOffset + 20 * self.count
+        self.ofsOffset = self.crcOffset + 4 * self.count
+        self.largeOffset = self.ofsOffset + 4 * self.count
+
+    def sha_at(self, i):
+        start = self.shaOffset + 20 * i
+        return self.data[start:start+20]
+
+    def offset_at(self, i):
+        start = self.ofsOffset + 4 * i
+        offset, = struct.unpack('!L', self.data[start:start+4])
+        if offset & 0x80000000:
+            # MSB set: index into the 8-byte offset table
+            start = self.largeOffset + 8 * (offset & 0x7fffffff)
+            offset, = struct.unpack('!Q', self.data[start:start+8])
+        return offset
+
+    def find(self, binsha):
+        """
+        Return the position of binsha in the index, or None.
+        The fan-out table bounds the search to SHAs sharing the first byte.
+        """
+        first = binsha[0]
+        lo = self.fanout[first-1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = self.sha_at(mid)
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def shas(self):
+        for i in range(self.count):
+            yield self.sha_at(i).hex()
+
+    def offsets(self):
+        # Offsets of every object, in index order, reading the table at once
+        offsets = list(struct.unpack_from('!%dL' % self.count, self.data, self.ofsOffset))
+        for i, offset in enumerate(offsets):
+            if offset & 0x80000000:
+                offsets[i], = struct.unpack_from('!Q', self.data, self.largeOffset + 8 * (offset & 0x7fffffff))
+        return offsets
+
+    def close(self):
+        self.data.close()
+
+
+class GitPack(object):
+    def __init__(self, path):
+        self.path = path
+        self.index = GitPackIndex(path[:-len('.pack')] + '.idx')
+        self.data = mmap_file(path)
+        self.bitmap = None
+        """Its bitmap index once looked up, False when it has none"""
+
+        signature, version, count = struct.unpack('!4sLL', self.data[:12])
+        if signature != PACK_SIGNATURE or version not in (2, 3):
+            raise Exception("Unsupported pack {0}".format(path))
+        if count != self.index.count:
+            raise Exception("Pack {0} does not match its index".format(path))
+
+    def contains(self, sha):
+        return self.index.find(bytes.fromhex(sha)) is not None
+
+    def entry_header(self, offset):
+        """
+        Parse the entry header at offset.
+        Return (type, size, position of the data, delta base) where the delta
+        base is an offset for OFS_DELTA, a binary SHA for REF_DELTA, else None.
+        """
+        data = self.data
+        pos = offset
+        c = data[pos]
+        pos += 1
+        type = (c >> 4) & 0x7
+        size = c & 0x0f
+        shift = 4
+        while c & 0x80:
+            c = data[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+        base = None
+        if type == OBJ_OFS_DELTA:
+            c = data[pos]
+            pos += 1
+            ofs = c & 0x7f
+            while c & 0x80:
+                c = data[pos]
+                pos += 1
+                ofs = ((ofs + 1) << 7) | (c & 0x7f)
+            base = offset - ofs
+        elif type == OBJ_REF_DELTA:
+            base = data[pos:pos+20]
+            pos += 20
+        return type, size, pos, base
+
+    def info_at(self, offset, base_info=None):
+        """
+        Return (format, size) of the object at offset reading only entry
+        headers: the size of a delta result is the second varint of the
+        delta, the format is the one of the base at the end of the chain.
+        """
+        type, size, pos, base = self.entry_header(offset)
+        if type in PACK_TYPE_NAMES:
+            return PACK_TYPE_NAMES[type], size
+
+        # Both varints of the delta header take at most 10 bytes each
+        head = inflate_head(self.data, pos, 20)
+        pos, _ = delta_read_size(head, 0)
+        _, size = delta_read_size(head, pos)
+
+        while type not in PACK_TYPE_NAMES:
+            if type == OBJ_OFS_DELTA:
+                offset = base
+            elif type == OBJ_REF_DELTA:
+                i = self.index.find(base)
+                if i is not None:
+                    offset = self.index.offset_at(i)
+                elif base_info is not None:
+                    return base_info(base.hex())[0], size
+                else:
+                    raise Exception("Missing delta base {0}".format(base.hex()))
+            else:
+                raise Exception("Unknown pack entry type {0} in {1}".format(type, self.path))
+            type, _, _, base = self.entry_header(offset)
+        return PACK_TYPE_NAMES[type], size
+
+    def info(self, sha, base_info=None):
+        i = self.index.find(bytes.fromhex(sha))
+        if i is None:
+            return None
+        return self.info_at(self.index.offset_at(i), base_info)
+
+    def stream_at(self, offset, chunkSize, base_reader=None):
+        """
+        Return (format, size, chunks). Whole objects are inflated chunk by
+        chunk straight from the mmap, deltas have to be resolved in memory.
+        """
+        type, size, pos, base = self.entry_header(offset)
+        if type in PACK_TYPE_NAMES:
+            return PACK_TYPE_NAMES[type], size, inflate_chunks(self.data, pos, chunkSize)
+        fmt, data = self.read_at(offset, base_reader)
+        return fmt, len(data), iter([data])
+
+    def stream(self, sha, chunkSize, base_reader=None):
+        i = self.index.find(bytes.fromhex(sha))
+        if i is None:
+            return None
+        return self.stream_at(self.index.offset_at(i), chunkSize, base_reader)
+
+    def read_at(self, offset, base_reader=None):
+        """
+        Read the object at offset, resolving delta chains iteratively.
+        base_reader is used for REF_DELTA bases missing from this pack.
+        Return (format, data)
+        """
+        deltas = []
+        while True:
+            type, size, pos, base = self.entry_header(offset)
+            if type in PACK_TYPE_NAMES:
+                fmt = PACK_TYPE_NAMES[type]
+                data = inflate(self.data, pos, size)
+                break
+
+            deltas.append(inflate(self.data, pos, size))
+            if type == OBJ_OFS_DELTA:
+                offset = base
+            elif type == OBJ_REF_DELTA:
+                i = self.index.find(base)
+                if i is not None:
+                    offset = self.index.offset_at(i)
+                elif base_reader is not None:
+                    fmt, data = base_reader(base.hex())
+                    break
+                else:
+                    raise Exception("Missing delta base {0}".format(base.hex()))
+            else:
+                raise Exception("Unknown pack entry type {0} in {1}".format(type, self.path))
+
+        # Apply deltas from the one closest to the base outward
+        for delta in reversed(deltas):
+            data = delta_apply(data, delta)
+        return fmt, data
+
+    def read(self, sha, base_reader=None):
+        i = self.index.find(bytes.fromhex(sha))
+        if i is None:
+            return None
+        return self.read_at(self.index.offset_at(i), base_reader)
+
+    def close(self):
+        if self.bitmap:
+            self.bitmap.close()
+        self.data.close()
+        self.index.close()
+
+
+class GitMultiPackIndex(object):
+    """
+    Multi-pack-index (objects/pack/multi-pack-index):
+    header (signature, version, hash version, chunk count, base file count,
+    pack count), table of contents, then chunks: the .idx names of the packs,
+    fan-out table, sorted SHAs, (pack number, offset) of each object and
+    8-byte offsets for large packs; a checksum ends the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = mmap_file(path)
+
+        signature, version, hashVersion, chunkCount, baseCount, self.packCount = struct.unpack_from('!4sBBBBL', self.data, 0)
+        if signature != MIDX_SIGNATURE or version != MIDX_VERSION or hashVersion != MIDX_HASH_SHA1:
+            raise Exception("Unsupported multi-pack-index {0}".format(path))
+
+        chunks = {}
+        for i in range(chunkCount):
+            chunkId, offset = struct.unpack_from('!4sQ', self.data, 12 + 12 * i)
+            chunks[chunkId] = offset
+        for chunkId in (CHUNK_PACK_NAMES, CHUNK_OID_FANOUT, CHUNK_OID_LOOKUP, CHUNK_OBJECT_OFFSETS):
+            if chunkId not in chunks:
+                raise Exception("Multi-pack-index {0} has no {1} chunk".format(path, chunkId.decode("ascii")))
+
+        names = self.data[chunks[CHUNK_PACK_NAMES]:chunks[CHUNK_OID_FANOUT]].split(b'\x00')
+        self.packNames = [name.decode("utf-8", "surrogateescape") for name in names[:self.packCount]]
+        self.fanout = struct.unpack_from('!256L', self.data, chunks[CHUNK_OID_FANOUT])
+        self.count = self.fanout[255]
+        self.lookupOffset = chunks[CHUNK_OID_LOOKUP]
+        self.objectOffset = chunks[CHUNK_OBJECT_OFFSETS]
+        self.largeOffset = chunks.get(CHUNK_LARGE_OFFSETS)
+        self.packs = None
+        """Pack of each pack number, set by pack_list"""
+        self.others = None
+        """The packs of the repository it does not cover, set by pack_list"""
+
+    def sha_at(self, i):
+        start = self.lookupOffset + 20 * i
+        return self.data[start:start+20]
+
+    def find(self, binsha):
+        """
+        Return the position of binsha in the multi-pack-index, or None
+        """
+        first = binsha[0]
+        lo = self.fanout[first-1] if first else 0
+        hi = self.fanout[first]
+        data = self.data
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.lookupOffset + 20 * mid
+            cur = data[start:start+20]
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def object_at(self, i):
+        """
+        Return (pack number, offset) of the object at position i
+        """
+        packId, offset = struct.unpack_from('!LL', self.data, self.objectOffset + 8 * i)
+        if self.largeOffset is not None and offset & MIDX_LARGE_OFFSET:
+            offset, = struct.unpack_from('!Q', self.data, self.largeOffset + 8 * (offset & ~MIDX_LARGE_OFFSET))
+        return packId, offset
+
+    def close(self):
+        self.data.close()
+
+
+def pack_list(repo):
+    """
+    Return the packs of the repository, opening them the first time only.
+    The multi-pack-index is opened with them, unless core.multiPackIndex is false.
+    """
+    if repo.packs is None:
+        packs = []
+        path = repo.dir("objects", "pack")
+        if path:
+            for f in sorted(os.listdir(path)):
+                if f.endswith('.pack') and os.path.exists(os.path.join(path, f[:-5] + '.idx')):
+                    packs.append(GitPack(os.path.join(path, f)))
+        repo.packs = packs
+
+        repo.multiPackIndex = None
+        midxPath = os.path.join(path, "multi-pack-index") if path else None
+        if (midxPath and os.path.exists(midxPath)
+                and repo.conf.getboolean("core", "multiPackIndex", fallback=True)):
+            midx = GitMultiPackIndex(midxPath)
+            byName = {os.path.basename(pack.path)[:-5] + '.idx': pack for pack in packs}
+            if all(name in byName for name in midx.packNames):
+                midx.packs = [byName[name] for name in midx.packNames]
+                midx.others = [pack for pack in packs if pack not in midx.packs]
+                repo.multiPackIndex = midx
+            else:
+                midx.close()  # Names a pack deleted since: stale
+    return repo.packs
+
+
+def pack_reset(repo):
+    # Drop the open packs so that the next lookup sees the pack directory again
+    if repo.packs:
+        for pack in repo.packs:
+            pack.close()
+    if repo.multiPackIndex:
+        repo.multiPackIndex.close()
+    repo.packs = None
+    repo.multiPackIndex = None
+
+
+def pack_indexes(repo):
+    """
+    Return the indexes to search for objects: the multi-pack-index and the
+    .idx of the packs it does not cover, or the .idx of every pack without one
+    """
+    packs = pack_list(repo)
+    midx = repo.multiPackIndex
+    if midx is None:
+        return [pack.index for pack in packs]
+    return [midx] + [pack.index for pack in midx.others]
+
+
+def sha_lower_bound(index, binsha):
+    """
+    Return the position of the first SHA of index (a pack index or a
+    multi-pack-index) not below binsha, with the fan-out table bounding the search
+    """
+    first = binsha[0]
+    lo = index.fanout[first-1] if first else 0
+    hi = index.fanout[first]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if index.sha_at(mid) < binsha:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def pack_find(repo, sha):
+    """
+    Return (pack, offset) of sha, or None when no pack holds it.
+    The multi-pack-index is searched first, then the packs it does not cover.
+    """
+    binsha = bytes.fromhex(sha)
+    packs = pack_list(repo)
+    midx = repo.multiPackIndex
+    if midx is not None:
+        i = midx.find(binsha)
+        if i is not None:
+            packId, offset = midx.object_at(i)
+            return midx.packs[packId], offset
+        packs = midx.others
+    for pack in packs:
+        i = pack.index.find(binsha)
+        if i is not None:
+            return pack, pack.index.offset_at(i)
+    return None
+
+
+def pack_info(repo, sha, base_info=None):
+    """
+    Return (format, size) of sha from the first pack holding it, or None.
+    """
+    found = pack_find(repo, sha)
+    if found is None:
+        return None
+    pack, offset = found
+    return pack.info_at(offset, base_info)
+
+
+def pack_stream(repo, sha, chunkSize, base_reader=None):
+    """
+    Return (format, size, chunks) of sha from the first pack holding it, or None.
+    """
+    found = pack_find(repo, sha)
+    if found is None:
+        return None
+    pack, offset = found
+    return pack.stream_at(offset, chunkSize, base_reader)
+
+
+def pack_read(repo, sha, base_reader=None):
+    """
+    Look sha up in the packs of repo.
+    Return (format, data), or None when no pack holds the object.
+    """
+    found = pack_find(repo, sha)
+    if found is None:
+        return None
+    pack, offset = found
+    return pack.read_at(offset, base_reader)
+
+
+# Blocks of the delta base are indexed by their content in chunks of this size
+DELTA_BLOCK = 16
+
+
+def delta_encode_size(size):
+    ret = bytearray()
+    while True:
+        c = size & 0x7f
+        size >>= 7
+        if size:
+            ret.append(c | 0x80)
+        else:
+            ret.append(c)
+            return ret
+
+
+def delta_create(base, target):
+    """
+    Compute a git delta turning base into target.
+    Blocks of base are indexed by content, then target is scanned for
+    matching blocks which are extended and emitted as copy instructions.
+    Everything else becomes insert instructions.
+    """
+    out = delta_encode_size(len(base)) + delta_encode_size(len(target))
+
+    blocks = {}
+    for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        blocks.setdefault(base[i:i+DELTA_BLOCK], i)
+
+    def emit_insert(start, end):
+        while start < end:
+            n = min(end - start, 0x7f)
+            out.append(n)
+            out.extend(target[start:start+n])
+            start += n
+
+    def emit_copy(offset, size):
+        while size:
+            n = min(size, 0xffffff)
+            cmd = 0x80
+            args = bytearray()
+            for i in range(4):
+                b = (offset >> (8 * i)) & 0xff
+                if b:
+                    cmd |= 1 << i
+                    args.append(b)
+            for i in range(3):
+                b = (n >> (8 * i)) & 0xff
+                if b:
+                    cmd |= 0x10 << i
+                    args.append(b)
+            out.append(cmd)
+            out.extend(args)
+            offset += n
+            size -= n
+
+    pos = 0
+    pending = 0  # Start of the bytes waiting to be inserted
+    end = len(target)
+    while pos + DELTA_BLOCK <= end:
+        offset = blocks.get(target[pos:pos+DELTA_BLOCK])
+        if offset is None:
+            pos += 1
+            continue
+
+        # Extend the match forward, a block at a time then byte by byte
+        size = DELTA_BLOCK
+        while (offset + size + DELTA_BLOCK <= len(base) and pos + size + DELTA_BLOCK <= end
+                and base[offset+size:offset+size+DELTA_BLOCK] == target[pos+size:pos+size+DELTA_BLOCK]):
+            size += DELTA_BLOCK
+        while offset + size < len(base) and pos + size < end and base[offset+size] == target[pos+size]:
+            size += 1
+        # And backward, into the bytes not emitted yet
+        while offset > 0 and pos > pending and base[offset-1] == target[pos-1]:
+            offset -= 1
+            pos -= 1
+            size += 1
+
+        emit_insert(pending, pos)
+        emit_copy(offset, size)
+        pos += size
+        pending = pos
+
+    emit_insert(pending, end)
+    return bytes(out)
+
+
+def pack_encode_header(type, size):
+    c = (type << 4) | (size & 0x0f)
+    size >>= 4
+    ret = bytearray()
+    while size:
+        ret.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret.append(c)
+    return ret
+
+
+def pack_encode_offset(ofs):
+    # Big-endian base 128 with an implicit +1 on every continuation byte
+    ret = bytearray([ofs & 0x7f])
+    ofs >>= 7
+    while ofs:
+        ofs -= 1
+        ret.append(0x80 | (ofs & 0x7f))
+        ofs >>= 7
+    ret.reverse()
+    return ret
+
+
+def pack_write(repo, objects, count):
+    """
+    Write count objects into a new pack and its index.
+    objects yields (sha, format, data, base) in write order, where base is
+    the SHA the data is a delta against, or None when data is the whole object.
+    Return the path of the new pack.
+    """
+    typeNumbers = {name: type for type, name in PACK_TYPE_NAMES.items()}
+    packDir = repo.dir("objects", "pack", mkdir=True)
+    tmpPath = os.path.join(packDir, "tmp_pack_%d" % os.getpid())
+
+    offsets = {}
+    crcs = {}
+    packHash = hashlib.sha1()
+    with open(tmpPath, 'wb') as f:
+        def write(buf):
+            packHash.update(buf)
+            f.write(buf)
+
+        write(struct.pack('!4sLL', PACK_SIGNATURE, 2, count))
+        pos = 12
+        for sha, fmt, data, base in objects:
+            if base is None:
+                entry = pack_encode_header(typeNumbers[fmt], len(data))
+            elif base in offsets:
+                entry = pack_encode_header(OBJ_OFS_DELTA, len(data)) + pack_encode_offset(pos - offsets[base])
+            else:
+                entry = pack_encode_header(OBJ_REF_DELTA, len(data)) + bytes.fromhex(base)
+            entry += zlib.compress(data)
+            write(entry)
+            offsets[sha] = pos
+            crcs[sha] = zlib.crc32(entry)
+            pos += len(entry)
+
+        if len(offsets) != count:
+            raise Exception("Pack object count mismatch")
+        checksum = packHash.digest()
+        f.write(checksum)
+
+    basePath = os.path.join(packDir, "pack-" + checksum.hex())
+    idxTmpPath = tmpPath + ".idx"
+    with open(idxTmpPath, 'wb') as f:
+        f.write(idx_serialize(offsets, crcs, checksum))
+
+    os.replace(tmpPath, basePath + ".pack")
+    os.replace(idxTmpPath, basePath + ".idx")
+    return basePath + ".pack"
+
+
+def idx_serialize(offsets, crcs, checksum):
+    shas = sorted(offsets)
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+
+    small = []
+    large = []
+    for sha in shas:
+        ofs = offsets[sha]
+        if ofs < 0x80000000:
+            small.append(ofs)
+        else:
+            small.append(0x80000000 | len(large))
+            large.append(ofs)
+
+    buff = bytearray(struct.pack('!4sL', IDX_SIGNATURE, 2))
+    buff += struct.pack('!256L', *fanout)
+    buff += b''.join(bytes.fromhex(sha) for sha in shas)
+    buff += struct.pack('!%dL' % len(shas), *(crcs[sha] for sha in shas))
+    buff += struct.pack('!%dL' % len(small), *small)
+    buff += struct.pack('!%dQ' % len(large), *large)
+    buff += checksum
+    buff += hashlib.sha1(buff).digest()
+    return bytes(buff)
+
+
+def midx_write(repo):
+    """
+    Write the multi-pack-index of every pack of the repository.
+    An object in several packs is taken from the newest one, as git does.
+    Return the number of objects, or None when there is no pack and nothing was written.
+    """
+    packs = sorted(pack_list(repo), key=lambda pack: os.path.basename(pack.path))
+    path = repo.path("objects", "pack", "multi-pack-index")
+    if not packs:
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+
+    # Newest pack first, then by pack number: the first pack seen holding an object wins
+    newest = sorted(range(len(packs)), key=lambda packId: (-os.path.getmtime(packs[packId].path), packId))
+    objects = {}
+    for packId in newest:
+        index = packs[packId].index
+        shas = index.data[index.shaOffset:index.shaOffset + 20 * index.count]
+        for i, offset in enumerate(index.offsets()):
+            objects.setdefault(shas[20*i:20*i+20], (packId, offset))
+    shas = sorted(objects)
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[sha[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+
+    names = b''.join(os.path.basename(pack.path)[:-5].encode("utf-8", "surrogateescape") + b'.idx\x00' for pack in packs)
+    names += b'\x00' * (-len(names) % 4)
+    # Offsets only go to the large offset chunk when some do not fit in 32 bits
+    largeNeeded = any(offset > 0xFFFFFFFF for _, offset in objects.values())
+    large = []
+    objectOffsets = bytearray(8 * len(shas))
+    for i, sha in enumerate(shas):
+        packId, offset = objects[sha]
+        if largeNeeded and offset >= MIDX_LARGE_OFFSET:
+            offset = MIDX_LARGE_OFFSET | len(large)
+            large.append(objects[sha][1])
+        struct.pack_into('!LL', objectOffsets, 8 * i, packId, offset)
+
+    chunks = [(CHUNK_PACK_NAMES, names), (CHUNK_OID_FANOUT, struct.pack('!256L', *fanout)),
+        (CHUNK_OID_LOOKUP, b''.join(shas)), (CHUNK_OBJECT_OFFSETS, bytes(objectOffsets))]
+    if large:
+        chunks.append((CHUNK_LARGE_OFFSETS, struct.pack('!%dQ' % len(large), *large)))
+
+    out = bytearray(struct.pack('!4sBBBBL', MIDX_SIGNATURE, MIDX_VERSION, MIDX_HASH_SHA1, len(chunks), 0, len(packs)))
+    offset = 12 + 12 * (len(chunks) + 1)
+    for chunkId, chunk in chunks:
+        out += struct.pack('!4sQ', chunkId, offset)
+        offset += len(chunk)
+    out += struct.pack('!4sQ', b'\x00' * 4, offset)
+    for _, chunk in chunks:
+        out += chunk
+    out += hashlib.sha1(out).digest()
+
+    lockPath = path + '.lock'
+    fd = os.open(lockPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o444)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(out)
+        pack_reset(repo)
+        os.replace(lockPath, path)
+    except BaseException:
+        os.remove(lockPath)
+        raise
+    return len(shas)
@@ -1,55 +1,542 @@
+#This file is the refs: loose ref files, packed-refs and the tag command.
+#A command reads refs through one snapshot per repository: each loose file is
+#opened at most once and packed-refs is searched in place, so resolving or
+#listing every ref costs one walk of .git/refs and one read of packed-refs.
 import collections
 import os
+import sys
 from libgitv.GitObject import GitObject
 
 from libgitv.GitRepository import GitRepository
-from libgitv.GitCommit import GitCommit
+from libgitv.GitCommit import GitCommit, kvlm_parse
+from libgitv.GitPack import mmap_file
 import libgitv.util.StringHelpers as StringHelper
 
 
+PACKED_REFS_HEADER = b'# pack-refs with: peeled fully-peeled sorted \n'
+# Longest chain of symbolic refs followed, as in git
+SYMREF_MAX_DEPTH = 5
+
+
+class GitPackedRefs(object):
+    """
+    .git/packed-refs: a header line listing its traits, then one "<sha> <refname>"
+    line per ref, sorted by name when it has the sorted trait, each annotated
+    tag followed by a "^<sha>" line with the object it peels to.
+    Sorted files are searched in place with a binary search over the mmap.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = mmap_file(path) if os.path.getsize(path) else b''
+        self.start = 0
+        traits = []
+        if self.data[:1] == b'#':
+            self.start = self.data.find(b'\n') + 1 or len(self.data)
+            traits = self.data[:self.start].split(b':', 1)[-1].split()
+        self.peeledAll = b'fully-peeled' in traits
+        self.table = None
+        if b'sorted' not in traits:
+            self.table = {name: (sha, peeled) for name, sha, peeled in self.entries()}
+
+    def record_at(self, pos):
+        """
+        Parse the ref line at pos and its peeled line.
+        Return (position of the next ref line, name, sha, peeled sha or None)
+        """
+        data = self.data
+        end = data.find(b'\n', pos)
+        if end < 0:
+            end = len(data)
+        name = data[pos+41:end].rstrip(b'\r').decode("utf-8", "surrogateescape")
+        sha = data[pos:pos+40].decode("ascii")
+        peeled = None
+        pos = end + 1
+        if data[pos:pos+1] == b'^':
+            peeled = data[pos+1:pos+41].decode("ascii")
+            end = data.find(b'\n', pos)
+            pos = len(data) if end < 0 else end + 1
+        return pos, name, sha, peeled
+
+    def entries(self):
+        # Yield (name, sha, peeled sha or None) in file order
+        pos = self.start
+        while pos < len(self.data):
+            pos, name, sha, peeled = self.record_at(pos)
+            yield name, sha, peeled
+
+    def find(self, name):
+        """
+        Return (sha, peeled sha or None) of ref name, or None
+        """
+        if self.table is not None:
+            return self.table.get(name)
+        target = name.encode("utf-8", "surrogateescape")
+        data = self.data
+        lo = self.start
+        hi = len(data)
+        # lo and hi always stay at the start of a ref line
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = data.rfind(b'\n', lo, mid) + 1 or lo
+            if data[pos:pos+1] == b'^':
+                pos = data.rfind(b'\n', lo, pos - 1) + 1 or lo
+            end = data.find(b'\n', pos)
+            cur = data[pos+41:end if end >= 0 else len(data)].rstrip(b'\r')
+            if cur < target:
+                lo = self.record_at(pos)[0]
+            elif cur > target:
+                hi = pos
+            else:
+                return self.record_at(pos)[2:]
+        return None
+
+    def close(self):
+        if self.data:
+            self.data.close()
+
+
+class GitRefSnapshot(object):
+    """
+    The refs of a repository as one command sees them. Each loose ref file is
+    read at most once, packed-refs is opened once, and the full listing is
+    built on first use only: a lookup reads one loose file, or binary searches packed-refs.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.loose = {}
+        """Ref name -> content of its loose file, None when there is none"""
+        self.packed = None
+        self.listing = None
+
+    def loose_read(self, name):
+        if name not in self.loose:
+            try:
+                with open(self.repo.path(name), 'r') as f:
+                    self.loose[name] = f.read().strip()
+            except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+                self.loose[name] = None
+        return self.loose[name]
+
+    def packed_refs(self):
+        # The packed-refs file, None when there is none
+        if self.packed is None:
+            path = self.repo.path("packed-refs")
+            self.packed = GitPackedRefs(path) if os.path.exists(path) else False
+        return self.packed or None
+
+    def resolve(self, name):
+        """
+        Return the SHA ref name points to, following symbolic refs, or None
+        """
+        for _ in range(SYMREF_MAX_DEPTH):
+            data = self.loose_read(name)
+            if data is None:
+                packed = self.packed_refs()
+                found = packed.find(name) if packed is not None else None
+                return found[0] if found is not None else None
+            if not data.startswith("ref: "):
+                return data
+            name = data[5:]
+        raise Exception("Too many levels of symbolic refs at {0}".format(name))
+
+    def peeled(self, name):
+        """
+        Return the object the annotated tag ref name peels to, or None when it is not a tag
+        """
+        sha = self.resolve(name)
+        if sha is None:
+            return None
+        packed = self.packed_refs()
+        if self.loose_read(name) is None and packed is not None:
+            found = packed.find(name)
+            if found is not None and (found[1] is not None or packed.peeledAll):
+                return found[1]
+        return object_peel(self.repo, sha)
+
+    def loose_names(self):
+        # Names of the loose refs under refs/, from one walk of the directory
+        names = []
+        base = self.repo.path("refs")
+        for dir, dirs, files in os.walk(base):
+            prefix = os.path.relpath(dir, self.repo.gitdir).replace(os.sep, '/') + '/'
+            names.extend(prefix + f for f in files if not f.endswith('.lock'))
+        return names
+
+    def list(self):
+        """
+        Return the sorted list of (name, sha) of every ref under refs/, loose or packed
+        """
+        if self.listing is None:
+            refs = {}
+            packed = self.packed_refs()
+            if packed is not None:
+                for name, sha, _ in packed.entries():
+                    refs[name] = sha
+            for name in self.loose_names():
+                sha = self.resolve(name)
+                if sha is not None:
+                    refs[name] = sha
+            self.listing = sorted(refs.items(), key=lambda ref: ref[0].encode("utf-8", "surrogateescape"))
+        return self.listing
+
+    def close(self):
+        if self.packed:
+            self.packed.close()
+        self.packed = None
+
+
+def ref_snapshot(repo):
+    """
+    Return the ref snapshot of the repository, created on first use
+    """
+    if repo.refs is None:
+        repo.refs = GitRefSnapshot(repo)
+    return repo.refs
+
+
+def ref_snapshot_reset(repo):
+    # Drop the snapshot so that the next lookup sees the refs written since
+    if repo.refs is not None:
+        repo.refs.close()
+    repo.refs = None
+
+
 def ref_resolve(repo, ref):
-    data = None
+    return ref_snapshot(repo).resolve(ref)
+
+
+def ref_list(repo, prefix="refs/"):
+    """
+    Return the sorted list of (name, sha) of the refs whose name starts with prefix
+    """
+    return [ref for ref in ref_snapshot(repo).list() if ref[0].startswith(prefix)]
+
+
+NULL_SHA = '0' * 40
+# Transactions of at least this many refs go into packed-refs, rewritten once,
+# rather than into one loose file each
+TRANSACTION_PACK_MIN = 100
+REF_NAME_FORBIDDEN = set(' ~^:?*[\\\x7f')
+
+
+def object_peel(repo, sha):
+    # Follow annotated tags down to the object they tag; None when sha is not a tag
+    peeled = None
+    while True:
+        try:
+            if GitObject.object_info(repo, sha)[0] != b'tag':
+                return peeled
+            data = GitObject.object_read_raw(repo, sha)[1]
+        except Exception:
+            return peeled  # Missing object
+        sha = peeled = kvlm_parse(data)[b'object'].decode("ascii")
+
+
+def ref_name_check(name):
+    """
+    Raise unless name is a valid ref name for an update: HEAD, or refs/...
+    without empty or dot-led components, '..', '@{', '.lock' ends or control characters
+    """
+    if name == 'HEAD':
+        return
+    components = name.split('/')
+    if (not name.startswith('refs/') or '..' in name or '@{' in name or name.endswith('.')
+            or any(c in REF_NAME_FORBIDDEN or c < ' ' for c in name)
+            or any(not c or c.startswith('.') or c.endswith('.lock') for c in components)):
+        raise Exception("Invalid ref name {0}".format(name))
+
+
+def lock_create(path):
+    """
+    Create path.lock, failing if it exists: whoever holds it is updating path.
+    Return the file descriptor
+    """
     try:
-        with open(repo.file(ref), 'r') as fp:
-            data = fp.read()[:-1]
-        if data.startswith("ref: "):
-            return ref_resolve(repo, data[5:])
-        else:
-            return data
-    except:
-        return data
-
-
-def ref_list(repo, path=None):
-    if not path:
-        path = repo.dir("refs")
-    ret = collections.OrderedDict()
-
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
-        else:
-            ret[f] = ref_resolve(repo, can)
-    
-    return ret
+        return os.open(path + '.lock', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        raise Exception("Unable to create '{0}.lock': File exists. Another process may be updating it.".format(path))
 
 
-def cmd_show_ref(args):
+def packed_refs_read(repo, packed):
+    """
+    Return a dict name -> (sha, peeled sha or None) of the refs in packed-refs,
+    peeling the refs the file has no peeled line for when it is not fully peeled
+    """
+    refs = {}
+    if packed is not None:
+        for name, sha, peeled in packed.entries():
+            refs[name] = (sha, peeled if peeled is not None or packed.peeledAll else object_peel(repo, sha))
+    return refs
+
+
+def packed_refs_serialize(refs):
+    out = bytearray(PACKED_REFS_HEADER)
+    for name in sorted(refs, key=lambda name: name.encode("utf-8", "surrogateescape")):
+        sha, peeled = refs[name]
+        out += "{0} {1}\n".format(sha, name).encode("utf-8", "surrogateescape")
+        if peeled is not None:
+            out += "^{0}\n".format(peeled).encode("ascii")
+    return bytes(out)
+
+
+def ref_dirs_prune(repo, path):
+    # Remove the directories a deleted loose ref leaves empty, keeping refs/heads, refs/tags...
+    refsDir = repo.path("refs")
+    dir = os.path.dirname(path)
+    while os.path.dirname(dir) != refsDir and dir.startswith(refsDir + os.sep):
+        try:
+            os.rmdir(dir)
+        except OSError:
+            break
+        dir = os.path.dirname(dir)
+
+
+def refs_pack(repo, all=False, prune=True):
+    """
+    Write packed-refs with every packed ref plus the loose tags (every loose ref
+    with all), then delete the loose files now packed unless prune is False.
+    Return the number of refs packed.
+    """
+    # packed-refs is locked before it is read, so that no update written in between is lost
+    path = repo.path("packed-refs")
+    fd = lock_create(path)
+    snapshot = GitRefSnapshot(repo)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            refs = packed_refs_read(repo, snapshot.packed_refs())
+            loose = {}
+            for name in snapshot.loose_names():
+                data = snapshot.loose_read(name)
+                if data is None or data.startswith("ref: "):
+                    continue  # Symbolic refs stay loose
+                if all or name.startswith("refs/tags/"):
+                    loose[name] = data
+                    refs[name] = (data, object_peel(repo, data))
+            f.write(packed_refs_serialize(refs))
+        snapshot.close()
+        os.replace(path + '.lock', path)
+    except BaseException:
+        snapshot.close()
+        os.remove(path + '.lock')
+        raise
+
+    if prune:
+        # Each loose file is removed under its own lock, and only if it still holds the packed value
+        for name, data in loose.items():
+            path = repo.path(name)
+            try:
+                os.close(lock_create(path))
+            except Exception:
+                continue  # Being updated: the loose file wins
+            try:
+                with open(path, 'r') as f:
+                    if f.read().strip() != data:
+                        continue  # Updated since it was read: the loose file wins
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            finally:
+                os.remove(path + '.lock')
+            ref_dirs_prune(repo, path)
+    ref_snapshot_reset(repo)
+    return len(refs)
+
+
+def cmd_pack_refs(args):
     repo = GitRepository.repo_find()
-    refs = ref_list(repo)
-    show_ref(repo, refs, prefix="refs")
+    refs_pack(repo, args.all, not args.no_prune)
+
+
+class GitRefTransaction(object):
+    """
+    A batch of ref updates applied all or nothing.
+    Each update gives the new value (NULL_SHA deletes the ref) and optionally
+    the expected old one (NULL_SHA: the ref must not exist). commit() locks
+    every ref, checks the old values, then writes them all; if anything fails
+    before the writes start, the locks are removed and no ref changes.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.updates = collections.OrderedDict()
+        """Ref name -> (new sha or None to only check it, expected old sha or None)"""
+
+    def update(self, name, new, old=None):
+        ref_name_check(name)
+        for sha in (new, old):
+            if sha is not None and (len(sha) != 40 or any(c not in '0123456789abcdef' for c in sha)):
+                raise Exception("Invalid object id {0} for {1}".format(sha, name))
+        if name in self.updates:
+            raise Exception("Multiple updates for ref {0} not allowed".format(name))
+        self.updates[name] = (new, old)
+
+    def create(self, name, new):
+        self.update(name, new, NULL_SHA)
+
+    def delete(self, name, old=None):
+        self.update(name, NULL_SHA, old)
+
+    def verify(self, name, old):
+        self.update(name, None, old)
+
+    def commit(self):
+        repo = self.repo
+        # Updates go to the ref a symbolic ref points to, as for HEAD
+        current = GitRefSnapshot(repo)
+        updates = collections.OrderedDict()
+        for name, update in self.updates.items():
+            for _ in range(SYMREF_MAX_DEPTH):
+                data = current.loose_read(name)
+                if data is None or not data.startswith("ref: "):
+                    break
+                name = data[5:]
+            if name in updates:
+                raise Exception("Multiple updates for ref {0} not allowed".format(name))
+            updates[name] = update
+
+        written = [name for name, (new, old) in updates.items() if new is not None]
+        bulk = sum(1 for name in written if updates[name][0] != NULL_SHA) >= TRANSACTION_PACK_MIN
+        locks = []
+        try:
+            for name in sorted(updates):
+                path = repo.path(name)
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                except OSError:
+                    raise Exception("Cannot lock ref {0}: a ref is in the way of its directory".format(name))
+                if os.path.isdir(path):
+                    raise Exception("Cannot lock ref {0}: there are refs under it".format(name))
+                fd = lock_create(path)
+                locks.append(path + '.lock')
+                new = updates[name][0]
+                with os.fdopen(fd, 'w') as f:
+                    if new is not None and new != NULL_SHA and not bulk:
+                        f.write(new + '\n')
+
+            # packed-refs is rewritten once: for a bulk update, or to drop deleted refs.
+            # It is locked before being read, so that nobody rewrites it in between
+            packedPath = repo.path("packed-refs")
+            deleted = [name for name in written if updates[name][0] == NULL_SHA]
+            packedLocked = bulk or bool(deleted)
+            if packedLocked:
+                os.close(lock_create(packedPath))
+                locks.append(packedPath + '.lock')
+
+            # Values read once every ref is locked cannot change before the commit
+            current = GitRefSnapshot(repo)
+            for name, (new, old) in updates.items():
+                value = current.resolve(name)
+                if old is not None and (value or NULL_SHA) != old:
+                    if old == NULL_SHA:
+                        raise Exception("Cannot lock ref {0}: reference already exists".format(name))
+                    raise Exception("Cannot lock ref {0}: is at {1} but expected {2}".format(name, value or NULL_SHA, old))
+
+            packed = current.packed_refs()
+            rewritePacked = bulk or (packed is not None and any(packed.find(name) for name in deleted))
+            if rewritePacked:
+                refs = packed_refs_read(repo, packed)
+                for name in deleted:
+                    refs.pop(name, None)
+                if bulk:
+                    for name in written:
+                        if updates[name][0] != NULL_SHA:
+                            refs[name] = (updates[name][0], object_peel(repo, updates[name][0]))
+                with open(packedPath + '.lock', 'wb') as f:
+                    f.write(packed_refs_serialize(refs))
+            elif packedLocked:
+                os.remove(packedPath + '.lock')
+                locks.remove(packedPath + '.lock')
+        except BaseException:
+            for lockPath in locks:
+                os.remove(lockPath)
+            current.close()
+            raise
 
+        # Commit: packed-refs first, so that dropping a loose file never uncovers a stale packed value
+        current.close()
+        if rewritePacked:
+            os.replace(packedPath + '.lock', packedPath)
+            locks.remove(packedPath + '.lock')
+        for name in sorted(updates):
+            new = updates[name][0]
+            path = repo.path(name)
+            if new is None:
+                os.remove(path + '.lock')
+            elif new == NULL_SHA or bulk:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.remove(path + '.lock')
+                if new == NULL_SHA:
+                    ref_dirs_prune(repo, path)
+            else:
+                os.replace(path + '.lock', path)
+        ref_snapshot_reset(repo)
 
-def show_ref(repo, refs, with_hash=True, prefix=""):
-    for k, v in refs.items():
-        if type(v) == str:
-            print("{0}{1}{2}".format(
-                v + " " if with_hash else "",
-                prefix + "/" if prefix else "",
-                k))
-        else:
-            show_ref(repo, v, with_hash=with_hash, prefix="{0}{1}{2}".format(prefix, "/" if prefix else "", k))
+
+def update_ref_value(repo, name):
+    # The object an update names, NULL_SHA for an empty or null value
+    if not name or name == NULL_SHA:
+        return NULL_SHA
+    return GitObject.object_find(repo, name)
+
+
+def update_ref_parse(repo, line):
+    """
+    Parse a line of "update-ref --stdin": "update <ref> <new> [<old>]",
+    "create <ref> <new>", "delete <ref> [<old>]" or "verify <ref> [<old>]".
+    Return (command, ref, new, old) with object names resolved, old None when not given
+    """
+    fields = line.split(' ')
+    command = fields[0]
+    argCounts = {'update': (2, 3), 'create': (2, 2), 'delete': (1, 2), 'verify': (1, 2)}
+    if command not in argCounts:
+        raise Exception("Unknown command: {0}".format(line))
+    low, high = argCounts[command]
+    if not low <= len(fields) - 1 <= high:
+        raise Exception("{0}: wrong number of arguments: {1}".format(command, line))
+
+    name = fields[1]
+    new = update_ref_value(repo, fields[2]) if command in ('update', 'create') else None
+    old = update_ref_value(repo, fields[-1]) if len(fields) - 1 > low else None
+    if command == 'verify' and old is None:
+        old = NULL_SHA  # Without a value the ref must not exist
+    return command, name, new, old
+
+
+def cmd_update_ref(args):
+    repo = GitRepository.repo_find()
+    transaction = GitRefTransaction(repo)
+    if args.stdin:
+        for line in sys.stdin.read().split('\n'):
+            if not line:
+                continue
+            command, name, new, old = update_ref_parse(repo, line)
+            if command == 'delete':
+                transaction.delete(name, old)
+            elif command == 'verify':
+                transaction.verify(name, old)
+            else:
+                transaction.update(name, new, NULL_SHA if command == 'create' else old)
+    elif args.delete:
+        if args.ref is None or args.newvalue is not None and args.oldvalue is not None:
+            raise Exception("usage: update-ref -d <ref> [<old>]")
+        transaction.delete(args.ref, None if args.newvalue is None else update_ref_value(repo, args.newvalue))
+    else:
+        if args.ref is None or args.newvalue is None:
+            raise Exception("usage: update-ref <ref> <new> [<old>]")
+        transaction.update(args.ref, update_ref_value(repo, args.newvalue),
+            None if args.oldvalue is None else update_ref_value(repo, args.oldvalue))
+    transaction.commit()
+
+
+def cmd_show_ref(args):
+    repo = GitRepository.repo_find()
+    snapshot = ref_snapshot(repo)
+    for name, sha in ref_list(repo):
+        print("{0} {1}".format(sha, name))
+        if args.dereference:
+            peeled = snapshot.peeled(name)
+            if peeled is not None:
+                print("{0} {1}^{{}}".format(peeled, name))
 
 
 class GitRefs():
@@ -96,48 +583,27 @@ def cmd_tag(args):
         # TODO: Need to pass in args.msg optionally into tag_create
         tag_create(repo, args.name, object_id, type="annotated" if args.create_tag_object else "lightweight", msg = args.msg)
     else:
-        refs = ref_list(repo)
-        show_ref(repo, refs["tags"], with_hash=False)
+        for name in tag_list(repo):
+            print(name)
 
 
 def tag_create(repo, name, object_id, type, msg=''):
     if type=="lightweight":
         # Create lightweight -- plain ref to a commit
-        # Create a file of given name at .git/refs/tags
-        path = repo.file('refs', 'tags', name)
-        with open(path, 'w') as f:
-            # Write commit id into file
-            f.write(object_id)
-        
+        sha = object_id
     elif type=="annotated": #git tag -a v1.0.0 -m "Releasing version v1.0.0"
         # Create new commit object with message (annotation)
-        # TODO: Pass in args.msg into GitTag.create
         annotatedTag = GitTag.create(repo, object_id, name, msg)
-        annotation_id = annotatedTag.object_write()
-        
-        # Create a file of given name at .git/refs/tags
-        path = repo.file('refs', 'tags', name)
-        with open(path, 'w') as f:
-            # Write commit id into file
-            f.write(annotation_id)
+        sha = annotatedTag.object_write()
     else:
-        raise('Unknown tag type')
-
-def tag_list(repo, path=None):
-    #git tag -l
-    #get in to ./git/refs/tags and read all the files and show
-    if not path:
-        path = repo.dir("tags")
-    ret = ''
-
-    for f in sorted(os.listdir(path)):
-        tag_file = os.path.join(path, f)
-        with open(tag_file, 'r') as fp:
-            data = fp.read()
-            ret += data+'\n'
-            print(data)
-    
-    return ret
-
-
-        
\ No newline at end of file
+        raise Exception('Unknown tag type {0}'.format(type))
+
+    # Create refs/tags/<name>, failing if the tag exists
+    transaction = GitRefTransaction(repo)
+    transaction.create('refs/tags/' + name, sha)
+    transaction.commit()
+
+
+def tag_list(repo):
+    # git tag -l: the names of the tags, without refs/tags/
+    return [name[len("refs/tags/"):] for name, sha in ref_list(repo, "refs/tags/")]
@@ -0,0 +1,309 @@
+#This file is the repack command.
+#repack collects every object reachable from the refs, the index and the
+#reflogs, picks delta bases
+#with a sliding window and writes them all into a single pack,
+#then removes the loose copies (and with -d the packs it replaced).
+#With -b it also writes the pack's reachability bitmap index.
+#repack -i only merges the loose objects and the packs under a size threshold
+#into one new pack, then rewrites the multi-pack-index over the packs left.
+import collections
+import os
+
+from libgitv.GitRepository import GitRepository
+from libgitv.GitObject import GitObject
+from libgitv.GitCommit import kvlm_parse
+from libgitv.GitTree import GitTree
+from libgitv.GitPack import pack_list, pack_reset, pack_write, delta_create, midx_write
+from libgitv.GitRefs import ref_resolve, ref_list, NULL_SHA
+from libgitv.GitIndex import GitIndex
+from libgitv.GitBitmap import bitmap_write
+import libgitv.util.StringHelpers as StringHelper
+
+
+DEFAULT_WINDOW = 10
+DEFAULT_DEPTH = 50
+# Objects bigger than this are stored whole, without searching for a delta
+DELTA_MAX_SIZE = 16 * 1024 * 1024
+# repack -i merges the packs smaller than this
+DEFAULT_BATCH_SIZE = 16 * 1024 * 1024
+
+TYPE_ORDER = {b'commit': 0, b'tree': 1, b'blob': 2, b'tag': 3}
+
+
+def name_hash(name):
+    # Same as git's pack_name_hash: the last characters of the path weigh
+    # the most, so files with the same name or extension sort together
+    hash = 0
+    for c in name:
+        if c in b' \t\n\r':
+            continue
+        hash = ((hash >> 2) + (c << 24)) & 0xffffffff
+    return hash
+
+
+def ref_roots(repo):
+    """
+    Return the SHAs pointed to by HEAD and every ref
+    """
+    roots = []
+    head = ref_resolve(repo, 'HEAD')
+    if head:
+        roots.append(head)
+    roots.extend(sha for name, sha in ref_list(repo))
+    return roots
+
+
+def index_roots(repo):
+    """
+    Return the SHAs the index refers to: the blob of every entry
+    and the tree of every valid cache-tree directory
+    """
+    index = GitIndex.read_index(repo)
+    roots = [entry.sha1.hex() for _, entry in index.entries.sorted_items() if entry.mode != 0o160000]
+    toVisit = [index.cacheTree] if index.cacheTree is not None else []
+    while toVisit:
+        node = toVisit.pop()
+        if node.valid():
+            roots.append(node.sha)
+        toVisit.extend(node.children.values())
+    return roots
+
+
+def reflog_roots(repo):
+    """
+    Return the old and new values recorded in the reflogs under .git/logs,
+    skipping the objects that no longer exist, as the reflog may name pruned ones
+    """
+    roots = collections.OrderedDict()
+    for dir, dirs, files in os.walk(repo.path("logs")):
+        for name in files:
+            with open(os.path.join(dir, name), 'rb') as f:
+                for line in f:
+                    for sha in line.split(b' ', 2)[:2]:
+                        sha = sha.decode("ascii", "replace")
+                        if len(sha) == 40 and sha != NULL_SHA:
+                            roots[sha] = None
+    ret = []
+    for sha in roots:
+        try:
+            GitObject.object_info(repo, sha)
+        except Exception:
+            continue
+        ret.append(sha)
+    return ret
+
+
+def objects_reachable(repo, roots):
+    """
+    Walk commits, trees and tags from roots.
+    Return an ordered dict sha -> (format, path name) of every reachable object
+    """
+    seen = {}
+    toVisit = [(sha, b'') for sha in reversed(roots)]
+    while toVisit:
+        sha, name = toVisit.pop()
+        if sha in seen:
+            continue
+        fmt, data = GitObject.object_read_raw(repo, sha)
+        seen[sha] = (fmt, name)
+
+        if fmt == b'commit':
+            kvlm = kvlm_parse(data)
+            parents = kvlm.get(b'parent', [])
+            if type(parents) != list:
+                parents = [parents]
+            for p in reversed(parents):
+                toVisit.append((p.decode("ascii"), b''))
+            toVisit.append((kvlm[b'tree'].decode("ascii"), b''))
+        elif fmt == b'tree':
+            for item in reversed(GitTree.parse(data)):
+                if item.mode == b'160000':
+                    continue  # Submodule commits live in another repository
+                toVisit.append((item.sha, item.path))
+        elif fmt == b'tag':
+            toVisit.append((kvlm_parse(data)[b'object'].decode("ascii"), b''))
+    return seen
+
+
+def delta_search(repo, objects, window=DEFAULT_WINDOW, depth=DEFAULT_DEPTH):
+    """
+    Sort objects by type, name hash and decreasing size, then try each
+    object against the previous window objects of the same type.
+    Return a dict sha -> (base sha, delta) for objects worth storing as deltas
+    """
+    sizes = {}
+    for sha, (fmt, name) in objects.items():
+        sizes[sha] = GitObject.object_info(repo, sha)[1]
+    order = sorted(objects, key=lambda sha: (TYPE_ORDER[objects[sha][0]], name_hash(objects[sha][1]), -sizes[sha]))
+
+    deltas = {}
+    depths = {}
+    candidates = []  # (sha, data) of the last window objects
+    for sha in order:
+        fmt = objects[sha][0]
+        if sizes[sha] > DELTA_MAX_SIZE:
+            candidates = []
+            continue
+        data = GitObject.object_read_raw(repo, sha)[1]
+
+        best = None
+        for baseSha, baseData in candidates:
+            if objects[baseSha][0] != fmt or depths.get(baseSha, 0) >= depth:
+                continue
+            # A base much smaller than the target will not give a useful delta
+            if len(baseData) < len(data) // 4:
+                continue
+            delta = delta_create(baseData, data)
+            limit = len(data) // 2 if best is None else len(best[1])
+            if len(delta) < limit:
+                best = (baseSha, delta)
+
+        if best is not None:
+            deltas[sha] = best
+            depths[sha] = depths.get(best[0], 0) + 1
+
+        candidates.append((sha, data))
+        if len(candidates) > window:
+            candidates.pop(0)
+    return deltas
+
+
+def pack_objects(repo, objects, deltas):
+    """
+    Yield (sha, format, data, base) with every delta base before its deltas,
+    in the order the objects were reached
+    """
+    written = set()
+    for sha in objects:
+        chain = []
+        while sha not in written:
+            chain.append(sha)
+            if sha not in deltas:
+                break
+            sha = deltas[sha][0]
+
+        for sha in reversed(chain):
+            written.add(sha)
+            fmt = objects[sha][0]
+            if sha in deltas:
+                yield sha, fmt, deltas[sha][1], deltas[sha][0]
+            else:
+                yield sha, fmt, GitObject.object_read_raw(repo, sha)[1], None
+
+
+def loose_objects(repo):
+    """
+    Return the SHAs of the loose objects
+    """
+    shas = []
+    objectsDir = repo.dir("objects")
+    for prefix in sorted(os.listdir(objectsDir)):
+        dir = os.path.join(objectsDir, prefix)
+        if len(prefix) == 2 and os.path.isdir(dir):
+            shas.extend(prefix + f for f in sorted(os.listdir(dir)) if len(f) == 38)
+    return shas
+
+
+def loose_prune(repo, objects):
+    # Remove the loose copies of objects, now packed, and the directories left empty
+    for sha in objects:
+        loose = repo.file("objects", sha[:2], sha[2:])
+        if loose and os.path.exists(loose):
+            os.remove(loose)
+    for prefix in os.listdir(repo.dir("objects")):
+        dir = repo.path("objects", prefix)
+        if len(prefix) == 2 and os.path.isdir(dir) and not os.listdir(dir):
+            os.rmdir(dir)
+
+
+def packs_delete(oldPacks, keep):
+    # Remove the packs at oldPacks but keep, with their index, bitmap and reverse index
+    for old in oldPacks:
+        if old == keep:
+            continue
+        for ext in ('.pack', '.idx', '.bitmap', '.rev'):
+            oldPath = old[:-len('.pack')] + ext
+            if os.path.exists(oldPath):
+                os.remove(oldPath)
+
+
+def repack(repo, window=DEFAULT_WINDOW, depth=DEFAULT_DEPTH, delete_old=False, write_bitmap=False):
+    roots = ref_roots(repo)
+    # Objects only the index or a reflog needs must survive the deletion of the old packs too
+    objects = objects_reachable(repo, roots + index_roots(repo) + reflog_roots(repo))
+    if not objects:
+        return None
+    deltas = delta_search(repo, objects, window, depth)
+
+    oldPacks = [pack.path for pack in pack_list(repo)]
+    path = pack_write(repo, pack_objects(repo, objects, deltas), len(objects))
+    pack_reset(repo)
+    if write_bitmap:
+        bitmap_write(repo, path, objects, roots)
+
+    loose_prune(repo, objects)
+    if delete_old:
+        packs_delete(oldPacks, path)
+        pack_reset(repo)
+    if os.path.exists(repo.path("objects", "pack", "multi-pack-index")):
+        midx_write(repo)
+
+    return path, len(objects), len(deltas)
+
+
+def repack_incremental(repo, batch_size=DEFAULT_BATCH_SIZE, window=DEFAULT_WINDOW, depth=DEFAULT_DEPTH):
+    """
+    Pack the loose objects and the objects of every pack smaller than batch_size
+    into one pack, reachable or not, leaving the bigger packs alone.
+    Then write the multi-pack-index of the packs left.
+    Return (path, object count, delta count) as repack, or None when there was nothing to merge.
+    """
+    small = [pack for pack in pack_list(repo) if os.path.getsize(pack.path) < batch_size]
+    loose = loose_objects(repo)
+    if not loose and len(small) < 2:
+        return None
+
+    objects = collections.OrderedDict()
+    for pack in small:
+        for sha in pack.index.shas():
+            objects[sha] = None
+    for sha in loose:
+        objects[sha] = None
+    for sha in objects:
+        objects[sha] = (GitObject.object_info(repo, sha)[0], b'')
+    # Objects of a type together, in the order they were found
+    objects = collections.OrderedDict(sorted(objects.items(), key=lambda item: TYPE_ORDER[item[1][0]]))
+    deltas = delta_search(repo, objects, window, depth)
+
+    path = pack_write(repo, pack_objects(repo, objects, deltas), len(objects))
+    pack_reset(repo)
+    loose_prune(repo, objects)
+    packs_delete([pack.path for pack in small], path)
+    pack_reset(repo)
+    midx_write(repo)
+    return path, len(objects), len(deltas)
+
+
+def cmd_repack(args):
+    repo = GitRepository.repo_find()
+    if args.incremental:
+        batchSize = StringHelper.toSize(args.batch_size) if args.batch_size else DEFAULT_BATCH_SIZE
+        ret = repack_incremental(repo, batchSize, args.window, args.depth)
+    else:
+        writeBitmap = args.write_bitmap_index or repo.conf.getboolean("repack", "writeBitmaps", fallback=False)
+        ret = repack(repo, args.window, args.depth, args.delete, writeBitmap)
+    if ret is None:
+        print("Nothing new to pack.")
+    else:
+        path, count, deltas = ret
+        print("Packed {0} objects ({1} deltas) into {2}".format(count, deltas, os.path.basename(path)))
+
+
+def cmd_multi_pack_index(args):
+    repo = GitRepository.repo_find()
+    if args.action == 'write':
+        count = midx_write(repo)
+        if count is None:
+            print("No packs to index")
+        else:
+            print("Wrote multi-pack-index of {0} objects in {1} packs".format(count, len(pack_list(repo))))
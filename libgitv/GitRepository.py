@@ -1,6 +1,9 @@
 from configparser import ConfigParser  # Read/Write configuration files in Microsoft INI format
 import os  # Provide filesystem abstraction routines
 
+from libgitv.GitObjectCache import GitObjectCache, DEFAULT_CACHE_SIZE
+import libgitv.util.StringHelpers as StringHelper
+
 
 # Supported repositoryformatversions. Only 0 for now
 SUPPORTED_REPO_FORMAT_VERS = (0,)
@@ -17,6 +20,12 @@ class GitRepository(object):
     worktree = None
     gitdir = None
     conf = None 
+    packs = None
+    multiPackIndex = None
+    looseNames = None
+    commitGraph = None
+    refs = None
+    objectCache = None
     
     def __init__(repo, path, force=False):
         repo.worktree = path
@@ -38,6 +47,10 @@ class GitRepository(object):
             vers = int(repo.conf.get("core", "repositoryformatversion"))
             if vers not in SUPPORTED_REPO_FORMAT_VERS:
                 raise Exception("Unsupported repositoryformatversion %s" % vers)
+
+        # Objects read through this repository are cached, core.objectCacheSize bytes at most
+        cacheSize = repo.conf.get("core", "objectCacheSize", fallback=None)
+        repo.objectCache = GitObjectCache(StringHelper.toSize(cacheSize) if cacheSize else DEFAULT_CACHE_SIZE)
     
     
     def path(repo, *path):
@@ -59,7 +72,7 @@ class GitRepository(object):
                 raise Exception("Not a directory: %s" % path)
         
         if mkdir:
-            os.makedirs(path)
+            os.makedirs(path, exist_ok=True)  # Another thread may create it concurrently
             return path
         else:
             return None
@@ -0,0 +1,68 @@
+#This file is the rev-list command and the reachable object queries.
+#With a bitmap index the objects reachable from a set of commits are the OR of
+#the bitmaps of the nearest selected commits and the objects of the commits walked
+#to reach them: counting them is a popcount instead of a walk of every tree.
+from libgitv.GitRepository import GitRepository
+from libgitv.GitObject import GitObject
+from libgitv.GitBitmap import bitmap_reachable
+from libgitv.GitRepack import objects_reachable, ref_roots
+from libgitv.GitRevWalk import rev_walk
+from libgitv.GitAbbrev import abbrev
+from libgitv.util.Ewah import bit_positions
+
+
+def rev_list_objects(repo, roots, useBitmap=True):
+    """
+    Return a dict sha -> format of every object reachable from roots,
+    from the bitmap index when there is one, else walking every commit and tree
+    """
+    ret = bitmap_reachable(repo, roots) if useBitmap else None
+    if ret is None:
+        return {sha: fmt for sha, (fmt, _) in objects_reachable(repo, roots).items()}
+    index, bits, extra = ret
+    objects = {}
+    for fmt, typeBits in index.types.items():
+        for pos in bit_positions(bits & typeBits):
+            objects[index.sha_at(pos)] = fmt
+    objects.update(extra)
+    return objects
+
+
+def rev_list_count(repo, roots, useBitmap=True, fmt=None):
+    """
+    Return the number of objects reachable from roots, only those of format fmt if given.
+    With a bitmap index no object is listed: the bits are counted.
+    """
+    ret = bitmap_reachable(repo, roots) if useBitmap else None
+    if ret is None:
+        return sum(1 for f in rev_list_objects(repo, roots, False).values() if fmt is None or f == fmt)
+    index, bits, extra = ret
+    if fmt is not None:
+        bits &= index.types[fmt]
+    return bits.bit_count() + sum(1 for f in extra.values() if fmt is None or f == fmt)
+
+
+def cmd_rev_list(args):
+    repo = GitRepository.repo_find()
+    roots = [GitObject.object_find(repo, name) for name in args.commits]
+    if args.all:
+        roots += ref_roots(repo)
+    if not roots:
+        raise Exception("rev-list needs at least one commit")
+
+    if args.count:
+        print(rev_list_count(repo, roots, args.use_bitmap_index, None if args.objects else b'commit'))
+        return
+    if not args.use_bitmap_index:
+        # Commits newest first, as log shows them
+        commits = [GitObject.object_find(repo, sha, b'commit') for sha in roots]
+        commits = list(rev_walk(repo, [sha for sha in commits if sha is not None]))
+        objects = [sha for sha, fmt in rev_list_objects(repo, roots, False).items() if fmt != b'commit'] if args.objects else []
+    else:
+        listed = rev_list_objects(repo, roots)
+        commits = [sha for sha, fmt in listed.items() if fmt == b'commit']
+        objects = [sha for sha, fmt in listed.items() if fmt != b'commit'] if args.objects else []
+    if args.abbrev_commit:
+        commits = abbrev(repo, commits, args.abbrev)
+    for sha in commits + objects:
+        print(sha)
@@ -0,0 +1,125 @@
+#This file is the revision walker and the log command.
+#Commits come out one at a time, newest first, from a priority queue keyed
+#on the committer date, so "log -n 20" only reads the commits it shows and
+#their parents. Parents and dates come from the commit-graph when it has the commit.
+import heapq
+import itertools
+from datetime import datetime
+
+from libgitv.GitRepository import GitRepository
+from libgitv.GitObject import GitObject
+from libgitv.GitCommitGraph import commit_graph, commit_parse, GENERATION_INFINITY
+import libgitv.util.StringHelpers as StringHelper
+
+
+class GitRevWalk(object):
+    def __init__(self, repo):
+        self.repo = repo
+        self.graph = commit_graph(repo)
+        self.positions = {}
+        """Commit-graph positions of the parents seen so far, saving their binary search"""
+
+    def commit_info(self, sha):
+        """
+        Return (parent SHAs, generation, commit date) of a commit
+        """
+        graph = self.graph
+        if graph is not None:
+            i = self.positions.pop(sha, None)
+            if i is None:
+                i = graph.find(sha)
+            if i is not None:
+                parents, generation, date = graph.commit_at(i)
+                parentShas = [graph.sha_at(p) for p in parents]
+                self.positions.update(zip(parentShas, parents))
+                return parentShas, generation, date
+        tree, parents, date = commit_parse(self.repo, sha)
+        return parents, GENERATION_INFINITY, date
+
+    def date_order(self, starts, since=None, firstParent=False):
+        """
+        Yield (sha, parent SHAs, commit date) of the commits reachable from starts,
+        newest first; commits of equal dates come in the order they were reached.
+        The walk stops at the first commit older than since: all the others are older still.
+        """
+        queue = []
+        counter = itertools.count()
+        seen = set()
+
+        def push(sha):
+            if sha in seen:
+                return
+            seen.add(sha)
+            parents, generation, date = self.commit_info(sha)
+            if firstParent:
+                parents = parents[:1]
+            heapq.heappush(queue, (-date, next(counter), sha, parents))
+
+        for sha in starts:
+            push(sha)
+        while queue:
+            negDate, _, sha, parents = heapq.heappop(queue)
+            if since is not None and -negDate < since:
+                return
+            for parent in parents:
+                push(parent)
+            yield sha, parents, -negDate
+
+    def topo_order(self, commits):
+        """
+        Reorder (sha, parents, date) so that no commit comes before all its children,
+        as git does: tips in date order, then a depth first walk following each
+        line of history to its end. This needs the whole walk first.
+        """
+        commits = list(commits)
+        indegree = {sha: 1 for sha, _, _ in commits}
+        for sha, parents, _ in commits:
+            for parent in parents:
+                if parent in indegree:
+                    indegree[parent] += 1
+        byName = {commit[0]: commit for commit in commits}
+
+        stack = [commit for commit in commits if indegree[commit[0]] == 1]
+        stack.reverse()
+        while stack:
+            commit = stack.pop()
+            for parent in commit[1]:
+                if parent not in indegree:
+                    continue  # Not part of the walk, e.g. older than since
+                indegree[parent] -= 1
+                if indegree[parent] == 1:
+                    stack.append(byName[parent])
+            yield commit
+
+
+def rev_walk(repo, starts, maxCount=None, since=None, until=None, firstParent=False, topoOrder=False):
+    """
+    Yield the SHAs of the commits reachable from starts, newest first (or in
+    topological order), lazily: only the commits needed so far are read.
+    since and until are Unix timestamps bounding the commit dates shown.
+    """
+    walker = GitRevWalk(repo)
+    commits = walker.date_order(starts, since, firstParent)
+    if topoOrder:
+        commits = walker.topo_order(commits)
+    shas = (sha for sha, _, date in commits if until is None or date <= until)
+    return itertools.islice(shas, maxCount)
+
+
+def log_print(repo, sha):
+    commit = GitObject.object_read(repo, sha)
+    assert(commit.format==b'commit')
+    print('commit: {0}'.format(sha))
+    arrAuthor = commit.kvlm[b'author'].decode("utf-8", "replace").split(' ')
+    commitDate = datetime.fromtimestamp(int(arrAuthor[-2]))
+    print('Author: {0} {1}\nDate: {2} {3}\n'.format(' '.join(arrAuthor[:-3]), arrAuthor[-3], commitDate.ctime(), arrAuthor[-1]))
+    print('\t{0}'.format(commit.kvlm[b''].decode("utf-8", "replace").rstrip('\n').replace('\n', '\n\t')))
+
+
+def cmd_log(args):
+    repo = GitRepository.repo_find()
+    since = StringHelper.toTimestamp(args.since) if args.since else None
+    until = StringHelper.toTimestamp(args.until) if args.until else None
+    start = GitObject.object_find(repo, args.commit, b'commit')
+    for sha in rev_walk(repo, [start], args.max_count, since, until, args.first_parent, args.topo_order):
+        log_print(repo, sha)
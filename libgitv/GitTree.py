@@ -1,8 +1,10 @@
 import os  # Provide filesystem abstraction routines
 from queue import SimpleQueue  # Queue data structrue
+from concurrent.futures import ThreadPoolExecutor  # Worker pool for blob writes
 
 from libgitv.GitRepository import GitRepository
 from libgitv.GitObject import GitObject
+from libgitv.GitPack import pack_list
 
 
 # Tree Leaf - A singular record
@@ -41,7 +43,7 @@ class GitTree(GitObject):
         path = raw[x+1:y]
         
         # Read SHA and convert to hex string
-        sha = hex(int.from_bytes(raw[y+1:y+21], "big"))[2:]  # Remove '0x' added by hex()
+        sha = raw[y+1:y+21].hex()  # Keep leading zeros, unlike hex(int)
         
         return y+21, GitTreeLeaf(mode, path, sha)
     
@@ -56,22 +58,70 @@ class GitTree(GitObject):
         return ret
     
     
-    def checkout(repo, tree, path):
+    def checkout(repo, tree, path, jobs=None):
+        # Plan: walk every tree first, collecting directories in creation
+        # order (parents before children) and the blobs to write
+        dirs = []
+        blobs = []
         toVisit = SimpleQueue()
         toVisit.put((tree, path))  # Insert root node in list of nodes to visit
         
         while not toVisit.empty():
             tree, path = toVisit.get()
             for item in tree.items:
-                obj = GitObject.object_read(repo, item.sha)
                 dest = os.path.join(path, item.path)
 
-                if obj.format == b'tree':
-                    os.makedirs(dest, exist_ok=True)
-                    toVisit.put((obj, dest))  # Add subtree to list of nodes to visit
-                elif obj.format == b'blob':
-                    with open(dest, 'wb') as f:
-                        f.write(obj.blobdata)  # Write blob objects of tree
+                if item.mode == b'160000':
+                    dirs.append(dest)  # Submodule: only its directory belongs to us
+                    continue
+                fmt, _ = GitObject.object_info(repo, item.sha)
+                if fmt == b'tree':
+                    dirs.append(dest)
+                    toVisit.put((GitObject.object_read(repo, item.sha), dest))  # Add subtree to list of nodes to visit
+                elif fmt == b'blob':
+                    blobs.append((item.sha, dest))
+
+        for dest in dirs:
+            os.makedirs(dest, exist_ok=True)
+
+        if jobs is None:
+            jobs = checkout_jobs(repo)
+        pack_list(repo)  # Open the packs once, before the workers share them
+
+        # Inflate and write blobs in parallel, zlib releases the GIL
+        errors = []
+        if jobs <= 1:
+            for sha, dest in blobs:
+                try:
+                    checkout_blob(repo, sha, dest)
+                except Exception as e:
+                    errors.append((dest, e))
+        else:
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [(dest, pool.submit(checkout_blob, repo, sha, dest)) for sha, dest in blobs]
+                # Report in plan order, whatever order the workers finished in
+                for dest, future in futures:
+                    e = future.exception()
+                    if e is not None:
+                        errors.append((dest, e))
+
+        if errors:
+            raise Exception("Checkout failed for {0} file(s):\n - {1}".format(len(errors),
+                "\n - ".join("{0}: {1}".format(os.fsdecode(dest), e) for dest, e in errors)))
+
+
+def checkout_jobs(repo):
+    # checkout.workers in .git/config, else one worker per core
+    jobs = repo.conf.getint("checkout", "workers", fallback=0)
+    return jobs if jobs > 0 else (os.cpu_count() or 1)
+
+
+def checkout_blob(repo, sha, dest):
+    # Stream the blob to disk, a chunk at a time
+    fmt, size, chunks = GitObject.object_stream(repo, sha)
+    with open(dest, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)  # Write blob objects of tree
         
 
 def cmd_ls_tree(args):
@@ -82,7 +132,7 @@ def cmd_ls_tree(args):
         print("{0} {1} {2}\t{3}".format(
             "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
             # Git's ls-tree displays the type of the object pointed to.  We can do that too :)
-            GitObject.object_read(repo, item.sha).format.decode("ascii"),
+            GitObject.object_info(repo, item.sha)[0].decode("ascii"),
             item.sha,
             item.path.decode("ascii")))
 
@@ -101,4 +151,4 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path, exist_ok=True)
 
-    GitTree.checkout(repo, obj, os.path.realpath(args.path).encode())
\ No newline at end of file
+    GitTree.checkout(repo, obj, os.path.realpath(args.path).encode(), jobs=args.jobs)
\ No newline at end of file
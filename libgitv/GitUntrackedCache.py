@@ -0,0 +1,184 @@
+#This file is the untracked cache, stored in the UNTR extension of the index.
+#For every directory of the worktree it remembers the stat data of the
+#directory, the hash of its .gitignore and the untracked files found in it.
+#While neither changes, status reuses the list instead of reading the directory.
+import platform
+import struct
+
+from libgitv.util.Ewah import ewah_serialize, ewah_deserialize, bit_positions
+from libgitv.util.Varint import varint_encode, varint_decode
+
+
+EMPTY_BLOB_SHA = bytes.fromhex('e69de29bb2d1d6434b8b29ae775ad8c2e48c5391')
+NULL_SHA = b'\x00' * 20
+STAT_FORMAT = '!9L'  # ctime s/ns, mtime s/ns, dev, ino, uid, gid, size
+STAT_SIZE = 36
+NULL_STAT = (0,) * 9
+
+# Flags of git's dir_struct the cache was built with. This is one git never
+# sets, so that git does not use a cache built with our ignore rules (and we
+# rebuild one built with git's).
+UNTRACKED_CACHE_FLAGS = 0x80000000
+
+
+def stat_data(st):
+    return tuple(v & 0xFFFFFFFF for v in (st.st_ctime_ns // 1000000000, st.st_ctime_ns % 1000000000,
+        st.st_mtime_ns // 1000000000, st.st_mtime_ns % 1000000000,
+        st.st_dev, st.st_ino, st.st_uid, st.st_gid, st.st_size))
+
+
+def cache_ident(repo):
+    # The cache only holds for this worktree location on this system
+    return ("Location %s, system %s" % (repo.worktree, platform.system())).encode("utf-8", "surrogateescape") + b'\x00'
+
+
+class GitUntrackedDir(object):
+    def __init__(self, name=b''):
+        self.name = name
+        self.untracked = []
+        """Names of the untracked files directly in this directory"""
+        self.children = {}
+        """Subdirectory blocks, by name"""
+        self.valid = False
+        self.checkOnly = False
+        self.stat = NULL_STAT
+        """Stat data of the directory when untracked was computed"""
+        self.sha = NULL_SHA
+        """Blob id of the directory's .gitignore (of the empty blob when missing)"""
+
+
+class GitUntrackedCache(object):
+    def __init__(self, repo):
+        self.ident = cache_ident(repo)
+        self.excludeStat = NULL_STAT
+        self.excludesFileStat = NULL_STAT
+        self.flags = UNTRACKED_CACHE_FLAGS
+        self.excludeSha = NULL_SHA
+        self.excludesFileSha = NULL_SHA
+        self.perDir = b'.gitignore'
+        self.root = GitUntrackedDir()
+
+    def parse(repo, data):
+        """
+        Parse an UNTR extension. Return None when it was built for another
+        worktree or with other flags: it must then be rebuilt from scratch.
+        """
+        pos, identLen = varint_decode(data, 0)
+        ident = data[pos:pos+identLen]
+        pos += identLen
+        cache = GitUntrackedCache(repo)
+        if ident != cache.ident:
+            return None
+
+        cache.excludeStat = struct.unpack_from(STAT_FORMAT, data, pos)
+        cache.excludesFileStat = struct.unpack_from(STAT_FORMAT, data, pos + STAT_SIZE)
+        cache.flags, = struct.unpack_from('!L', data, pos + 2 * STAT_SIZE)
+        pos += 2 * STAT_SIZE + 4
+        if cache.flags != UNTRACKED_CACHE_FLAGS:
+            return None
+        cache.excludeSha = data[pos:pos+20]
+        cache.excludesFileSha = data[pos+20:pos+40]
+        pos += 40
+        end = data.index(b'\x00', pos)
+        cache.perDir = data[pos:end]
+        pos = end + 1
+
+        pos, count = varint_decode(data, pos)
+        if count == 0:
+            return cache
+
+        # Directory blocks, depth first
+        dirs = []
+
+        def parse_dir(pos):
+            pos, untrackedCount = varint_decode(data, pos)
+            pos, childCount = varint_decode(data, pos)
+            end = data.index(b'\x00', pos)
+            node = GitUntrackedDir(data[pos:end])
+            pos = end + 1
+            dirs.append(node)
+            for i in range(untrackedCount):
+                end = data.index(b'\x00', pos)
+                node.untracked.append(data[pos:end])
+                pos = end + 1
+            for i in range(childCount):
+                pos, child = parse_dir(pos)
+                node.children[child.name] = child
+            return pos, node
+
+        pos, cache.root = parse_dir(pos)
+
+        pos, valid, _ = ewah_deserialize(data, pos)
+        pos, checkOnly, _ = ewah_deserialize(data, pos)
+        pos, shaValid, _ = ewah_deserialize(data, pos)
+        for i in bit_positions(checkOnly):
+            dirs[i].checkOnly = True
+        # Stat data of the valid directories, then the ids of the .gitignore files
+        for i in bit_positions(valid):
+            dirs[i].valid = True
+            dirs[i].stat = struct.unpack_from(STAT_FORMAT, data, pos)
+            pos += STAT_SIZE
+        for i in bit_positions(shaValid):
+            dirs[i].sha = data[pos:pos+20]
+            pos += 20
+        return cache
+
+    def serialize(self):
+        out = bytearray(varint_encode(len(self.ident)) + self.ident)
+        out += struct.pack(STAT_FORMAT, *self.excludeStat)
+        out += struct.pack(STAT_FORMAT, *self.excludesFileStat)
+        out += struct.pack('!L', self.flags)
+        out += self.excludeSha + self.excludesFileSha
+        out += self.perDir + b'\x00'
+
+        # Flatten the directories depth first, as the bitmaps index them
+        dirs = []
+        toVisit = [self.root]
+        while toVisit:
+            node = toVisit.pop()
+            dirs.append(node)
+            toVisit.extend(reversed(list(node.children.values())))
+
+        out += varint_encode(len(dirs))
+        valid = checkOnly = shaValid = 0
+        stats = bytearray()
+        shas = bytearray()
+        for i, node in enumerate(dirs):
+            out += varint_encode(len(node.untracked)) + varint_encode(len(node.children))
+            out += node.name + b'\x00'
+            for name in node.untracked:
+                out += name + b'\x00'
+            if node.valid:
+                valid |= 1 << i
+                stats += struct.pack(STAT_FORMAT, *node.stat)
+            if node.checkOnly:
+                checkOnly |= 1 << i
+            if node.sha != NULL_SHA:
+                shaValid |= 1 << i
+                shas += node.sha
+
+        out += ewah_serialize(valid)
+        out += ewah_serialize(checkOnly)
+        out += ewah_serialize(shaValid)
+        out += stats + shas
+        out += b'\x00'
+        return bytes(out)
+
+    def invalidate(self, path):
+        """
+        Forget the untracked files of the directory holding path (bytes),
+        called when a path enters or leaves the index
+        """
+        node = self.root
+        for name in path.split(b'/')[:-1]:
+            node = node.children.get(name)
+            if node is None:
+                return
+        node.valid = False
+
+    def check_excludes(self, excludeStat, excludeSha, excludesFileStat, excludesFileSha):
+        # Global exclude files changed: nothing cached can be trusted
+        if (excludeSha, excludesFileSha) != (self.excludeSha, self.excludesFileSha):
+            self.root = GitUntrackedDir()
+        self.excludeStat, self.excludeSha = excludeStat, excludeSha
+        self.excludesFileStat, self.excludesFileSha = excludesFileStat, excludesFileSha
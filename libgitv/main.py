@@ -2,10 +2,17 @@ import argparse  # Parse command line arguments
 import sys  # Provide access to command-line arguments 
 # Import cmd handler functions from gitv library files
 from libgitv.GitRepository import cmd_init
-from libgitv.GitObject import cmd_cat_file, cmd_hash_object, cmd_log, cmd_rev_parse
+from libgitv.GitObject import cmd_cat_file, cmd_hash_object, cmd_rev_parse
+from libgitv.GitRevWalk import cmd_log
+from libgitv.GitMergeBase import cmd_merge_base
 from libgitv.GitTree import cmd_ls_tree, cmd_checkout
-from libgitv.GitRefs import cmd_show_ref, cmd_tag
-from libgitv.GitIndex import cmd_ls_files, cmd_status, cmd_add
+from libgitv.GitRefs import cmd_show_ref, cmd_tag, cmd_pack_refs, cmd_update_ref
+from libgitv.GitIndex import cmd_ls_files, cmd_status, cmd_add, cmd_write_tree
+from libgitv.GitRepack import cmd_repack, cmd_multi_pack_index
+from libgitv.GitCommitGraph import cmd_commit_graph
+from libgitv.GitRevList import cmd_rev_list
+from libgitv.GitDiff import cmd_diff_tree
+from libgitv.GitFsmonitor import cmd_fsmonitor_daemon
 
 argparser = argparse.ArgumentParser(description="Content tracker")
 argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
@@ -27,12 +34,29 @@ argsp.add_argument("path",
 
 # cat-file prints the content of an object
 argsp = argsubparsers.add_parser("cat-file", help = "Provide content of repository objects")
+argsp.add_argument("-t",
+   dest="show_type",
+   action="store_true",
+   help="Show the object type instead of its content.")
+argsp.add_argument("-s",
+   dest="show_size",
+   action="store_true",
+   help="Show the object size instead of its content.")
+argsp.add_argument("--batch",
+   dest="batch",
+   action="store_true",
+   help="Print type, size and content of each object named on stdin.")
+argsp.add_argument("--batch-check",
+   dest="batch_check",
+   action="store_true",
+   help="Print type and size of each object named on stdin.")
 argsp.add_argument("type",
    metavar="type",
-   choices=["blob", "commit", "tag", "tree"],
-   help="Specify the type.")
+   nargs="?",
+   help="Specify the type (blob, commit, tag or tree).")
 argsp.add_argument("object",
    metavar = "object",
+   nargs="?",
    help = "The object to display.")
 
 
@@ -59,6 +83,31 @@ argsp.add_argument("path",
 # log prints commit history of a given commit (defaulting to HEAD)
 argsp = argsubparsers.add_parser("log", help = "Display history of the given commit.")
 argsp.add_argument("commit", default= "HEAD", nargs="?", help = "Commit to start at.")
+argsp.add_argument("-n", "--max-count",
+   type=int,
+   default=None,
+   help="Show at most this many commits.")
+argsp.add_argument("--since",
+   help="Show commits more recent than a date (timestamp, ISO date or \"2 weeks ago\").")
+argsp.add_argument("--until",
+   help="Show commits older than a date.")
+argsp.add_argument("--first-parent",
+   action="store_true",
+   help="Follow only the first parent of merge commits.")
+argsp.add_argument("--topo-order",
+   action="store_true",
+   help="Show no parent before all its children.")
+
+
+# merge-base finds the best common ancestors of commits
+argsp = argsubparsers.add_parser("merge-base", help="Find as good common ancestors as possible for a merge")
+argsp.add_argument("-a", "--all",
+   action="store_true",
+   help="Output all merge bases instead of the first one.")
+argsp.add_argument("--is-ancestor",
+   action="store_true",
+   help="Exit with status 0 if the first commit is an ancestor of the second, 1 otherwise.")
+argsp.add_argument("commits", nargs="+", help="The commits; with more than two, the merge bases of the first and a merge of the others.")
 
 
 # ls-tree pretty prints a tree object
@@ -70,10 +119,50 @@ argsp.add_argument("object", help="The object to show.")
 argsp = argsubparsers.add_parser("checkout", help="Checkout a commit inside of a directory.")
 argsp.add_argument("commit",  help="The commit or tree to checkout.")
 argsp.add_argument("path", help="The EMPTY directory to checkout on.")
+argsp.add_argument("-j", "--jobs",
+   type=int,
+   default=None,
+   help="Number of parallel workers writing files (default: checkout.workers or one per core).")
+
+
+# diff-tree compares two trees, or a commit with its parents
+argsp = argsubparsers.add_parser("diff-tree", help="Compare the content and mode of the blobs of two trees")
+argsp.add_argument("-r",
+   dest="recursive",
+   action="store_true",
+   help="Recurse into subtrees")
+argsp.add_argument("--name-only",
+   action="store_true",
+   help="Only show the names of the changed files")
+argsp.add_argument("--name-status",
+   action="store_true",
+   help="Only show the status and names of the changed files")
+argsp.add_argument("--root",
+   action="store_true",
+   help="Show a root commit as adding every file")
+argsp.add_argument("-m",
+   action="store_true",
+   help="Compare a merge commit with each of its parents; merges are not shown without it")
+argsp.add_argument("trees",
+   nargs="+",
+   help="Two trees or commits, or one commit to compare with its parent")
 
 
 # show-ref lists references
 argsp = argsubparsers.add_parser("show-ref", help="List references.")
+argsp.add_argument("-d", "--dereference",
+   action="store_true",
+   help="Also show the object each annotated tag points to, as <tag>^{}")
+
+
+# pack-refs moves loose refs into the packed-refs file
+argsp = argsubparsers.add_parser("pack-refs", help="Pack refs into the packed-refs file")
+argsp.add_argument("--all",
+   action="store_true",
+   help="Pack every ref, not only the tags and the refs already packed")
+argsp.add_argument("--no-prune",
+   action="store_true",
+   help="Keep the loose files of the refs packed")
 
 
 # tag creates a new tag or lists existing tags
@@ -85,6 +174,20 @@ argsp.add_argument("-m", action="store", dest="msg", default="", help="Follows t
 argsp.add_argument("-l", action="store_true", dest="list", help="Lists all the tags.")
 
 
+# update-ref updates refs safely, one or a whole batch read from stdin at once
+argsp = argsubparsers.add_parser("update-ref", help="Update, create or delete refs atomically")
+argsp.add_argument("-d",
+   dest="delete",
+   action="store_true",
+   help="Delete the ref, checking its old value if given")
+argsp.add_argument("--stdin",
+   action="store_true",
+   help="Read update, create, delete and verify commands from stdin and apply them all or none")
+argsp.add_argument("ref", nargs="?", help="The ref to update")
+argsp.add_argument("newvalue", nargs="?", help="Its new value")
+argsp.add_argument("oldvalue", nargs="?", help="The value it must have now")
+
+
 argsp = argsubparsers.add_parser("rev-parse", help="Parse revision (or other objects) identifiers")
 argsp.add_argument("--gitv-type",
     metavar="type",
@@ -92,6 +195,13 @@ argsp.add_argument("--gitv-type",
     choices=["blob", "commit", "tag", "tree"],
     default=None,
     help="Specify the expected type")
+argsp.add_argument("--short",
+    action="store_true",
+    help="Print the shortest unique abbreviation of the object name")
+argsp.add_argument("--abbrev",
+    type=int,
+    default=None,
+    help="Shortest length of the abbreviations (default core.abbrev or 7)")
 argsp.add_argument("name", help="The name to parse")
 
 
@@ -102,6 +212,81 @@ argsp = argsubparsers.add_parser("add", help="Add file contents to the index")
 argsp.add_argument("path", help="Path specification of files to add to the index")
 
 
+# repack packs all reachable objects into a single pack
+argsp = argsubparsers.add_parser("repack", help="Pack reachable objects into a packfile")
+argsp.add_argument("-d",
+   dest="delete",
+   action="store_true",
+   help="Remove the packs made redundant by the new pack")
+argsp.add_argument("--window",
+   type=int,
+   default=10,
+   help="Number of objects to try as delta bases")
+argsp.add_argument("--depth",
+   type=int,
+   default=50,
+   help="Maximum length of delta chains")
+argsp.add_argument("-b", "--write-bitmap-index",
+   action="store_true",
+   help="Write a reachability bitmap index for the new pack")
+argsp.add_argument("-i", "--incremental",
+   action="store_true",
+   help="Only merge the loose objects and the small packs, then write the multi-pack-index")
+argsp.add_argument("--batch-size",
+   default=None,
+   help="With -i, merge the packs smaller than this size (default 16m)")
+
+
+# multi-pack-index indexes every pack at once, for one lookup whatever the number of packs
+argsp = argsubparsers.add_parser("multi-pack-index", help="Write the multi-pack-index of the packs")
+argsp.add_argument("action",
+   choices=["write"],
+   help="Write the multi-pack-index of every pack")
+
+
+# rev-list lists the commits, or every object, reachable from the given commits
+argsp = argsubparsers.add_parser("rev-list", help="List the objects reachable from commits")
+argsp.add_argument("--objects",
+   action="store_true",
+   help="List trees, blobs and tags as well as commits")
+argsp.add_argument("--count",
+   action="store_true",
+   help="Print the number of objects instead of listing them")
+argsp.add_argument("--use-bitmap-index",
+   action="store_true",
+   help="Use the pack's reachability bitmaps instead of walking every tree")
+argsp.add_argument("--all",
+   action="store_true",
+   help="Start from every ref and HEAD")
+argsp.add_argument("--abbrev-commit",
+   action="store_true",
+   help="Print the shortest unique abbreviations of the commit names")
+argsp.add_argument("--abbrev",
+   type=int,
+   default=None,
+   help="Shortest length of the abbreviations (default core.abbrev or 7)")
+argsp.add_argument("commits",
+   nargs="*",
+   help="Commits to start from")
+
+
+argsp = argsubparsers.add_parser("write-tree", help="Create a tree object from the current index")
+
+
+# commit-graph writes the commit-graph file used to walk history quickly
+argsp = argsubparsers.add_parser("commit-graph", help="Write the commit-graph file")
+argsp.add_argument("action",
+   choices=["write"],
+   help="Write the commit-graph of every commit reachable from the refs")
+
+
+# fsmonitor--daemon watches the worktree so that status only looks at changed paths
+argsp = argsubparsers.add_parser("fsmonitor--daemon", help="Run the filesystem monitor used when core.fsmonitor is true")
+argsp.add_argument("action",
+   choices=["start", "stop", "run", "status"],
+   help="Start it in the background, stop it, run it in the foreground or show its status")
+
+
 argsp = argsubparsers.add_parser("status", help="Show the working tree status")
 argsp.add_argument("path", nargs="?", help="Path specification of files to add to the index")
 
@@ -126,19 +311,29 @@ commandDict = {
     "cat-file": cmd_cat_file,
     "checkout": cmd_checkout,
     "commit": cmd_commit,
+    "commit-graph": cmd_commit_graph,
+    "diff-tree": cmd_diff_tree,
+    "fsmonitor--daemon": cmd_fsmonitor_daemon,
     "hash-object": cmd_hash_object,
     "init": cmd_init,
     "log": cmd_log,
     "ls-tree": cmd_ls_tree,
     "ls-files": cmd_ls_files,
     "merge": cmd_merge,
+    "merge-base": cmd_merge_base,
+    "multi-pack-index": cmd_multi_pack_index,
+    "pack-refs": cmd_pack_refs,
     "rebase": cmd_rebase,
+    "repack": cmd_repack,
+    "rev-list": cmd_rev_list,
     "rev-parse": cmd_rev_parse,
     "rm": cmd_rm,
     "show-ref": cmd_show_ref,
     "status": cmd_status,
     "tag": cmd_tag,
-    "version": cmd_version
+    "update-ref": cmd_update_ref,
+    "version": cmd_version,
+    "write-tree": cmd_write_tree
 }
 
 
@@ -0,0 +1,75 @@
+# EWAH compressed bitmaps, as serialized by git:
+# bit count, word count, 64-bit words, position of the last running length word.
+# A running length word (RLW) holds the running bit (bit 0), the number of
+# clean words of that bit (bits 1-32) and the number of literal words that
+# follow it (bits 33-63).
+# Bitmaps are handled as Python ints: bit i of the bitmap is bit i of the int.
+import struct
+
+WORD_MASK = 0xFFFFFFFFFFFFFFFF
+MAX_RUN = 0xFFFFFFFF
+MAX_LITERALS = 0x7FFFFFFF
+
+
+def ewah_serialize(bits, bitSize=None):
+    # Like git's, a bitmap is as long as needed to hold its last set bit
+    if bitSize is None:
+        bitSize = bits.bit_length()
+    nwords = (bitSize + 63) // 64
+    words = struct.unpack('<%dQ' % nwords, bits.to_bytes(nwords * 8, 'little')) if nwords else ()
+
+    out = []
+    rlwPos = 0
+    i = 0
+    while i < nwords or not out:
+        runBit = 0
+        run = 0
+        if i < nwords and words[i] in (0, WORD_MASK):
+            clean = words[i]
+            runBit = 1 if clean == WORD_MASK else 0
+            while i < nwords and words[i] == clean and run < MAX_RUN:
+                run += 1
+                i += 1
+        start = i
+        while i < nwords and words[i] not in (0, WORD_MASK) and i - start < MAX_LITERALS:
+            i += 1
+        rlwPos = len(out)
+        out.append(runBit | (run << 1) | ((i - start) << 33))
+        out.extend(words[start:i])
+
+    return struct.pack('!LL', bitSize, len(out)) + struct.pack('!%dQ' % len(out), *out) + struct.pack('!L', rlwPos)
+
+
+def ewah_deserialize(data, pos):
+    """
+    Return (position after the bitmap, bits, bit count)
+    """
+    bitSize, nwords = struct.unpack_from('!LL', data, pos)
+    pos += 8
+    buffer = struct.unpack_from('!%dQ' % nwords, data, pos)
+    pos += 8 * nwords + 4  # The RLW position is not needed to decode
+
+    words = []
+    i = 0
+    while i < nwords:
+        rlw = buffer[i]
+        i += 1
+        run = (rlw >> 1) & MAX_RUN
+        literals = rlw >> 33
+        if run:
+            words.extend([WORD_MASK if rlw & 1 else 0] * run)
+        words.extend(buffer[i:i+literals])
+        i += literals
+
+    bits = int.from_bytes(struct.pack('<%dQ' % len(words), *words), 'little') if words else 0
+    return pos, bits & ((1 << bitSize) - 1), bitSize
+
+
+def bit_positions(bits):
+    # Indexes of the set bits, in increasing order
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    for byteIndex, byte in enumerate(data):
+        if byte:
+            for j in range(8):
+                if byte >> j & 1:
+                    yield byteIndex * 8 + j
@@ -1,2 +1,25 @@
+import time
+from datetime import datetime
+
 def toBytes(strVal, encoding='ascii'):
-  return strVal.encode(encoding) if isinstance(strVal, str) else strVal
\ No newline at end of file
+  return strVal.encode(encoding) if isinstance(strVal, str) else strVal
+
+def toSize(strVal):
+  # Parse a git config size such as "512", "64k", "32m" or "1g"
+  units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+  strVal = strVal.strip().lower()
+  if strVal and strVal[-1] in units:
+    return int(strVal[:-1]) * units[strVal[-1]]
+  return int(strVal)
+
+def toTimestamp(strVal):
+  # Parse a --since/--until date: a Unix timestamp, an ISO 8601 date or "<n> <unit>s ago"
+  units = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800, 'month': 2592000, 'year': 31536000}
+  strVal = strVal.strip().lower()
+  if strVal.isdigit():
+    return int(strVal)
+  if strVal.endswith('ago'):
+    parts = strVal.replace('.', ' ').split()
+    if len(parts) == 3 and parts[0].isdigit() and parts[1].rstrip('s') in units:
+      return int(time.time()) - int(parts[0]) * units[parts[1].rstrip('s')]
+  return int(datetime.fromisoformat(strVal).timestamp())
@@ -0,0 +1,24 @@
+# Variable width integers used by index v4 and its extensions:
+# big-endian base 128 with an implicit +1 on every continuation byte
+
+
+def varint_encode(value):
+    ret = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        value -= 1
+        ret.append(0x80 | (value & 0x7f))
+        value >>= 7
+    ret.reverse()
+    return bytes(ret)
+
+
+def varint_decode(data, pos):
+    c = data[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return pos, value